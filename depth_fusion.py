@@ -0,0 +1,80 @@
+import os, time
+import argparse
+from pathlib import Path
+
+import torch
+
+from src.fusion.depth_consistency import fuse_depth_maps, get_source_views
+from src.fusion.ply import write_point_cloud_ply
+from src.fusion.scan import get_scan_views, load_scan
+
+
+def fuse_scan(args, scan):
+    scan_dir = Path(args.root_dir) / scan
+    views = get_scan_views(scan_dir)
+    if args.test_view is not None:
+        views = args.test_view
+    frames = load_scan(scan_dir, views, skip_missing=args.test_view is None)
+
+    #* full fusion checks every reference view against all other views
+    pair_path = None if args.dataset_dir is None else Path(args.dataset_dir) / scan / "pair.txt"
+    num_src_views = None if args.full_fusion else args.num_src_views
+    source_views = get_source_views(frames, num_src_views, pair_path)
+
+    start = time.time()
+    xyzrgb = fuse_depth_maps(
+        frames,
+        source_views,
+        pixel_thres=args.geo_pixel_thres,
+        depth_thres=args.geo_depth_thres,
+        geo_mask_thres=args.geo_mask_thres,
+        voxel_size=args.voxel_size,
+        batch_size=args.batch_size,
+        device=args.device,
+    )
+    print(f"{scan}: fused {len(frames)} views into {len(xyzrgb)} points in {time.time() - start:.2f}s")
+    write_point_cloud_ply(os.path.join(args.root_dir, "points", "{}.ply".format(scan)), xyzrgb)
+
+
+if __name__ == "__main__":
+     # -------------------------------- args
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', dest='dataset', type=str, default="DTU",
+        help='dataset name')
+    parser.add_argument('--root_dir', dest='root_dir', type=str,
+        help='directory of depth maps')
+    parser.add_argument('--dataset_dir', type=str, default=None,
+        help='dataset directory with <scan>/pair.txt, used to pick source views')
+    parser.add_argument("--test_view", type=int, nargs="+", default=None)
+    parser.add_argument('--test_scan', dest='test_scan', type=str, nargs="+", default=[''],)
+    parser.add_argument('--full_fusion', action='store_true',
+        help='use all other views as source views of every reference view')
+    parser.add_argument('--num_src_views', type=int, default=10,
+        help='source views per reference view without --full_fusion')
+    parser.add_argument('--geo_pixel_thres', type=float, default=1.0,
+        help='max reprojection error in pixels')
+    parser.add_argument('--geo_depth_thres', type=float, default=0.01,
+        help='max relative depth error')
+    parser.add_argument('--geo_mask_thres', type=int, default=3,
+        help='min number of consistent source views')
+    parser.add_argument('--voxel_size', type=float, default=0.2,
+        help='voxel size of the downsampled point cloud, 0 to keep all points')
+    parser.add_argument('--device', type=str, default=None, help='torch device, default: cuda if available')
+    parser.add_argument('--batch_size', type=int, default=16, help='source views checked at once')
+    parser.add_argument('--num_threads', type=int, default=None, help='CPU threads used by torch')
+
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    scans = os.listdir(args.root_dir)
+
+    if args.dataset == "DTU":
+        scans = [i for i in scans if i[:4] == 'scan'] #* dtu
+    else:
+        scans = [i for i in scans if i in args.test_scan]
+    print("found scans:", scans)
+
+    os.makedirs(os.path.join(args.root_dir, "points"), exist_ok=True)
+    for scan in scans:
+        fuse_scan(args, scan)
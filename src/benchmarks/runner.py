@@ -0,0 +1,163 @@
+import json
+from dataclasses import asdict, dataclass
+from itertools import product
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+from tqdm import tqdm
+
+from ..dataset import DatasetCfg
+from ..model.decoder import DecoderCfg
+from ..model.encoder import EncoderCfg
+from .stages import BenchmarkCase, Stage, build_stages
+
+
+@dataclass
+class BenchmarkCfg:
+    stages: list[str]
+    views: list[int]
+    resolutions: list[list[int]]  # [height, width] pairs
+    depth_candidates: list[int]
+    batch_sizes: list[int]
+    device: str | None  # None: CUDA if available
+    warm_up: int
+    repeats: int
+    run: bool  # False: only compare output_path against baseline_path
+    output_path: Path
+    baseline_path: Path | None
+    tolerance: float  # relative slowdown / memory increase reported as a regression
+
+
+def synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+@torch.no_grad()
+def measure(stage: Stage, device: torch.device, warm_up: int, repeats: int) -> dict:
+    for _ in range(warm_up):
+        stage.run()
+    synchronize(device)
+
+    # Peak memory is only tracked by the CUDA caching allocator.
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        base_memory = torch.cuda.memory_allocated(device)
+
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        stage.run()
+        synchronize(device)
+        times.append((perf_counter() - start) * 1e3)
+
+    if device.type == "cuda":
+        peak_memory = (torch.cuda.max_memory_allocated(device) - base_memory) / 2**20
+    else:
+        peak_memory = None
+
+    flops = stage.flops
+    if flops is None:
+        with FlopCounterMode(display=False) as counter:
+            stage.run()
+        flops = counter.get_total_flops()
+
+    return {
+        "time_ms": {
+            "mean": float(np.mean(times)),
+            "min": float(np.min(times)),
+            "p50": float(np.percentile(times, 50)),
+            "p90": float(np.percentile(times, 90)),
+            "p99": float(np.percentile(times, 99)),
+        },
+        "peak_memory_mb": peak_memory,
+        "gflops": flops / 1e9,
+    }
+
+
+def run_benchmarks(
+    cfg: BenchmarkCfg,
+    encoder_cfg: EncoderCfg,
+    decoder_cfg: DecoderCfg,
+    dataset_cfg: DatasetCfg,
+) -> dict:
+    if cfg.device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    else:
+        device = torch.device(cfg.device)
+
+    cases = [
+        BenchmarkCase(views, height, width, depth_candidates, batch_size)
+        for views, (height, width), depth_candidates, batch_size in product(
+            cfg.views, cfg.resolutions, cfg.depth_candidates, cfg.batch_sizes
+        )
+    ]
+    results = []
+    for case in tqdm(cases, desc="Benchmarking"):
+        stages = build_stages(case, encoder_cfg, decoder_cfg, dataset_cfg, device)
+        for name in cfg.stages:
+            result = {"stage": name, **asdict(case)}
+            if name not in stages:
+                result["error"] = f"not available for this config on {device.type}"
+            else:
+                try:
+                    result.update(
+                        measure(stages[name], device, cfg.warm_up, cfg.repeats)
+                    )
+                except RuntimeError as error:  # e.g. out of memory
+                    result["error"] = str(error).splitlines()[0]
+            results.append(result)
+        del stages
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    return {
+        "device": torch.cuda.get_device_name(device)
+        if device.type == "cuda"
+        else "cpu",
+        "torch": torch.__version__,
+        "results": results,
+    }
+
+
+def get_key(result: dict) -> tuple:
+    return tuple(
+        result[key]
+        for key in ("stage", "views", "height", "width", "depth_candidates", "batch_size")
+    )
+
+
+def compare_benchmarks(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """List the stages and cases that got slower (median time) or use more memory than
+    in the baseline by more than the given relative tolerance.
+    """
+    baseline_results = {get_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        reference = baseline_results.get(get_key(result))
+        if reference is None or "error" in result or "error" in reference:
+            continue
+
+        name = "{stage} (views={views}, {height}x{width}, D={depth_candidates}, " \
+            "batch={batch_size})".format(**result)
+        old, new = reference["time_ms"]["p50"], result["time_ms"]["p50"]
+        if new > old * (1 + tolerance):
+            regressions.append(f"{name}: median time {old:.2f} -> {new:.2f} ms")
+        old, new = reference["peak_memory_mb"], result["peak_memory_mb"]
+        if old is not None and new is not None and new > old * (1 + tolerance):
+            regressions.append(f"{name}: peak memory {old:.1f} -> {new:.1f} MiB")
+    return regressions
+
+
+def save_benchmarks(results: dict, path: Path) -> None:
+    path.parent.mkdir(exist_ok=True, parents=True)
+    with path.open("w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_benchmarks(path: Path) -> dict:
+    with path.open("r") as f:
+        return json.load(f)
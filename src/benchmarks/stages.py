@@ -0,0 +1,213 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from typing import Any, Callable, Iterator
+
+import torch
+from einops import rearrange
+from jaxtyping import Float
+from torch import Tensor
+
+from ..dataset import DatasetCfg
+from ..dataset.types import BatchedViews
+from ..global_cfg import get_cfg
+from ..model.decoder import DecoderCfg, get_decoder
+from ..model.encoder import EncoderCfg, get_encoder
+from ..model.encoder.backbone.backbone_multiview import feature_add_position_list
+from ..model.types import Gaussians
+
+
+@dataclass
+class BenchmarkCase:
+    views: int
+    height: int
+    width: int
+    depth_candidates: int
+    batch_size: int
+
+
+@dataclass
+class Stage:
+    run: Callable[[], Any]
+
+    # Analytic estimate for stages whose work is not in matmuls or convolutions, which
+    # is all torch's FLOP counter sees. None means count the FLOPs.
+    flops: int | None = None
+
+
+def get_synthetic_context(
+    case: BenchmarkCase,
+    device: torch.device,
+) -> BatchedViews:
+    """Random images seen by cameras on a small arc that look at the same point."""
+    b, v = case.batch_size, case.views
+    angle = torch.linspace(-0.1 * (v - 1), 0.1 * (v - 1), v)
+    extrinsics = torch.eye(4).repeat(b, v, 1, 1)
+    extrinsics[:, :, 0, 0] = angle.cos()
+    extrinsics[:, :, 0, 2] = angle.sin()
+    extrinsics[:, :, 2, 0] = -angle.sin()
+    extrinsics[:, :, 2, 2] = angle.cos()
+    extrinsics[:, :, 0, 3] = -5 * angle.sin()
+    extrinsics[:, :, 2, 3] = 5 * (1 - angle.cos())
+    intrinsics = torch.tensor([[1.0, 0, 0.5], [0, 1.0, 0.5], [0, 0, 1]])
+    return {
+        "extrinsics": extrinsics.to(device),
+        "intrinsics": intrinsics.repeat(b, v, 1, 1).to(device),
+        "image": torch.rand((b, v, 3, case.height, case.width), device=device),
+        "near": torch.ones((b, v), device=device),
+        "far": torch.full((b, v), 100.0, device=device),
+        "index": torch.arange(v, device=device).repeat(b, 1),
+    }
+
+
+@contextmanager
+def num_context_views(views: int) -> Iterator[None]:
+    """Temporarily set the number of context views in the global config, which the
+    encoder reads when it is built.
+    """
+    view_sampler_cfg = get_cfg().dataset.view_sampler
+    old_views = view_sampler_cfg.num_context_views
+    view_sampler_cfg.num_context_views = views
+    try:
+        yield
+    finally:
+        view_sampler_cfg.num_context_views = old_views
+
+
+def get_random_features(
+    case: BenchmarkCase,
+    channels: int,
+    downscale_factor: int,
+    device: torch.device,
+) -> Float[Tensor, "batch view channel height width"]:
+    return torch.randn(
+        (
+            case.batch_size,
+            case.views,
+            channels,
+            case.height // downscale_factor,
+            case.width // downscale_factor,
+        ),
+        device=device,
+    )
+
+
+def build_stages(
+    case: BenchmarkCase,
+    encoder_cfg: EncoderCfg,
+    decoder_cfg: DecoderCfg,
+    dataset_cfg: DatasetCfg,
+    device: torch.device,
+) -> dict[str, Stage]:
+    """Build every stage of the pipeline for one case, with random weights. Each stage
+    gets synthetic inputs of the shape it sees in the full model, so stages can be
+    timed in isolation. Stages that cannot run on the device, or whose module the
+    configuration does not build, are left out.
+    """
+    encoder_cfg = replace(encoder_cfg, num_depth_candidates=case.depth_candidates)
+    with num_context_views(case.views):
+        encoder, _ = get_encoder(encoder_cfg)
+    encoder = encoder.to(device).eval()
+    decoder = get_decoder(decoder_cfg, dataset_cfg).to(device)
+
+    b, v, h, w = case.batch_size, case.views, case.height, case.width
+    c = encoder_cfg.d_feature
+    d = case.depth_candidates
+    scale = encoder_cfg.downscale_factor
+    context = get_synthetic_context(case, device)
+    backbone = encoder.backbone
+    depth_predictor = encoder.depth_predictor
+    splits = encoder_cfg.multiview_trans_attn_split
+
+    with torch.no_grad():
+        # transformer input: CNN features with positional encodings
+        images = backbone.normalize_images(context["image"])
+        features_list = feature_add_position_list(
+            [x[0] for x in backbone.extract_feature(images)],
+            splits,
+            backbone.feature_channels,
+        )
+
+        # decoder input: the Gaussians of a full encoder pass, rendered from the context
+        gaussians: Gaussians = encoder(context, 0, deterministic=True)
+
+    # cost volume, its refiner and the depth refiner
+    features = get_random_features(case, c, scale, device)
+    num_neighbors = v - 1
+    if encoder_cfg.costvolume_num_neighbors is not None and v > 2:
+        num_neighbors = min(num_neighbors, encoder_cfg.costvolume_num_neighbors)
+    # Without a cost volume, the refiner only sees the features.
+    costvolume_c = c if encoder_cfg.wo_cost_volume else d + c
+    costvolume_in = torch.randn(
+        (v * b, costvolume_c, h // scale, w // scale), device=device
+    )
+    depth_unet_in = torch.randn(
+        (v * b, 3 + encoder_cfg.depth_unet_feat_dim + 2, h, w), device=device
+    )
+
+    # Gaussian adapter input, shaped like in EncoderCostVolume.forward
+    adapter = encoder.gaussian_adapter
+    srf = encoder_cfg.num_surfaces
+    xy = torch.rand((b, v, h * w, srf, 1, 2), device=device)
+    depths = 1 + 10 * torch.rand((b, v, h * w, srf, 1), device=device)
+    opacities = torch.rand((b, v, h * w, srf, 1), device=device)
+    raw_gaussians = torch.randn((b, v, h * w, srf, 1, adapter.d_in), device=device)
+
+    def correlate():
+        return depth_predictor.build_cost_volume(
+            features,
+            context["intrinsics"],
+            context["extrinsics"],
+            context["near"],
+            context["far"],
+            d,
+        )
+
+    stages = {
+        "encoder": Stage(lambda: encoder(context, 0, deterministic=True)),
+        "backbone": Stage(
+            lambda: backbone(
+                context["image"], attn_splits=splits, return_cnn_features=True
+            )
+        ),
+        "transformer": Stage(
+            lambda: backbone.transformer(features_list, attn_num_splits=splits)
+        ),
+        # per source view: one multiply-add per channel and candidate, plus the
+        # bilinear lookup (four taps per channel) of the warped features
+        "cost_volume": Stage(
+            correlate,
+            flops=num_neighbors * v * b * d * (h // scale) * (w // scale) * c * (2 + 8),
+        ),
+        "costvolume_unet": Stage(lambda: depth_predictor.corr_refine_net(costvolume_in)),
+        "depth_unet": Stage(lambda: depth_predictor.refine_unet(depth_unet_in)),
+        "gaussian_adapter": Stage(
+            lambda: adapter.forward(
+                rearrange(context["extrinsics"], "b v i j -> b v () () () i j"),
+                rearrange(context["intrinsics"], "b v i j -> b v () () () i j"),
+                xy,
+                depths,
+                opacities,
+                raw_gaussians,
+                (h, w),
+            )
+        ),
+        "decoder": Stage(
+            lambda: decoder.forward(
+                gaussians,
+                context["extrinsics"],
+                context["intrinsics"],
+                context["near"],
+                context["far"],
+                (h, w),
+            )
+        ),
+    }
+
+    # Ablations without cost volume refinement have no refiner.
+    if not hasattr(depth_predictor, "corr_refine_net"):
+        del stages["costvolume_unet"]
+
+    # The CUDA rasterizer cannot run on other devices.
+    if decoder_cfg.name == "splatting_cuda" and device.type != "cuda":
+        del stages["decoder"]
+    return stages
@@ -2,17 +2,20 @@ from torch.utils.data import Dataset
 
 from ..misc.step_tracker import StepTracker
 from .dataset_re10k import DatasetRE10k, DatasetRE10kCfg
+from .dataset_re10k_mmap import DatasetRE10kMmap, DatasetRE10kMmapCfg
 from .dataset_dtu import DatasetDTU, DatasetDTUCfg
+from .map_style_wrapper import MapStyleWrapper
 from .types import Stage
 from .view_sampler import get_view_sampler
 
 DATASETS: dict[str, Dataset] = {
     "re10k": DatasetRE10k,
+    "re10k_mmap": DatasetRE10kMmap,
     "dtu": DatasetDTU,
 }
 
 
-DatasetCfg = DatasetRE10kCfg
+DatasetCfg = DatasetRE10kCfg | DatasetRE10kMmapCfg
 # DatasetCfg = DatasetDTUCfg
 
 
@@ -28,4 +31,7 @@ def get_dataset(
         cfg.cameras_are_circular,
         step_tracker,
     )
-    return DATASETS[cfg.name](cfg, stage, view_sampler)
+    dataset = DATASETS[cfg.name](cfg, stage, view_sampler)
+    if isinstance(dataset, DatasetRE10k) and cfg.map_style:
+        dataset = MapStyleWrapper(dataset)
+    return dataset
@@ -26,11 +26,11 @@ from .types import Stage
 from .view_sampler import ViewSampler
 import random
 
-from .scene_transform import get_boundingbox
+from .scene_transform import normalize_cameras
 
 from torchvision import transforms as T
 
-from transforms3d.quaternions import qinverse, qmult, rotate_vector, quat2mat, mat2quat
+from transforms3d.quaternions import qinverse, qmult, rotate_vector, quat2mat
 
 
 random.seed(0)
@@ -80,30 +80,6 @@ def read_monoData(path):
         mono = mono[None]
     return mono
 
-def load_K_Rt_from_P(filename, P=None):
-    if P is None:
-        lines = open(filename).read().splitlines()
-        if len(lines) == 4:
-            lines = lines[1:]
-        lines = [[x[0], x[1], x[2], x[3]] for x in (x.split(" ") for x in lines)]
-        P = np.asarray(lines).astype(np.float32).squeeze()
-
-    out = cv2.decomposeProjectionMatrix(P)
-    K = out[0]
-    R = out[1]
-    t = out[2]
-
-    K = K / K[2, 2]
-    intrinsics = np.eye(4)
-    intrinsics[:3, :3] = K
-
-    pose = np.eye(4, dtype=np.float32)
-    pose[:3, :3] = R.transpose()
-    pose[:3, 3] = (t[:3] / t[3])[:, 0]
-
-    return intrinsics, pose
-
-
 @dataclass
 class DatasetDTUCfg(DatasetCfgCommon):
     name: Literal['dtu']
@@ -119,6 +95,7 @@ class DatasetDTUCfg(DatasetCfgCommon):
     test_context_views: list[int]
     test_target_views: list[int]
     single_view: bool
+    cache_dir: Path | None = None
 
 
 class DatasetDTU(IterableDataset):
@@ -218,29 +195,16 @@ class DatasetDTU(IterableDataset):
             #* each scene
             proj_matrices = []
             for i, vid in enumerate(view_ids):
-                # NOTE that the id in image file names is from 1 to 49 (not 0~48)
-                img_filename = os.path.join(str(self.cfg.roots[0]),
-                                            f'Rectified/{scan}_train/rect_{vid + 1:03d}_{light_idx}_r5000.png')
-                depth_filename = os.path.join(str(self.cfg.roots[0]),
-                                            f'Depths_raw/{scan}/depth_map_{vid:04d}.pfm')
-                
-                mask_filename = os.path.join(str(self.cfg.roots[0]),
-                                             f'Masks/{scan}_train/mask_{vid:04d}.png')
+                view = self.load_view(scan, vid, light_idx)
                 
-                normal_filename = os.path.join(str(self.cfg.roots[0]),
-                                            f'Rectified/{scan}_train/normal/rect_{vid + 1:03d}_{light_idx}_r5000_normal.npy')
-                
-                img_src = Image.open(img_filename) 
-                img = self.transform(img_src)
-                
-                imgs += [img]
+                imgs += [view["image"]]
                 
                 #TODO: duster code
-                img_paths += [img_filename]
+                img_paths += [view["image_path"]]
                 
-                masks += [self.transform(Image.open(mask_filename).convert('L'))]
+                masks += [view["mask"]]
                 
-                monoNs += [self.transform(read_monoData(normal_filename).transpose(1, 2, 0))]
+                monoNs += [view["normal"]]
                 
                 index_mat = self.remap[vid]
                 near_fars.append(self.all_near_fars[index_mat])
@@ -249,53 +213,24 @@ class DatasetDTU(IterableDataset):
                 w2cs.append(self.all_extrinsics[index_mat] @ w2c_ref_inv) #* reference view to source view
                 # w2cs.append(self.all_extrinsics[index_mat])
                 
-                if os.path.exists(depth_filename):
-                    depth_h = self.read_depth(depth_filename)
-                    depths_h += [depth_h]
-
-
-            scale_mat, scale_factor = self.cal_scale_mat(img_hw=[self.cfg.image_shape[0], self.cfg.image_shape[1]],
-                                                     intrinsics=intrinsics_org_scale, extrinsics=w2cs,
-                                                     near_fars=near_fars, factor=1.1)
-            new_near_fars = []
-            new_w2cs = []
-            new_c2ws = []
-            new_depths_h = [] 
-            new_qs = [] #* quaternion
-            new_rs = [] #* 3x3 rotation matrix
-            new_ts = [] #* translation vector
-            new_cs = [] #* camera origin
-            
-            for i, (intrinsic, extrinsic, depth) in enumerate(zip(intrinsics_org_scale, w2cs, depths_h)):
-            
-                P = intrinsic @ extrinsic @ scale_mat # perspective matrix scaled by scale_mat
-                P = P[:3, :4]
-                c2w = load_K_Rt_from_P(None, P)[1] #* camera to world
-
-                camera_o = c2w[:3, 3].copy() #* camera origin
-                
-                if i == 0:
-                    camera_o_canonical = camera_o.copy()
-                
-                # translate the camera to make the first camera located at the origin
-                c2w[:3, 3] -= camera_o_canonical
-                
-                
-                new_cs.append(camera_o)
-                
-                w2c = np.linalg.inv(c2w)
-                new_w2cs.append(w2c)
-                new_c2ws.append(c2w)
-                
-                new_qs.append(mat2quat(w2c[:3, :3]))
-                new_rs.append(c2w[:3, :3].copy())
-                new_ts.append(c2w[:3, 3].copy())
-                
-                dist = np.sqrt(np.sum(camera_o ** 2))
-                near = dist - 1 if dist > 1 else 0.1
-                far = dist + 1
-                new_near_fars.append([0.95 * near, 1.05 * far])
-                new_depths_h.append(depth * scale_factor)
+                if view["depth"] is not None:
+                    depths_h += [view["depth"].numpy()]
+
+
+            # normalize all views at once: scale the scene into the unit sphere and move
+            # the first camera to the origin
+            cameras = normalize_cameras(
+                (self.cfg.image_shape[0], self.cfg.image_shape[1]),
+                torch.from_numpy(np.stack(intrinsics_org_scale)),
+                torch.from_numpy(np.stack(w2cs)),
+                torch.from_numpy(np.stack(near_fars)).float(),
+                factor=1.1,
+            )
+            scale_mat = cameras.scale_mat.numpy()
+            scale_factor = cameras.scale_factor.numpy()
+            new_depths_h = [depth * scale_factor for depth in depths_h]
+            new_qs = cameras.quaternions.numpy() #* quaternion
+            new_cs = cameras.origins.numpy() #* camera origin
             
             q1, t1 = new_qs[0], new_cs[0]
             # quaternion and translation vector that transforms World-to-Cam
@@ -312,13 +247,13 @@ class DatasetDTU(IterableDataset):
             T[:3, -1] = t12
             T = torch.from_numpy(T)
 
-            new_rs = torch.from_numpy(np.stack(new_rs).astype(np.float32))
-            new_ts = torch.from_numpy(np.stack(new_ts).astype(np.float32))
+            new_rs = cameras.c2ws[:, :3, :3].contiguous() #* 3x3 rotation matrix
+            new_ts = cameras.c2ws[:, :3, 3].contiguous() #* translation vector
 
             imgs = torch.stack(imgs)
             depths_h = np.stack(new_depths_h)
             
-            intrinsics, w2cs, c2ws, near_fars = np.stack(intrinsics), np.stack(new_w2cs), np.stack(new_c2ws), np.stack(new_near_fars)
+            intrinsics, w2cs, c2ws, near_fars = np.stack(intrinsics), cameras.w2cs.numpy(), cameras.c2ws.numpy(), cameras.near_fars.numpy()
             intrinsics_org_scale = np.stack(intrinsics_org_scale)
             
             focal_lengths = repeat(intrinsics[0, :2, :2].diagonal(), 'xy -> b xy', b=len(intrinsics))
@@ -591,6 +526,56 @@ class DatasetDTU(IterableDataset):
 
         return intrinsics_, extrinsics, [depth_min, depth_max]
     
+    def load_view(self, scan: str, vid: int, light_idx: int) -> dict:
+        """Load the resized image, mask, normal and depth of one view. With cache_dir
+        set, every view is preprocessed once and stored as a .torch file that later
+        epochs and other workers memory-map, so PNG decoding, PFM parsing and resizing
+        only happen on the first access.
+        """
+        if self.cfg.cache_dir is None:
+            return self.read_view(scan, vid, light_idx)
+
+        h, w = self.cfg.image_shape
+        cache_path = (
+            self.cfg.cache_dir / f"{h}x{w}" / scan / f"{vid:04d}_{light_idx}.torch"
+        )
+        if cache_path.exists():
+            return torch.load(cache_path, mmap=True)
+
+        view = self.read_view(scan, vid, light_idx)
+
+        # Write to a temporary file first, since other workers may build the same view.
+        cache_path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        torch.save(view, tmp_path)
+        os.replace(tmp_path, cache_path)
+        return view
+
+    def read_view(self, scan: str, vid: int, light_idx: int) -> dict:
+        # NOTE that the id in image file names is from 1 to 49 (not 0~48)
+        img_filename = os.path.join(str(self.cfg.roots[0]),
+                                    f'Rectified/{scan}_train/rect_{vid + 1:03d}_{light_idx}_r5000.png')
+        depth_filename = os.path.join(str(self.cfg.roots[0]),
+                                    f'Depths_raw/{scan}/depth_map_{vid:04d}.pfm')
+        
+        mask_filename = os.path.join(str(self.cfg.roots[0]),
+                                     f'Masks/{scan}_train/mask_{vid:04d}.png')
+        
+        normal_filename = os.path.join(str(self.cfg.roots[0]),
+                                    f'Rectified/{scan}_train/normal/rect_{vid + 1:03d}_{light_idx}_r5000_normal.npy')
+        
+        depth = None
+        if os.path.exists(depth_filename):
+            depth = torch.from_numpy(self.read_depth(depth_filename))
+
+        return {
+            "image": self.transform(Image.open(img_filename)),
+            "image_path": img_filename,
+            "mask": self.transform(Image.open(mask_filename).convert('L')),
+            "normal": self.transform(read_monoData(normal_filename).transpose(1, 2, 0)),
+            "depth": depth,
+        }
+
     def read_depth(self, filename):
         depth_h = np.array(read_pfm(filename)[0], dtype=np.float32)  # (1200, 1600)
         depth_h = cv2.resize(depth_h, None, fx=0.5, fy=0.5,
@@ -605,16 +590,6 @@ class DatasetDTU(IterableDataset):
         
         return depth_h
     
-    def cal_scale_mat(self, img_hw, intrinsics, extrinsics, near_fars, factor=1.):
-        center, radius, _ = get_boundingbox(img_hw, intrinsics, extrinsics, near_fars)
-
-        radius = radius * factor
-        scale_mat = np.diag([radius, radius, radius, 1.0])
-        scale_mat[:3, 3] = center.cpu().numpy()
-        scale_mat = scale_mat.astype(np.float32)
-
-        return scale_mat, 1. / radius.cpu().numpy()
-    
     def build_remap(self):
         self.remap = np.zeros(np.max(self.allview_ids) + 1).astype('int')
         for i, item in enumerate(self.allview_ids):
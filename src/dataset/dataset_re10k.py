@@ -1,14 +1,15 @@
 import json
+from collections import defaultdict
 from dataclasses import dataclass
 from functools import cached_property
 from io import BytesIO
 from pathlib import Path
-from typing import Literal
+from typing import Iterator, Literal
 
 import torch
 import torchvision.transforms as tf
 from einops import rearrange, repeat
-from jaxtyping import Float, UInt8
+from jaxtyping import Float, Int64, UInt8
 from PIL import Image
 from torch import Tensor
 from torch.utils.data import IterableDataset
@@ -17,8 +18,9 @@ from ..geometry.projection import get_fov
 from .dataset import DatasetCfgCommon
 from .shims.augmentation_shim import apply_augmentation_shim
 from .shims.crop_shim import apply_crop_shim
+from .sharding import get_rank_and_world_size, get_shard
 from .types import Stage
-from .view_sampler import ViewSampler
+from .view_sampler import ViewSampler, ViewSamplerEvaluation
 
 
 @dataclass
@@ -37,6 +39,8 @@ class DatasetRE10kCfg(DatasetCfgCommon):
     far: float = -1.0
     baseline_scale_bounds: bool = True
     shuffle_val: bool = True
+    shard: bool = False
+    map_style: bool = False
 
 
 class DatasetRE10k(IterableDataset):
@@ -46,6 +50,10 @@ class DatasetRE10k(IterableDataset):
 
     to_tensor: tf.ToTensor
     chunks: list[Path]
+    epoch: Int64[Tensor, ""]
+    rank: int
+    world_size: int
+    chunk_suffix: str = ".torch"
     near: float = 0.1
     far: float = 1000.0
 
@@ -66,14 +74,16 @@ class DatasetRE10k(IterableDataset):
         if cfg.far != -1:
             self.far = cfg.far
 
+        # The epoch lives in shared memory so that set_epoch reaches the data loader
+        # workers. The rank is read here because workers may not see the process group.
+        self.epoch = torch.tensor(0, dtype=torch.int64).share_memory_()
+        self.rank, self.world_size = get_rank_and_world_size()
+
         # Collect chunks.
         self.chunks = []
         for root in cfg.roots:
             root = root / self.data_stage
-            root_chunks = sorted(
-                [path for path in root.iterdir() if path.suffix == ".torch"]
-            )
-            self.chunks.extend(root_chunks)
+            self.chunks.extend(self.collect_chunks(root))
         if self.cfg.overfit_to_scene is not None:
             chunk_path = self.index[self.cfg.overfit_to_scene]
             self.chunks = [chunk_path] * len(self.chunks)
@@ -82,38 +92,35 @@ class DatasetRE10k(IterableDataset):
             # is not change, this should not cause any problem except for the display
             self.chunks = self.chunks[:: cfg.test_chunk_interval]
 
+    def collect_chunks(self, root: Path) -> list[Path]:
+        return sorted(
+            [path for path in root.iterdir() if path.suffix == self.chunk_suffix]
+        )
+
     def shuffle(self, lst: list) -> list:
         indices = torch.randperm(len(lst))
         return [lst[x] for x in indices]
 
     def __iter__(self):
-        # Chunks must be shuffled here (not inside __init__) for validation to show
-        # random chunks.
-        if self.stage in (("train", "val") if self.cfg.shuffle_val else ("train")):
-            self.chunks = self.shuffle(self.chunks)
-
-        # When testing, the data loaders alternate chunks.
-        worker_info = torch.utils.data.get_worker_info()
-        if self.stage == "test" and worker_info is not None:
-            self.chunks = [
-                chunk
-                for chunk_index, chunk in enumerate(self.chunks)
-                if chunk_index % worker_info.num_workers == worker_info.id
-            ]
-
-        for chunk_path in self.chunks:
+        for chunk_path in self.iterate_chunk_paths():
             # print(chunk_path)
-            # Load the chunk.
+            # Load the chunk. If only some of its scenes are needed, seek to them
+            # directly instead of loading every scene in the chunk.
+            keys = self.get_required_keys(chunk_path)
+            if keys is not None and len(keys) == 0:
+                continue
             try :
-                chunk = torch.load(chunk_path)
+                if keys is None:
+                    chunk = self.load_chunk(chunk_path)
+                else:
+                    chunk = self.load_scenes(chunk_path, keys)
             except:
                 print(chunk_path, "failed to load")
                 continue
 
             if self.cfg.overfit_to_scene is not None:
-                item = [x for x in chunk if x["key"] == self.cfg.overfit_to_scene]
-                assert len(item) == 1
-                chunk = item * len(chunk)
+                assert len(chunk) == 1
+                chunk = chunk * len(self.chunk_keys[chunk_path])
 
             if self.stage in (("train", "val") if self.cfg.shuffle_val else ("train")):
                 chunk = self.shuffle(chunk)
@@ -121,113 +128,206 @@ class DatasetRE10k(IterableDataset):
             # for example in chunk:
             times_per_scene = self.cfg.test_times_per_scene
             for run_idx in range(int(times_per_scene * len(chunk))):
-                example = chunk[run_idx // times_per_scene]
-
-                extrinsics, intrinsics = self.convert_poses(example["cameras"])
-                if times_per_scene > 1:  # specifically for DTU
-                    scene = f"{example['key']}_{(run_idx % times_per_scene):02d}"
-                else:
-                    scene = example["key"]
-
-                try:
-                    context_indices, target_indices = self.view_sampler.sample(
-                        scene,
-                        extrinsics,
-                        intrinsics,
-                    )
-                    # reverse the context
-                    # context_indices = torch.flip(context_indices, dims=[0])
-                    # print(context_indices)
-                except ValueError:
-                    # Skip because the example doesn't have enough frames.
-                    continue
-
-                # Skip the example if the field of view is too wide.
-                if (get_fov(intrinsics).rad2deg() > self.cfg.max_fov).any():
-                    continue
-
-                # Load the images.
-                context_images = [
-                    example["images"][index.item()] for index in context_indices
+                example = self.get_example(chunk[run_idx // times_per_scene], run_idx)
+                if example is not None:
+                    yield example
+
+    def iterate_chunk_paths(self) -> Iterator[Path]:
+        shuffle = self.stage in (("train", "val") if self.cfg.shuffle_val else ("train"))
+
+        if not self.cfg.shard:
+            # Chunks must be shuffled here (not inside __init__) for validation to show
+            # random chunks.
+            if shuffle:
+                self.chunks = self.shuffle(self.chunks)
+
+            # When testing, the data loaders alternate chunks.
+            worker_info = torch.utils.data.get_worker_info()
+            if self.stage == "test" and worker_info is not None:
+                self.chunks = [
+                    chunk
+                    for chunk_index, chunk in enumerate(self.chunks)
+                    if chunk_index % worker_info.num_workers == worker_info.id
                 ]
-                context_images = self.convert_images(context_images)
-                target_images = [
-                    example["images"][index.item()] for index in target_indices
-                ]
-                target_images = self.convert_images(target_images)
-
-                # Skip the example if the images don't have the right shape.
-                context_image_invalid = context_images.shape[1:] != (3, 360, 640)
-                target_image_invalid = target_images.shape[1:] != (3, 360, 640)
-                if self.cfg.skip_bad_shape and (context_image_invalid or target_image_invalid):
-                    print(
-                        f"Skipped bad example {example['key']}. Context shape was "
-                        f"{context_images.shape} and target shape was "
-                        f"{target_images.shape}."
-                    )
-                    continue
-
-                # Resize the world to make the baseline 1.
-                context_extrinsics = extrinsics[context_indices]
-                if context_extrinsics.shape[0] == 2 and self.cfg.make_baseline_1:
-                    a, b = context_extrinsics[:, :3, 3]
-                    scale = (a - b).norm()
-                    if scale < self.cfg.baseline_epsilon:
-                        print(
-                            f"Skipped {scene} because of insufficient baseline "
-                            f"{scale:.6f}"
-                        )
-                        continue
-                    extrinsics[:, :3, 3] /= scale
-                else:
-                    scale = 1
-                
-                #! make the first extrinsics to be the reference view (identical rotation, zero translation) by projection matrices
-                all_indices = torch.cat([context_indices, target_indices])
-                c2ws_all = extrinsics[all_indices].clone()
-                w2cs_all = torch.inverse(c2ws_all)
-                
-                                # Extract the first extrinsic (rotation and translation)
-                def transform_extrinsics(w2cs):
-                    w2cs = w2cs.detach()
-                    ref_w2c_inv = torch.linalg.inv(w2cs[0])
-                    
-                    return torch.einsum('nij,jk->nik', w2cs, ref_w2c_inv)
-
-                w2cs_ref_all = transform_extrinsics(w2cs_all)
-                c2ws_ref_all = w2cs_ref_all.inverse()
-                
-                extrinsics[all_indices] = c2ws_ref_all.clone()
-                extrinsics_gt = extrinsics.clone()
-                
-                R = extrinsics_gt[:, :3, :3]
-                T = extrinsics_gt[:, :3, 3]
-                focal_lengths = repeat(intrinsics[0, :2, :2].diagonal(), 'xy -> b xy', b=len(intrinsics))
-
-                nf_scale = scale if self.cfg.baseline_scale_bounds else 1.0
-                example = {
-                    "context": {
-                        "extrinsics": extrinsics[context_indices],
-                        "extrinsics_gt": extrinsics_gt[context_indices],
-                        "intrinsics": intrinsics[context_indices],
-                        "image": context_images,
-                        "near": self.get_bound("near", len(context_indices)) / nf_scale,
-                        "far": self.get_bound("far", len(context_indices)) / nf_scale,
-                        "index": context_indices,
-                    },
-                    "target": {
-                        "extrinsics": extrinsics[target_indices],
-                        "intrinsics": intrinsics[target_indices],
-                        "image": target_images,
-                        "near": self.get_bound("near", len(target_indices)) / nf_scale,
-                        "far": self.get_bound("far", len(target_indices)) / nf_scale,
-                        "index": target_indices,
-                    },
-                    "scene": scene,
-                }
-                if self.stage == "train" and self.cfg.augment:
-                    example = apply_augmentation_shim(example)
-                yield apply_crop_shim(example, tuple(self.cfg.image_shape))
+            yield from self.chunks
+            return
+
+        # Every (rank, worker) pair reads a disjoint slice of the chunks. All shards
+        # shuffle with the same epoch seed, so together they cover each chunk exactly
+        # once per epoch.
+        shard_index, num_shards = get_shard(self.rank, self.world_size)
+        if shard_index >= len(self.chunks):
+            # An empty training shard would loop forever without yielding.
+            if self.stage == "train":
+                raise ValueError(
+                    f"Shard {shard_index} of {num_shards} gets none of the "
+                    f"{len(self.chunks)} chunks. Use fewer data loader workers or "
+                    "disable dataset.shard."
+                )
+            return
+        epoch = self.epoch.item()
+        while True:
+            chunks = self.chunks
+            if shuffle:
+                generator = torch.Generator().manual_seed(epoch)
+                indices = torch.randperm(len(chunks), generator=generator)
+                chunks = [chunks[x] for x in indices]
+            yield from chunks[shard_index::num_shards]
+
+            # Training shards never run dry, so a rank that drew fewer examples cannot
+            # stall the others at the end of an epoch.
+            if self.stage != "train":
+                return
+            epoch += 1
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch.fill_(epoch)
+
+    def get_example(self, example: dict, run_idx: int) -> dict | None:
+        times_per_scene = self.cfg.test_times_per_scene
+        extrinsics, intrinsics = self.convert_poses(example["cameras"])
+        if times_per_scene > 1:  # specifically for DTU
+            scene = f"{example['key']}_{(run_idx % times_per_scene):02d}"
+        else:
+            scene = example["key"]
+
+        try:
+            context_indices, target_indices = self.view_sampler.sample(
+                scene,
+                extrinsics,
+                intrinsics,
+            )
+            # reverse the context
+            # context_indices = torch.flip(context_indices, dims=[0])
+            # print(context_indices)
+        except ValueError:
+            # Skip because the example doesn't have enough frames.
+            return None
+
+        # Skip the example if the field of view is too wide.
+        if (get_fov(intrinsics).rad2deg() > self.cfg.max_fov).any():
+            return None
+
+        # Load the images.
+        context_images = [
+            example["images"][index.item()] for index in context_indices
+        ]
+        context_images = self.convert_images(context_images)
+        target_images = [
+            example["images"][index.item()] for index in target_indices
+        ]
+        target_images = self.convert_images(target_images)
+
+        # Skip the example if the images don't have the right shape.
+        context_image_invalid = context_images.shape[1:] != (3, 360, 640)
+        target_image_invalid = target_images.shape[1:] != (3, 360, 640)
+        if self.cfg.skip_bad_shape and (context_image_invalid or target_image_invalid):
+            print(
+                f"Skipped bad example {example['key']}. Context shape was "
+                f"{context_images.shape} and target shape was "
+                f"{target_images.shape}."
+            )
+            return None
+
+        # Resize the world to make the baseline 1.
+        context_extrinsics = extrinsics[context_indices]
+        if context_extrinsics.shape[0] == 2 and self.cfg.make_baseline_1:
+            a, b = context_extrinsics[:, :3, 3]
+            scale = (a - b).norm()
+            if scale < self.cfg.baseline_epsilon:
+                print(
+                    f"Skipped {scene} because of insufficient baseline "
+                    f"{scale:.6f}"
+                )
+                return None
+            extrinsics[:, :3, 3] /= scale
+        else:
+            scale = 1
+
+        #! make the first extrinsics to be the reference view (identical rotation, zero translation) by projection matrices
+        all_indices = torch.cat([context_indices, target_indices])
+        c2ws_all = extrinsics[all_indices].clone()
+        w2cs_all = torch.inverse(c2ws_all)
+
+                        # Extract the first extrinsic (rotation and translation)
+        def transform_extrinsics(w2cs):
+            w2cs = w2cs.detach()
+            ref_w2c_inv = torch.linalg.inv(w2cs[0])
+
+            return torch.einsum('nij,jk->nik', w2cs, ref_w2c_inv)
+
+        w2cs_ref_all = transform_extrinsics(w2cs_all)
+        c2ws_ref_all = w2cs_ref_all.inverse()
+
+        extrinsics[all_indices] = c2ws_ref_all.clone()
+        extrinsics_gt = extrinsics.clone()
+
+        R = extrinsics_gt[:, :3, :3]
+        T = extrinsics_gt[:, :3, 3]
+        focal_lengths = repeat(intrinsics[0, :2, :2].diagonal(), 'xy -> b xy', b=len(intrinsics))
+
+        nf_scale = scale if self.cfg.baseline_scale_bounds else 1.0
+        example = {
+            "context": {
+                "extrinsics": extrinsics[context_indices],
+                "extrinsics_gt": extrinsics_gt[context_indices],
+                "intrinsics": intrinsics[context_indices],
+                "image": context_images,
+                "near": self.get_bound("near", len(context_indices)) / nf_scale,
+                "far": self.get_bound("far", len(context_indices)) / nf_scale,
+                "index": context_indices,
+            },
+            "target": {
+                "extrinsics": extrinsics[target_indices],
+                "intrinsics": intrinsics[target_indices],
+                "image": target_images,
+                "near": self.get_bound("near", len(target_indices)) / nf_scale,
+                "far": self.get_bound("far", len(target_indices)) / nf_scale,
+                "index": target_indices,
+            },
+            "scene": scene,
+        }
+        if self.stage == "train" and self.cfg.augment:
+            example = apply_augmentation_shim(example)
+        return apply_crop_shim(example, tuple(self.cfg.image_shape))
+
+    def load_chunk(self, chunk_path: Path) -> list[dict]:
+        return torch.load(chunk_path)
+
+    def load_scenes(self, chunk_path: Path, keys: list[str]) -> list[dict]:
+        # Memory-mapping the chunk only deserializes its pickled structure, so the image
+        # bytes of scenes that are not requested are never read from disk.
+        try:
+            chunk = torch.load(chunk_path, mmap=True)
+        except RuntimeError:
+            # Chunks saved in the legacy (non-zipfile) format cannot be memory-mapped.
+            chunk = self.load_chunk(chunk_path)
+        scenes = {example["key"]: example for example in chunk}
+        return [scenes[key] for key in keys]
+
+    def load_scene(self, key: str) -> dict:
+        return self.load_scenes(self.index[key], [key])[0]
+
+    def get_required_keys(self, chunk_path: Path) -> list[str] | None:
+        """Return the scenes of the chunk that can actually be used, or None if the
+        whole chunk is needed.
+        """
+        if self.cfg.overfit_to_scene is not None:
+            return [self.cfg.overfit_to_scene]
+
+        # The evaluation index names every scene that will be used at test time.
+        if (
+            self.stage == "test"
+            and isinstance(self.view_sampler, ViewSamplerEvaluation)
+            and self.cfg.test_times_per_scene == 1
+        ):
+            return [
+                key
+                for key in self.chunk_keys[chunk_path]
+                if self.view_sampler.index.get(key) is not None
+            ]
+
+        return None
 
     def convert_poses(
         self,
@@ -298,7 +398,20 @@ class DatasetRE10k(IterableDataset):
                 merged_index = {**merged_index, **index}
         return merged_index
 
+    @cached_property
+    def chunk_keys(self) -> dict[Path, list[str]]:
+        chunk_keys = defaultdict(list)
+        for key, chunk_path in self.index.items():
+            chunk_keys[chunk_path].append(key)
+        return chunk_keys
+
     def __len__(self) -> int:
+        if self.cfg.shard:
+            # Each rank only sees its own share of the scenes.
+            length = len(self.index.keys()) * self.cfg.test_times_per_scene
+            if self.stage == "test" and self.cfg.test_len > 0:
+                length = min(length, self.cfg.test_len)
+            return length // self.world_size
         return (
             min(len(self.index.keys()) *
                 self.cfg.test_times_per_scene, self.cfg.test_len)
@@ -0,0 +1,186 @@
+import json
+from dataclasses import asdict, dataclass
+from functools import cached_property
+from pathlib import Path
+from typing import Literal
+
+import numpy as np
+import torch
+from einops import rearrange
+from jaxtyping import Float, UInt8
+from torch import Tensor
+
+from .dataset_re10k import DatasetRE10k, DatasetRE10kCfg
+
+# Every scene block starts on a page boundary so that the float32 camera rows at the
+# start of the block are always aligned, whatever the frame sizes of earlier scenes.
+BLOCK_ALIGNMENT = 4096
+CAMERA_ENTRIES = 18
+
+
+@dataclass
+class SceneRecord:
+    """Location of one scene inside a chunk's .bin file. The scene block holds the
+    float32 camera rows (num_frames x 18) followed by the decoded uint8 frames
+    (num_frames x height x width x 3), both stored contiguously.
+    """
+
+    key: str
+    offset: int  # byte offset of the scene block inside the .bin file
+    length: int  # byte length of the scene block (without alignment padding)
+    num_frames: int
+    frame_shape: tuple[int, int, int]  # height, width, channel
+
+
+def get_camera_bytes(num_frames: int) -> int:
+    return num_frames * CAMERA_ENTRIES * np.dtype(np.float32).itemsize
+
+
+def get_block_padding(num_bytes: int) -> int:
+    return -num_bytes % BLOCK_ALIGNMENT
+
+
+def load_chunk_table(path: Path) -> list[SceneRecord]:
+    with path.open("r") as f:
+        table = json.load(f)
+    return [
+        SceneRecord(**{**record, "frame_shape": tuple(record["frame_shape"])})
+        for record in table
+    ]
+
+
+def save_chunk_table(path: Path, table: list[SceneRecord]) -> None:
+    with path.open("w") as f:
+        json.dump([asdict(record) for record in table], f)
+
+
+@dataclass
+class SceneIndexEntry(SceneRecord):
+    """A SceneRecord together with the chunk it lives in and the absolute byte offset of
+    every frame, so that a single scene (or frame) can be read without opening the
+    chunk table.
+    """
+
+    chunk: str  # name of the .bin file inside the stage directory
+    frame_offsets: list[int]
+
+
+def get_frame_offsets(record: SceneRecord) -> list[int]:
+    start = record.offset + get_camera_bytes(record.num_frames)
+    frame_bytes = int(np.prod(record.frame_shape))
+    return [start + i * frame_bytes for i in range(record.num_frames)]
+
+
+def build_scene_index(stage_dir: Path) -> dict[str, SceneIndexEntry]:
+    scene_index = {}
+    for table_path in sorted(stage_dir.glob("*.json")):
+        bin_path = table_path.with_suffix(".bin")
+        if not bin_path.exists():
+            continue
+        for record in load_chunk_table(table_path):
+            scene_index[record.key] = SceneIndexEntry(
+                **asdict(record),
+                chunk=bin_path.name,
+                frame_offsets=get_frame_offsets(record),
+            )
+    return scene_index
+
+
+def load_scene_index(stage_dir: Path) -> dict[str, SceneIndexEntry]:
+    # Directories converted before the scene index existed are indexed on the fly.
+    path = stage_dir / "scene_index.json"
+    if not path.exists():
+        return build_scene_index(stage_dir)
+    with path.open("r") as f:
+        scene_index = json.load(f)
+    return {
+        key: SceneIndexEntry(**{**entry, "frame_shape": tuple(entry["frame_shape"])})
+        for key, entry in scene_index.items()
+    }
+
+
+def save_scene_index(stage_dir: Path, scene_index: dict[str, SceneIndexEntry]) -> None:
+    with (stage_dir / "scene_index.json").open("w") as f:
+        json.dump({key: asdict(entry) for key, entry in scene_index.items()}, f)
+
+
+def read_scene(
+    bin_path: Path,
+    record: SceneRecord,
+) -> tuple[
+    Float[Tensor, "frame 18"],  # cameras
+    UInt8[Tensor, "frame height width 3"],  # images
+]:
+    """Map a single scene block into memory. Nothing is read from disk until frames are
+    actually indexed, and the returned tensors are zero-copy views of the mapping. The
+    copy-on-write mode keeps the arrays writable, which torch.from_numpy requires.
+    """
+    block = np.memmap(
+        bin_path,
+        dtype=np.uint8,
+        mode="c",
+        offset=record.offset,
+        shape=(record.length,),
+    )
+    camera_bytes = get_camera_bytes(record.num_frames)
+    cameras = block[:camera_bytes].view(np.float32)
+    cameras = cameras.reshape(record.num_frames, CAMERA_ENTRIES)
+    images = block[camera_bytes:].reshape(record.num_frames, *record.frame_shape)
+    return torch.from_numpy(cameras), torch.from_numpy(images)
+
+
+@dataclass
+class DatasetRE10kMmapCfg(DatasetRE10kCfg):
+    name: Literal["re10k_mmap"]
+
+
+class DatasetRE10kMmap(DatasetRE10k):
+    """RE10k backed by pre-decoded, memory-mapped chunks written by
+    src/scripts/convert_re10k_mmap.py. Each .torch chunk is replaced by a .json table of
+    SceneRecords and a .bin file of raw scene blocks, so workers only touch the frames
+    that a sample actually uses and never run JPEG decoding.
+    """
+
+    cfg: DatasetRE10kMmapCfg
+    chunk_suffix: str = ".json"
+
+    def collect_chunks(self, root: Path) -> list[Path]:
+        # The stage directory also holds index.json and scene_index.json, which are not
+        # chunk tables.
+        return [
+            path
+            for path in super().collect_chunks(root)
+            if path.with_suffix(".bin").exists()
+        ]
+
+    def load_chunk(self, chunk_path: Path) -> list[dict]:
+        bin_path = chunk_path.with_suffix(".bin")
+        chunk = []
+        for record in load_chunk_table(chunk_path):
+            cameras, images = read_scene(bin_path, record)
+            chunk.append({"key": record.key, "cameras": cameras, "images": images})
+        return chunk
+
+    def convert_images(
+        self,
+        images: list[UInt8[Tensor, "height width 3"]],
+    ) -> Float[Tensor, "batch 3 height width"]:
+        images = rearrange(torch.stack(images), "b h w c -> b c h w")
+        return images.float() / 255
+
+    @cached_property
+    def scene_index(self) -> dict[str, SceneIndexEntry]:
+        scene_index = {}
+        for stage_dir in sorted({path.parent for path in self.index.values()}):
+            scene_index.update(load_scene_index(stage_dir))
+        return scene_index
+
+    def load_scenes(self, chunk_path: Path, keys: list[str]) -> list[dict]:
+        bin_path = chunk_path.with_suffix(".bin")
+        chunk = []
+        for key in keys:
+            entry = self.scene_index[key]
+            assert entry.chunk == bin_path.name
+            cameras, images = read_scene(bin_path, entry)
+            chunk.append({"key": key, "cameras": cameras, "images": images})
+        return chunk
@@ -0,0 +1,41 @@
+from torch.utils.data import Dataset
+
+from .dataset_re10k import DatasetRE10k
+
+
+class MapStyleWrapper(Dataset):
+    """Exposes the scenes of a chunked dataset through random access. Since the result
+    is map-style, Lightning shards it across DDP ranks with a DistributedSampler, which
+    also reshuffles deterministically every epoch; the data loader then splits each
+    rank's indices among its workers.
+    """
+
+    dataset: DatasetRE10k
+    keys: list[str]
+
+    def __init__(self, dataset: DatasetRE10k) -> None:
+        super().__init__()
+        self.dataset = dataset
+
+        # Follow the dataset's chunk order so that neighbouring indices share a chunk.
+        self.keys = []
+        for chunk_path in dataset.chunks:
+            keys = dataset.get_required_keys(chunk_path)
+            self.keys.extend(dataset.chunk_keys[chunk_path] if keys is None else keys)
+
+    def __len__(self) -> int:
+        length = len(self.keys) * self.dataset.cfg.test_times_per_scene
+        if self.dataset.stage == "test" and self.dataset.cfg.test_len > 0:
+            return min(length, self.dataset.cfg.test_len)
+        return length
+
+    def __getitem__(self, index: int):
+        # Examples that the dataset would skip are replaced by the next valid one.
+        times_per_scene = self.dataset.cfg.test_times_per_scene
+        for offset in range(len(self)):
+            run_idx = (index + offset) % len(self)
+            scene = self.dataset.load_scene(self.keys[run_idx // times_per_scene])
+            example = self.dataset.get_example(scene, run_idx)
+            if example is not None:
+                return example
+        raise ValueError("The dataset does not contain any valid examples.")
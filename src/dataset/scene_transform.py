@@ -1,5 +1,9 @@
+from dataclasses import dataclass
+
 import numpy as np
 import torch
+from jaxtyping import Float
+from torch import Tensor
 
 def rigid_transform(xyz, transform):
     """Applies a rigid transform (c2w) to an (N, 3) pointcloud.
@@ -105,3 +109,136 @@ def get_boundingbox(img_hw, intrinsics, extrinsics, near_fars):
     radius = max_length / 2
 
     return center, radius, bnds
+
+
+def get_boundingbox_batched(img_hw, intrinsics, extrinsics, near_fars):
+    """Vectorized get_boundingbox for stacked (view, 4, 4) intrinsics and w2c
+    extrinsics and (view, 2) near/far values.
+    """
+    im_h, im_w = int(img_hw[0]), int(img_hw[1])
+    num_views = intrinsics.shape[0]
+
+    # The 8 corners of every view frustum in camera space.
+    u = torch.tensor([0, 0, im_w, im_w] * 2, dtype=torch.float32)
+    v = torch.tensor([0, im_h, 0, im_h] * 2, dtype=torch.float32)
+    depth = torch.cat(
+        [
+            near_fars[:, :1].expand(num_views, 4),
+            near_fars[:, 1:].expand(num_views, 4),
+        ],
+        dim=1,
+    )
+    fx, fy = intrinsics[:, 0, 0, None], intrinsics[:, 1, 1, None]
+    cx, cy = intrinsics[:, 0, 2, None], intrinsics[:, 1, 2, None]
+    view_frust_pts = torch.stack(
+        [(u - cx) * depth / fx, (v - cy) * depth / fy, depth], dim=-1
+    )
+
+    c2w = torch.inverse(extrinsics)
+    view_frust_pts = torch.einsum("vij,vpj->vpi", c2w[:, :3, :3], view_frust_pts)
+    view_frust_pts = view_frust_pts + c2w[:, None, :3, 3]
+
+    view_frust_pts = view_frust_pts.reshape(-1, 3)
+    bnds = torch.stack(
+        [view_frust_pts.min(dim=0)[0], view_frust_pts.max(dim=0)[0]], dim=1
+    )
+    center = (bnds[:, 1] + bnds[:, 0]) / 2
+    radius = (bnds[:, 1] - bnds[:, 0]).max() / 2
+
+    return center, radius, bnds
+
+
+def decompose_projection_matrix(projection):
+    """Batched, closed-form equivalent of cv2.decomposeProjectionMatrix. Splits
+    (..., 3, 4) matrices P = K [R | -R C] into the intrinsics K (normalized so that
+    K[2, 2] = 1), the world-to-camera rotation R and the camera center C.
+    """
+    m = projection[..., :3]
+
+    # RQ decomposition through the QR decomposition of the row-reversed transpose.
+    flip = torch.eye(3, dtype=m.dtype, device=m.device).flip(0)
+    q, r = torch.linalg.qr((flip @ m).transpose(-1, -2))
+    k = flip @ r.transpose(-1, -2) @ flip
+    rotation = flip @ q.transpose(-1, -2)
+
+    # Like OpenCV, keep the diagonal of K positive.
+    sign = torch.diag_embed(torch.sign(k.diagonal(dim1=-2, dim2=-1)))
+    k = k @ sign
+    rotation = sign @ rotation
+
+    center = -torch.linalg.solve(m, projection[..., 3:])[..., 0]
+    return k / k[..., 2:3, 2:3], rotation, center
+
+
+def mat2quat_batched(rotation):
+    """Vectorized transforms3d.quaternions.mat2quat for (..., 3, 3) rotations. Returns
+    (w, x, y, z) quaternions with a non-negative w.
+    """
+    qxx, qyx, qzx, qxy, qyy, qzy, qxz, qyz, qzz = rotation.flatten(-2).unbind(-1)
+    zero = torch.zeros_like(qxx)
+    k = torch.stack(
+        [
+            torch.stack([qxx - qyy - qzz, zero, zero, zero], dim=-1),
+            torch.stack([qyx + qxy, qyy - qxx - qzz, zero, zero], dim=-1),
+            torch.stack([qzx + qxz, qzy + qyz, qzz - qxx - qyy, zero], dim=-1),
+            torch.stack([qyz - qzy, qzx - qxz, qxy - qyx, qxx + qyy + qzz], dim=-1),
+        ],
+        dim=-2,
+    ) / 3.0
+
+    # The quaternion is the eigenvector of the largest eigenvalue (eigh reads the
+    # lower triangle, like numpy in transforms3d).
+    _, vecs = torch.linalg.eigh(k)
+    q = vecs[..., [3, 0, 1, 2], -1]
+    return torch.where(q[..., :1] < 0, -q, q)
+
+
+@dataclass
+class NormalizedCameras:
+    scale_mat: Float[Tensor, "4 4"]
+    scale_factor: Float[Tensor, ""]
+    c2ws: Float[Tensor, "view 4 4"]
+    w2cs: Float[Tensor, "view 4 4"]
+    quaternions: Float[Tensor, "view 4"]  # w2c rotations as (w, x, y, z)
+    origins: Float[Tensor, "view 3"]  # camera centers before re-centering
+    near_fars: Float[Tensor, "view 2"]
+
+
+def normalize_cameras(
+    img_hw,
+    intrinsics: Float[Tensor, "view 4 4"],
+    extrinsics: Float[Tensor, "view 4 4"],
+    near_fars: Float[Tensor, "view 2"],
+    factor: float = 1.0,
+) -> NormalizedCameras:
+    """Scale the scene into the unit sphere around the views' joint frustum bounding box,
+    then move the first camera to the origin. Replaces the per-view loop of
+    get_boundingbox, cv2.decomposeProjectionMatrix, np.linalg.inv and mat2quat.
+    """
+    center, radius, _ = get_boundingbox_batched(img_hw, intrinsics, extrinsics, near_fars)
+    radius = radius * factor
+    scale_mat = torch.diag(torch.stack([radius, radius, radius, torch.ones_like(radius)]))
+    scale_mat[:3, 3] = center
+
+    # Decompose the scaled projection matrices in double precision.
+    projection = (intrinsics @ extrinsics @ scale_mat)[:, :3, :4]
+    _, rotation, origins = decompose_projection_matrix(projection.double())
+
+    c2ws = torch.eye(4, dtype=torch.float64).repeat(len(rotation), 1, 1)
+    c2ws[:, :3, :3] = rotation.transpose(-1, -2)
+    c2ws[:, :3, 3] = origins - origins[0]
+    w2cs = torch.inverse(c2ws)
+
+    dist = origins.norm(dim=-1)
+    near = torch.where(dist > 1, dist - 1, 0.1)
+    far = dist + 1
+
+    return NormalizedCameras(
+        scale_mat=scale_mat,
+        scale_factor=1.0 / radius,
+        c2ws=c2ws.float(),
+        w2cs=w2cs.float(),
+        quaternions=mat2quat_batched(w2cs[:, :3, :3]),
+        origins=origins.float(),
+        near_fars=torch.stack([0.95 * near, 1.05 * far], dim=-1).float(),
+    )
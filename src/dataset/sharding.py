@@ -0,0 +1,40 @@
+from typing import Any, Iterator
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Dataset, IterableDataset
+
+
+def get_rank_and_world_size() -> tuple[int, int]:
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def get_shard(rank: int, world_size: int) -> tuple[int, int]:
+    """Return the index of the calling (rank, worker) pair and the total number of
+    such pairs. Shard indices are laid out rank-major, so each rank owns a contiguous
+    block of worker shards.
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    if worker_info is None:
+        return rank, world_size
+    return (
+        rank * worker_info.num_workers + worker_info.id,
+        world_size * worker_info.num_workers,
+    )
+
+
+def iterate_worker_examples(dataset: Dataset) -> Iterator[Any]:
+    """Iterate over the calling data loader worker's examples. An iterable dataset
+    splits itself across workers, a map-style one is split here by index.
+    """
+    if isinstance(dataset, IterableDataset):
+        yield from dataset
+        return
+
+    # Iterating a map-style dataset directly would index it until IndexError,
+    # which MapStyleWrapper never raises, and every worker would see every scene.
+    shard, num_shards = get_shard(0, 1)
+    for index in range(shard, len(dataset), num_shards):
+        yield dataset[index]
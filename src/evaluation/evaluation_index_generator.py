@@ -1,10 +1,15 @@
+import hashlib
 import json
 from dataclasses import asdict, dataclass
 from pathlib import Path
+from typing import Iterator
 
 import torch
 from einops import rearrange
+from jaxtyping import Float
 from pytorch_lightning import LightningModule
+from torch import Tensor
+from torch.utils.data import DataLoader, Dataset, IterableDataset
 from tqdm import tqdm
 
 from ..geometry.epipolar_lines import project_rays
@@ -24,6 +29,9 @@ class EvaluationIndexGeneratorCfg:
     output_path: Path
     save_previews: bool
     seed: int
+    grid_stride: int = 1  # overlaps are estimated from every n-th pixel's ray
+    context_batch_size: int = 1  # context frames whose overlaps are computed at once
+    pair_batch_size: int = 64  # frame pairs per projection call
 
 
 @dataclass
@@ -32,6 +40,204 @@ class IndexEntry:
     target: tuple[int, ...]
 
 
+@dataclass
+class IndexSelection:
+    entry: IndexEntry
+    context_index: int
+    chosen: int
+    overlap_a: float  # fraction of the chosen frame's rays that hit the context frame
+    overlap_b: float  # fraction of the context frame's rays that hit the chosen frame
+
+
+def compute_overlaps(
+    origins: Float[Tensor, "view ray 3"],
+    directions: Float[Tensor, "view ray 3"],
+    extrinsics: Float[Tensor, "view 4 4"],
+    intrinsics: Float[Tensor, "view 3 3"],
+    source: Tensor,  # int64 [pair]
+    target: Tensor,  # int64 [pair]
+    pair_batch_size: int,
+) -> Float[Tensor, " pair"]:
+    """For each pair, compute the fraction of the source frame's rays whose projection
+    onto the target frame overlaps the image.
+    """
+    overlaps = []
+    for s, t in zip(source.split(pair_batch_size), target.split(pair_batch_size)):
+        projection = project_rays(
+            origins[s],
+            directions[s],
+            rearrange(extrinsics[t], "p i j -> p () i j"),
+            rearrange(intrinsics[t], "p i j -> p () i j"),
+        )
+        overlaps.append(projection["overlaps_image"].float().mean(dim=-1))
+    return torch.cat(overlaps)
+
+
+def get_candidates(
+    context_index: int,
+    num_views: int,
+    cfg: EvaluationIndexGeneratorCfg,
+) -> list[tuple[Tensor, Tensor]]:
+    """The frames a walk away from the context frame can visit in each direction. The
+    walk checks the frame one past the maximum distance before it stops.
+    """
+    deltas = torch.arange(cfg.min_distance, cfg.max_distance + 2)
+    candidates = []
+    for step in (1, -1):
+        indices = context_index + step * deltas
+        in_range = (indices >= 0) & (indices < num_views)
+        candidates.append((indices[in_range], deltas[in_range]))
+    return candidates
+
+
+def fill_overlap_matrix(
+    overlaps: Float[Tensor, "view view"],
+    origins: Float[Tensor, "view ray 3"],
+    directions: Float[Tensor, "view ray 3"],
+    extrinsics: Float[Tensor, "view 4 4"],
+    intrinsics: Float[Tensor, "view 3 3"],
+    context_indices: list[int],
+    cfg: EvaluationIndexGeneratorCfg,
+) -> None:
+    """Compute the missing overlaps (NaN) between the context frames and the frames
+    their walks can visit, in both directions, in batches of frame pairs.
+    """
+    v, _ = overlaps.shape
+    pairs = []
+    for context_index in context_indices:
+        for indices, _ in get_candidates(context_index, v, cfg):
+            context = torch.full_like(indices, context_index)
+            pairs.append(torch.stack((context, indices), dim=-1))
+            pairs.append(torch.stack((indices, context), dim=-1))
+    pairs = torch.cat(pairs).unique(dim=0)
+    pairs = pairs[overlaps[pairs[:, 0], pairs[:, 1]].isnan()]
+    if len(pairs) == 0:
+        return
+    overlaps[pairs[:, 0], pairs[:, 1]] = compute_overlaps(
+        origins,
+        directions,
+        extrinsics,
+        intrinsics,
+        pairs[:, 0].to(origins.device),
+        pairs[:, 1].to(origins.device),
+        cfg.pair_batch_size,
+    ).to(overlaps.device)
+
+
+def select_index_entry(
+    extrinsics: Float[Tensor, "view 4 4"],
+    intrinsics: Float[Tensor, "view 3 3"],
+    image_shape: tuple[int, int],
+    cfg: EvaluationIndexGeneratorCfg,
+    generator: torch.Generator,
+) -> IndexSelection | None:
+    """Pick a context pair whose overlap lies within the configured band and target
+    views between them. Context frames are tried in random order. For each, the frames
+    at increasing distance are visited in both directions until the overlap drops below
+    the minimum or the maximum distance is exceeded. Overlaps are read from a pairwise
+    matrix that is computed in batches for a few context frames at a time.
+    """
+    v, _, _ = extrinsics.shape
+    h, w = image_shape
+    xy, _ = sample_image_grid(
+        (h // cfg.grid_stride, w // cfg.grid_stride), extrinsics.device
+    )
+    origins, directions = get_world_rays(
+        rearrange(xy, "h w xy -> (h w) xy"),
+        rearrange(extrinsics, "v i j -> v () i j"),
+        rearrange(intrinsics, "v i j -> v () i j"),
+    )
+
+    # overlaps[i, j] is the fraction of frame i's rays that hit frame j.
+    overlaps = torch.full((v, v), torch.nan)
+
+    context_indices = torch.randperm(v, generator=generator).tolist()
+    for block_start in range(0, v, cfg.context_batch_size):
+        block = context_indices[block_start : block_start + cfg.context_batch_size]
+        fill_overlap_matrix(
+            overlaps, origins, directions, extrinsics, intrinsics, block, cfg
+        )
+
+        for context_index in block:
+            valid_indices = []
+            for indices, deltas in get_candidates(context_index, v, cfg):
+                overlap = torch.minimum(
+                    overlaps[indices, context_index], overlaps[context_index, indices]
+                )
+
+                # The walk reaches a frame if it did not stop at any frame before.
+                keep_going = (overlap >= cfg.min_overlap) & (deltas <= cfg.max_distance)
+                reached = torch.ones_like(keep_going)
+                reached[1:] = keep_going[:-1].cumprod(0)
+                valid = (
+                    reached
+                    & (overlap >= cfg.min_overlap)
+                    & (overlap <= cfg.max_overlap)
+                )
+                valid_indices.extend(
+                    (
+                        index,
+                        overlaps[index, context_index].item(),
+                        overlaps[context_index, index].item(),
+                    )
+                    for index in indices[valid].tolist()
+                )
+
+            if not valid_indices:
+                continue
+
+            # Pick a random valid view. Index the resulting views.
+            num_options = len(valid_indices)
+            chosen = torch.randint(0, num_options, size=tuple(), generator=generator)
+            chosen, overlap_a, overlap_b = valid_indices[chosen]
+
+            context_left = min(chosen, context_index)
+            context_right = max(chosen, context_index)
+
+            # Pick non-repeated random target views.
+            while True:
+                target_views = torch.randint(
+                    context_left,
+                    context_right + 1,
+                    (cfg.num_target_views,),
+                    generator=generator,
+                )
+                if (target_views.unique(return_counts=True)[1] == 1).all():
+                    break
+
+            entry = IndexEntry(
+                context=(context_left, context_right),
+                target=tuple(sorted(target_views.tolist())),
+            )
+            return IndexSelection(entry, context_index, chosen, overlap_a, overlap_b)
+
+    # This happens if no starting frame produces a valid evaluation example.
+    return None
+
+
+def save_preview(
+    images: Float[Tensor, "view 3 height width"],
+    selection: IndexSelection,
+    scene: str,
+    cfg: EvaluationIndexGeneratorCfg,
+) -> None:
+    preview_path = cfg.output_path / "previews"
+    preview_path.mkdir(exist_ok=True, parents=True)
+    a = add_label(images[selection.chosen], f"Overlap: {selection.overlap_a * 100:.1f}%")
+    b = images[selection.context_index]
+    b = add_label(b, f"Overlap: {selection.overlap_b * 100:.1f}%")
+    left, right = selection.entry.context
+    vis = add_border(add_border(hcat(a, b)), 1, 0)
+    vis = add_label(vis, f"Distance: {right - left} frames")
+    save_image(add_border(vis), preview_path / f"{scene}.png")
+
+
+def save_index(index: dict[str, IndexEntry | None], output_path: Path) -> None:
+    output_path.mkdir(exist_ok=True, parents=True)
+    with (output_path / "evaluation_index.json").open("w") as f:
+        json.dump({k: None if v is None else asdict(v) for k, v in index.items()}, f)
+
+
 class EvaluationIndexGenerator(LightningModule):
     generator: torch.Generator
     cfg: EvaluationIndexGeneratorCfg
@@ -47,112 +253,78 @@ class EvaluationIndexGenerator(LightningModule):
     def test_step(self, batch, batch_idx):
         b, v, _, h, w = batch["target"]["image"].shape
         assert b == 1
-        extrinsics = batch["target"]["extrinsics"][0]
-        intrinsics = batch["target"]["intrinsics"][0]
         scene = batch["scene"][0]
+        selection = select_index_entry(
+            batch["target"]["extrinsics"][0],
+            batch["target"]["intrinsics"][0],
+            (h, w),
+            self.cfg,
+            self.generator,
+        )
+        self.index[scene] = None if selection is None else selection.entry
 
-        context_indices = torch.randperm(v, generator=self.generator)
-        for context_index in tqdm(context_indices, "Finding context pair"):
-            xy, _ = sample_image_grid((h, w), self.device)
-            context_origins, context_directions = get_world_rays(
-                rearrange(xy, "h w xy -> (h w) xy"),
-                extrinsics[context_index],
-                intrinsics[context_index],
-            )
+        # Optionally, save a preview.
+        if selection is not None and self.cfg.save_previews:
+            save_preview(batch["target"]["image"][0], selection, scene, self.cfg)
 
-            # Step away from context view until the minimum overlap threshold is met.
-            valid_indices = []
-            for step in (1, -1):
-                min_distance = self.cfg.min_distance
-                max_distance = self.cfg.max_distance
-                current_index = context_index + step * min_distance
-
-                while 0 <= current_index.item() < v:
-                    # Compute overlap.
-                    current_origins, current_directions = get_world_rays(
-                        rearrange(xy, "h w xy -> (h w) xy"),
-                        extrinsics[current_index],
-                        intrinsics[current_index],
-                    )
-                    projection_onto_current = project_rays(
-                        context_origins,
-                        context_directions,
-                        extrinsics[current_index],
-                        intrinsics[current_index],
-                    )
-                    projection_onto_context = project_rays(
-                        current_origins,
-                        current_directions,
-                        extrinsics[context_index],
-                        intrinsics[context_index],
-                    )
-                    overlap_a = projection_onto_context["overlaps_image"].float().mean()
-                    overlap_b = projection_onto_current["overlaps_image"].float().mean()
-
-                    overlap = min(overlap_a, overlap_b)
-                    delta = (current_index - context_index).abs()
-
-                    min_overlap = self.cfg.min_overlap
-                    max_overlap = self.cfg.max_overlap
-                    if min_overlap <= overlap <= max_overlap:
-                        valid_indices.append(
-                            (current_index.item(), overlap_a, overlap_b)
-                        )
-
-                    # Stop once the camera has panned away too much.
-                    if overlap < min_overlap or delta > max_distance:
-                        break
-
-                    current_index += step
-
-            if valid_indices:
-                # Pick a random valid view. Index the resulting views.
-                num_options = len(valid_indices)
-                chosen = torch.randint(
-                    0, num_options, size=tuple(), generator=self.generator
-                )
-                chosen, overlap_a, overlap_b = valid_indices[chosen]
-
-                context_left = min(chosen, context_index.item())
-                context_right = max(chosen, context_index.item())
-                delta = context_right - context_left
-
-                # Pick non-repeated random target views.
-                while True:
-                    target_views = torch.randint(
-                        context_left,
-                        context_right + 1,
-                        (self.cfg.num_target_views,),
-                        generator=self.generator,
-                    )
-                    if (target_views.unique(return_counts=True)[1] == 1).all():
-                        break
+    def save_index(self) -> None:
+        save_index(self.index, self.cfg.output_path)
 
-                target = tuple(sorted(target_views.tolist()))
-                self.index[scene] = IndexEntry(
-                    context=(context_left, context_right),
-                    target=target,
-                )
 
-                # Optionally, save a preview.
-                if self.cfg.save_previews:
-                    preview_path = self.cfg.output_path / "previews"
-                    preview_path.mkdir(exist_ok=True, parents=True)
-                    a = batch["target"]["image"][0, chosen]
-                    a = add_label(a, f"Overlap: {overlap_a * 100:.1f}%")
-                    b = batch["target"]["image"][0, context_index]
-                    b = add_label(b, f"Overlap: {overlap_b * 100:.1f}%")
-                    vis = add_border(add_border(hcat(a, b)), 1, 0)
-                    vis = add_label(vis, f"Distance: {delta} frames")
-                    save_image(add_border(vis), preview_path / f"{scene}.png")
-                break
-        else:
-            # This happens if no starting frame produces a valid evaluation example.
-            self.index[scene] = None
+class IndexEntryDataset(IterableDataset):
+    """Selects the index entries of the wrapped dataset's scenes inside the data
+    loader's worker processes. An iterable dataset splits its chunks across the
+    workers itself, a map-style one is split by index. Each scene gets its own random
+    generator, so the index does not depend on how scenes are split across workers.
+    """
 
-    def save_index(self) -> None:
-        self.cfg.output_path.mkdir(exist_ok=True, parents=True)
-        with (self.cfg.output_path / "evaluation_index.json").open("w") as f:
-            json.dump(
-                {k: None if v is None else asdict(v) for k, v in self.index.items()}, f
+    def __init__(self, dataset: Dataset, cfg: EvaluationIndexGeneratorCfg) -> None:
+        super().__init__()
+        self.dataset = dataset
+        self.cfg = cfg
+
+    def __iter__(self) -> Iterator[tuple[str, IndexEntry | None]]:
+        # The dataset package imports IndexEntry from this module.
+        from ..dataset.sharding import iterate_worker_examples
+
+        for example in iterate_worker_examples(self.dataset):
+            scene = example["scene"]
+            digest = hashlib.sha256(scene.encode()).digest()
+            generator = torch.Generator()
+            generator.manual_seed(self.cfg.seed + int.from_bytes(digest[:4], "little"))
+
+            images = example["target"]["image"]
+            _, _, h, w = images.shape
+            selection = select_index_entry(
+                example["target"]["extrinsics"],
+                example["target"]["intrinsics"],
+                (h, w),
+                self.cfg,
+                generator,
             )
+            if selection is not None and self.cfg.save_previews:
+                save_preview(images, selection, scene, self.cfg)
+            yield scene, None if selection is None else selection.entry
+
+
+def generate_evaluation_index(
+    cfg: EvaluationIndexGeneratorCfg,
+    dataset: Dataset,
+    num_workers: int,
+) -> dict[str, IndexEntry | None]:
+    """Build the evaluation index without Lightning, with scenes processed in parallel
+    by num_workers processes.
+    """
+    data_loader = DataLoader(
+        IndexEntryDataset(dataset, cfg),
+        batch_size=None,
+        num_workers=num_workers,
+    )
+    index = {}
+    for scene, entry in tqdm(data_loader, desc="Generating index"):
+        # MapStyleWrapper replaces skipped examples with the next valid one, so a
+        # scene can arrive more than once.
+        if scene in index:
+            continue
+        index[scene] = entry
+    return index
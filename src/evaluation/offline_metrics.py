@@ -0,0 +1,228 @@
+import json
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+import torch
+from jaxtyping import Float
+from tabulate import tabulate
+from torch import Tensor
+from torch.utils.data import DataLoader, Dataset, IterableDataset
+from tqdm import tqdm
+
+from ..dataset.data_module import DataLoaderStageCfg, worker_init_fn
+from ..dataset.sharding import iterate_worker_examples
+from ..misc.image_io import load_image
+from .evaluation_cfg import EvaluationCfg, MethodCfg
+from .metrics import compute_lpips, compute_psnr, compute_ssim
+
+METRICS = ("psnr", "lpips", "ssim")
+
+
+@dataclass
+class OfflineMetricsCfg:
+    batch_size: int  # frames per metric call, gathered across scenes
+    num_threads: int  # image loading threads per worker process
+    prefetch: int  # scenes whose images are loaded ahead, per worker process
+    device: str | None  # None: CUDA if available
+    cache_path: Path | None  # per-scene results; None: next to the output file
+
+
+@dataclass
+class SceneImages:
+    scene: str
+    ground_truth: Float[Tensor, "view 3 height width"] | None  # None: cached
+    predicted: dict[str, Float[Tensor, "view 3 height width"]]
+
+
+def get_scene_cache_path(cache_path: Path, scene: str) -> Path:
+    return cache_path / f"{scene}.json"
+
+
+def load_scene_metrics(
+    cache_path: Path,
+    scene: str,
+    keys: list[str],
+) -> dict[str, float] | None:
+    path = get_scene_cache_path(cache_path, scene)
+    if not path.exists():
+        return None
+    with path.open("r") as f:
+        metrics = json.load(f)
+
+    # Methods that were added since the scene was cached need a recomputation.
+    if any(f"{metric}_{key}" not in metrics for metric in METRICS for key in keys):
+        return None
+    return metrics
+
+
+def save_scene_metrics(cache_path: Path, scene: str, metrics: dict[str, float]) -> None:
+    # Write to a temporary file first so an interrupted run never leaves a truncated
+    # result behind.
+    path = get_scene_cache_path(cache_path, scene)
+    tmp_path = path.with_suffix(".tmp")
+    with tmp_path.open("w") as f:
+        json.dump(metrics, f)
+    tmp_path.replace(path)
+
+
+def load_method_images(method: MethodCfg, scene: str, indices: list[int]) -> Tensor:
+    images = [load_image(method.path / scene / f"color/{i:0>6}.png") for i in indices]
+    return torch.stack(images)
+
+
+class SceneImageDataset(IterableDataset):
+    """Pairs the ground-truth target views of every test example with each method's
+    saved renders. An iterable dataset splits its chunks across the data loader's
+    worker processes itself, a map-style one is split here by index. Within a worker,
+    a thread pool decodes the PNGs of the next few scenes while the current one is
+    handed to the main process.
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        cfg: OfflineMetricsCfg,
+        methods: list[MethodCfg],
+        cache_path: Path,
+    ) -> None:
+        super().__init__()
+        self.dataset = dataset
+        self.cfg = cfg
+        self.methods = methods
+        self.cache_path = cache_path
+
+    def __iter__(self) -> Iterator[SceneImages]:
+        keys = [method.key for method in self.methods]
+        pending: deque[tuple[str, Tensor, dict[str, Future]]] = deque()
+
+        with ThreadPoolExecutor(self.cfg.num_threads) as executor:
+            for example in iterate_worker_examples(self.dataset):
+                scene = example["scene"]
+                if load_scene_metrics(self.cache_path, scene, keys) is not None:
+                    yield SceneImages(scene, None, {})
+                    continue
+
+                if not all((method.path / scene).exists() for method in self.methods):
+                    print(f'Skipping "{scene}".')
+                    continue
+
+                indices = example["target"]["index"].tolist()
+                futures = {
+                    method.key: executor.submit(
+                        load_method_images, method, scene, indices
+                    )
+                    for method in self.methods
+                }
+                pending.append((scene, example["target"]["image"], futures))
+                if len(pending) > self.cfg.prefetch:
+                    scene_images = self.collect(*pending.popleft())
+                    if scene_images is not None:
+                        yield scene_images
+
+            while pending:
+                scene_images = self.collect(*pending.popleft())
+                if scene_images is not None:
+                    yield scene_images
+
+    def collect(
+        self,
+        scene: str,
+        ground_truth: Tensor,
+        futures: dict[str, Future],
+    ) -> SceneImages | None:
+        try:
+            predicted = {key: future.result() for key, future in futures.items()}
+        except FileNotFoundError:
+            print(f'Skipping "{scene}".')
+            return None
+        return SceneImages(scene, ground_truth, predicted)
+
+
+def compute_batch_metrics(
+    batch: list[SceneImages],
+    keys: list[str],
+    device: torch.device,
+) -> list[dict[str, float]]:
+    """Compute the metrics of all frames of several scenes at once and return the
+    per-scene means.
+    """
+    ground_truth = torch.cat([scene.ground_truth for scene in batch]).to(device)
+    num_frames = [scene.ground_truth.shape[0] for scene in batch]
+    scene_metrics = [{} for _ in batch]
+    for key in keys:
+        predicted = torch.cat([scene.predicted[key] for scene in batch]).to(device)
+        for metric, compute in zip(
+            METRICS, (compute_psnr, compute_lpips, compute_ssim)
+        ):
+            values = compute(ground_truth, predicted).split(num_frames)
+            for metrics, scene_values in zip(scene_metrics, values):
+                metrics[f"{metric}_{key}"] = scene_values.mean().item()
+    return scene_metrics
+
+
+def compute_offline_metrics(
+    cfg: OfflineMetricsCfg,
+    evaluation_cfg: EvaluationCfg,
+    dataset: Dataset,
+    loader_cfg: DataLoaderStageCfg,
+    cache_path: Path,
+) -> dict[str, float]:
+    """Compute every method's metrics over the dataset's test examples. Results are
+    cached per scene, so an interrupted run picks up where it stopped. The returned
+    values are means over scenes of the per-scene means, like the metrics that
+    MetricComputer logs.
+    """
+    if cfg.device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    else:
+        device = torch.device(cfg.device)
+    cache_path.mkdir(exist_ok=True, parents=True)
+    keys = [method.key for method in evaluation_cfg.methods]
+
+    data_loader = DataLoader(
+        SceneImageDataset(dataset, cfg, evaluation_cfg.methods, cache_path),
+        batch_size=None,
+        num_workers=loader_cfg.num_workers,
+        worker_init_fn=worker_init_fn,
+    )
+
+    scenes = set()
+    batch = []
+
+    def flush() -> None:
+        for scene, metrics in zip(batch, compute_batch_metrics(batch, keys, device)):
+            save_scene_metrics(cache_path, scene.scene, metrics)
+        batch.clear()
+
+    for scene_images in tqdm(data_loader, desc="Computing metrics"):
+        # MapStyleWrapper replaces skipped examples with the next valid one, so a
+        # scene can arrive more than once.
+        if scene_images.scene in scenes:
+            continue
+        scenes.add(scene_images.scene)
+        if scene_images.ground_truth is None:
+            continue
+        batch.append(scene_images)
+        if sum(scene.ground_truth.shape[0] for scene in batch) >= cfg.batch_size:
+            flush()
+    if batch:
+        flush()
+
+    all_metrics = [load_scene_metrics(cache_path, scene, keys) for scene in scenes]
+    if not all_metrics:
+        return {}
+    return {
+        name: sum(metrics[name] for metrics in all_metrics) / len(all_metrics)
+        for name in (f"{metric}_{key}" for key in keys for metric in METRICS)
+    }
+
+
+def print_metrics(evaluation_cfg: EvaluationCfg, metrics: dict[str, float]) -> None:
+    table = []
+    for method in evaluation_cfg.methods:
+        row = [f"{metrics[f'{metric}_{method.key}']:.3f}" for metric in METRICS]
+        table.append((method.key, *row))
+    print(tabulate(table, ["Method", "PSNR (dB)", "LPIPS", "SSIM"]))
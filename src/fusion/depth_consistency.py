@@ -0,0 +1,240 @@
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from jaxtyping import Bool, Float, Int64
+from torch import Tensor
+
+from .scan import ScanFrame
+from .sparse_tsdf import pack_keys
+from .tsdf import get_device
+
+
+def get_relative_projection(
+    intrinsics_from: Float[Tensor, "*#batch 3 3"],
+    extrinsics_from: Float[Tensor, "*#batch 4 4"],  # camera to world
+    intrinsics_to: Float[Tensor, "*#batch 3 3"],
+    extrinsics_to: Float[Tensor, "*#batch 4 4"],  # camera to world
+) -> tuple[Float[Tensor, "*batch 3 3"], Float[Tensor, "*batch 3"]]:
+    """Return (A, b) such that a pixel xy with depth d in the first camera projects to
+    d * A @ (x, y, 1) + b in the second camera, before the perspective divide.
+    """
+    relative = extrinsics_to.inverse() @ extrinsics_from
+    rotation = intrinsics_to @ relative[..., :3, :3] @ intrinsics_from.inverse()
+    translation = (intrinsics_to @ relative[..., :3, 3:])[..., 0]
+    return rotation, translation
+
+
+def project(
+    pixels: Float[Tensor, "*#batch pixel 3"],  # homogeneous
+    depth: Float[Tensor, "*#batch pixel"],
+    rotation: Float[Tensor, "*#batch 3 3"],
+    translation: Float[Tensor, "*#batch 3"],
+) -> tuple[Float[Tensor, "*batch pixel 2"], Float[Tensor, "*batch pixel"]]:
+    points = (pixels @ rotation.transpose(-1, -2)) * depth[..., None]
+    points = points + translation[..., None, :]
+    z = points[..., 2]
+    return points[..., :2] / z.clamp(min=1e-8)[..., None], z
+
+
+def sample_depth(
+    depth: Float[Tensor, "batch height width"],
+    xy: Float[Tensor, "batch pixel 2"],  # in pixels
+) -> Float[Tensor, "batch pixel"]:
+    """Bilinearly sample depth maps, with zero depth outside the image."""
+    h, w = depth.shape[-2:]
+    scale = torch.tensor((w - 1, h - 1), dtype=xy.dtype, device=xy.device)
+    grid = (xy / scale * 2 - 1)[:, None]
+    sampled = F.grid_sample(
+        depth[:, None], grid, mode="bilinear", padding_mode="zeros", align_corners=True
+    )
+    return sampled[:, 0, 0]
+
+
+@torch.no_grad()
+def check_geometric_consistency(
+    pixels: Float[Tensor, "pixel 3"],  # homogeneous
+    ref_depth: Float[Tensor, " pixel"],
+    ref_intrinsics: Float[Tensor, "3 3"],
+    ref_extrinsics: Float[Tensor, "4 4"],
+    src_depths: Float[Tensor, "source height width"],
+    src_intrinsics: Float[Tensor, "source 3 3"],
+    src_extrinsics: Float[Tensor, "source 4 4"],
+    pixel_thres: float,
+    depth_thres: float,  # relative to the reference depth
+) -> tuple[
+    Bool[Tensor, "source pixel"],  # consistent
+    Float[Tensor, "source pixel"],  # reprojected depth
+]:
+    """Reproject reference pixels into all source views at once, sample the source
+    depths there and project them back into the reference view. A pixel agrees with a
+    source view if it comes back within pixel_thres pixels with a relative depth error
+    below depth_thres.
+    """
+    to_src = get_relative_projection(
+        ref_intrinsics, ref_extrinsics, src_intrinsics, src_extrinsics
+    )
+    to_ref = get_relative_projection(
+        src_intrinsics, src_extrinsics, ref_intrinsics, ref_extrinsics
+    )
+    xy_src, _ = project(pixels, ref_depth, *to_src)
+    depth_src = sample_depth(src_depths, xy_src)
+
+    xy_src = torch.cat((xy_src, torch.ones_like(xy_src[..., :1])), dim=-1)
+    xy_ref, depth_reprojected = project(xy_src, depth_src, *to_ref)
+
+    pixel_error = (xy_ref - pixels[:, :2]).norm(dim=-1)
+    depth_error = (depth_reprojected - ref_depth).abs() / ref_depth
+    consistent = (pixel_error < pixel_thres) & (depth_error < depth_thres)
+    return consistent & (depth_src > 0), depth_reprojected
+
+
+@torch.no_grad()
+def fuse_reference_view(
+    ref: ScanFrame,
+    sources: list[ScanFrame],
+    pixel_thres: float,
+    depth_thres: float,
+    geo_mask_thres: int,
+    batch_size: int,
+    device: torch.device,
+) -> tuple[Float[Tensor, "point 3"], Float[Tensor, "point 3"]]:
+    """Return the world-space points and colors of the reference pixels that agree
+    with at least geo_mask_thres source views. Each point's depth is the average of
+    the reference depth and the agreeing reprojected depths. The source views are
+    checked batch_size at a time.
+    """
+
+    def to_tensor(x):
+        return torch.as_tensor(np.asarray(x), dtype=torch.float32, device=device)
+
+    # Only pixels with depth are checked.
+    depth = to_tensor(ref.depth)
+    y, x = torch.nonzero(depth > 0, as_tuple=True)
+    pixels = torch.stack((x, y, torch.ones_like(x)), dim=-1).float()
+    ref_depth = depth[y, x]
+    ref_intrinsics = to_tensor(ref.intrinsics)
+    ref_extrinsics = to_tensor(ref.extrinsics)
+
+    num_consistent = torch.zeros_like(ref_depth, dtype=torch.int64)
+    depth_sum = ref_depth.clone()
+    for i in range(0, len(sources), batch_size):
+        batch = sources[i : i + batch_size]
+        consistent, depth_reprojected = check_geometric_consistency(
+            pixels,
+            ref_depth,
+            ref_intrinsics,
+            ref_extrinsics,
+            to_tensor(np.stack([frame.depth for frame in batch])),
+            to_tensor(np.stack([frame.intrinsics for frame in batch])),
+            to_tensor(np.stack([frame.extrinsics for frame in batch])),
+            pixel_thres,
+            depth_thres,
+        )
+        num_consistent += consistent.sum(dim=0)
+        depth_sum += torch.where(consistent, depth_reprojected, 0).sum(dim=0)
+
+    mask = num_consistent >= geo_mask_thres
+    depth = depth_sum[mask] / (num_consistent[mask] + 1)
+    rays = pixels[mask] @ ref_intrinsics.inverse().T
+    points = (rays * depth[:, None]) @ ref_extrinsics[:3, :3].T + ref_extrinsics[:3, 3]
+    return points, to_tensor(ref.color)[y[mask], x[mask]]
+
+
+def voxel_downsample(
+    points: Float[Tensor, "point 3"],
+    colors: Float[Tensor, "point 3"],
+    voxel_size: float,
+) -> tuple[Float[Tensor, "voxel 3"], Float[Tensor, "voxel 3"]]:
+    """Replace the points in each voxel by their mean position and color."""
+    keys = pack_keys(torch.floor(points / voxel_size).long())
+    _, inverse, counts = torch.unique(keys, return_inverse=True, return_counts=True)
+    point_sum = points.new_zeros((len(counts), 3)).index_add_(0, inverse, points)
+    color_sum = colors.new_zeros((len(counts), 3)).index_add_(0, inverse, colors)
+    return point_sum / counts[:, None], color_sum / counts[:, None]
+
+
+def read_pair_file(path: Path) -> dict[int, list[int]]:
+    """Read an MVSNet-style pair.txt: the view count, then for every reference view
+    its index and a line of "count src score src score ...".
+    """
+    lines = Path(path).read_text().split("\n")
+    pairs = {}
+    for i in range(int(lines[0])):
+        ref = int(lines[2 * i + 1])
+        src = lines[2 * i + 2].split()
+        pairs[ref] = [int(view) for view in src[1::2]]
+    return pairs
+
+
+def get_nearest_views(
+    frames: list[ScanFrame],
+    num_views: int,
+) -> Int64[np.ndarray, "frame neighbor"]:
+    """For every frame, the positions of the num_views frames with the closest camera
+    centers.
+    """
+    centers = np.stack([frame.extrinsics[:3, 3] for frame in frames])
+    distances = np.linalg.norm(centers[:, None] - centers[None], axis=-1)
+    np.fill_diagonal(distances, np.inf)
+    return np.argsort(distances, axis=1)[:, :num_views]
+
+
+def get_source_views(
+    frames: list[ScanFrame],
+    num_src_views: int | None,  # None for all other frames
+    pair_path: Path | None = None,
+) -> list[list[int]]:
+    """Pick the source frames (as positions in frames) of every reference frame: all
+    other frames, or the best num_src_views from pair.txt if it exists, or else the
+    num_src_views nearest cameras.
+    """
+    n = len(frames)
+    if num_src_views is None:
+        return [[j for j in range(n) if j != i] for i in range(n)]
+    if pair_path is not None and pair_path.exists():
+        pairs = read_pair_file(pair_path)
+        position = {frame.index: i for i, frame in enumerate(frames)}
+        sources = [pairs.get(frame.index, []) for frame in frames]
+        sources = [[position[v] for v in views if v in position] for views in sources]
+        return [views[:num_src_views] for views in sources]
+    return get_nearest_views(frames, min(num_src_views, n - 1)).tolist()
+
+
+@torch.no_grad()
+def fuse_depth_maps(
+    frames: list[ScanFrame],
+    source_views: list[list[int]],
+    pixel_thres: float = 1.0,
+    depth_thres: float = 0.01,
+    geo_mask_thres: int = 3,
+    voxel_size: float = 0.0,  # no downsampling if 0
+    batch_size: int = 16,  # source views checked at once
+    device: str | None = None,
+) -> np.ndarray:
+    """Fuse the depth maps of a scan into a point cloud (xyz and RGB 0-255) by keeping
+    the geometrically consistent pixels of every view, then optionally merge points
+    per voxel.
+    """
+    device = get_device(device)
+    points, colors = [], []
+    for ref, sources in zip(frames, source_views):
+        p, c = fuse_reference_view(
+            ref,
+            [frames[i] for i in sources],
+            pixel_thres,
+            depth_thres,
+            geo_mask_thres,
+            batch_size,
+            device,
+        )
+        points.append(p)
+        colors.append(c)
+
+    points = torch.cat(points)
+    colors = torch.cat(colors)
+    if voxel_size > 0 and len(points) > 0:
+        points, colors = voxel_downsample(points, colors, voxel_size)
+    colors = colors.round().clamp(0, 255)
+    return torch.cat((points, colors), dim=-1).cpu().numpy()
@@ -0,0 +1,91 @@
+from pathlib import Path
+
+import numpy as np
+
+VERTEX_PROPERTIES = {
+    "f4": "float",
+    "u1": "uchar",
+}
+
+
+def get_header(elements: list[tuple[str, int, list[str]]]) -> bytes:
+    lines = ["ply", "format binary_little_endian 1.0"]
+    for name, count, properties in elements:
+        lines.append(f"element {name} {count}")
+        lines.extend(properties)
+    lines.append("end_header")
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+
+def get_vertices(fields: list[tuple[str, str, np.ndarray]]) -> np.ndarray:
+    """Pack per-vertex columns into a structured array with one record per vertex."""
+    dtype = np.dtype([(name, f"<{kind}") for name, kind, _ in fields])
+    vertices = np.empty(len(fields[0][2]), dtype=dtype)
+    for name, _, values in fields:
+        vertices[name] = values
+    return vertices
+
+
+def get_vertex_properties(vertices: np.ndarray) -> list[str]:
+    return [
+        f"property {VERTEX_PROPERTIES[vertices.dtype[name].str[1:]]} {name}"
+        for name in vertices.dtype.names
+    ]
+
+
+def write_mesh_ply(
+    path: Path | str,
+    verts: np.ndarray,  # [vertex, 3]
+    faces: np.ndarray,  # [face, 3]
+    norms: np.ndarray,  # [vertex, 3]
+    colors: np.ndarray,  # [vertex, 3], RGB 0-255
+) -> None:
+    """Save a triangle mesh with vertex normals and colors as binary PLY."""
+    vertices = get_vertices(
+        [
+            ("x", "f4", verts[:, 0]),
+            ("y", "f4", verts[:, 1]),
+            ("z", "f4", verts[:, 2]),
+            ("nx", "f4", norms[:, 0]),
+            ("ny", "f4", norms[:, 1]),
+            ("nz", "f4", norms[:, 2]),
+            ("red", "u1", colors[:, 0]),
+            ("green", "u1", colors[:, 1]),
+            ("blue", "u1", colors[:, 2]),
+        ]
+    )
+    face_records = np.empty(len(faces), dtype=[("n", "u1"), ("index", "<i4", (3,))])
+    face_records["n"] = 3
+    face_records["index"] = faces
+
+    header = get_header(
+        [
+            ("vertex", len(vertices), get_vertex_properties(vertices)),
+            ("face", len(faces), ["property list uchar int vertex_index"]),
+        ]
+    )
+    with Path(path).open("wb") as f:
+        f.write(header)
+        f.write(vertices.tobytes())
+        f.write(face_records.tobytes())
+
+
+def write_point_cloud_ply(
+    path: Path | str,
+    xyzrgb: np.ndarray,  # [point, 6], RGB 0-255
+) -> None:
+    """Save a colored point cloud as binary PLY."""
+    vertices = get_vertices(
+        [
+            ("x", "f4", xyzrgb[:, 0]),
+            ("y", "f4", xyzrgb[:, 1]),
+            ("z", "f4", xyzrgb[:, 2]),
+            ("red", "u1", xyzrgb[:, 3].astype(np.uint8)),
+            ("green", "u1", xyzrgb[:, 4].astype(np.uint8)),
+            ("blue", "u1", xyzrgb[:, 5].astype(np.uint8)),
+        ]
+    )
+    header = get_header([("vertex", len(vertices), get_vertex_properties(vertices))])
+    with Path(path).open("wb") as f:
+        f.write(header)
+        f.write(vertices.tobytes())
@@ -0,0 +1,117 @@
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from ..misc.depth_io import has_scene_depths, load_scene_depths
+
+
+@dataclass
+class ScanFrame:
+    index: int
+    depth: np.ndarray  # [height, width]
+    color: np.ndarray  # [height, width, 3], RGB 0-255
+    intrinsics: np.ndarray  # [3, 3], in pixels
+    extrinsics: np.ndarray  # [4, 4], camera to world
+
+
+def get_depth_path(scan_dir: Path, index: int) -> Path:
+    return scan_dir / "depth" / f"{index:0>6}.npy"
+
+
+def get_color_path(scan_dir: Path, index: int) -> Path:
+    return scan_dir / "color" / f"{index:0>6}.png"
+
+
+def load_color(scan_dir: Path, index: int) -> np.ndarray:
+    color = np.array(Image.open(get_color_path(scan_dir, index)), dtype=np.float32)
+    return color[..., :3]
+
+
+def get_pixel_intrinsics(intrinsics: np.ndarray, h: int, w: int) -> np.ndarray:
+    """Scale intrinsics that are normalized by the image size to pixels."""
+    intrinsics = np.array(intrinsics, dtype=np.float64)[:3, :3]
+    intrinsics[0, :] *= w
+    intrinsics[1, :] *= h
+    intrinsics[2, :] = (0, 0, 1)
+    return intrinsics
+
+
+def load_frame(scan_dir: Path, index: int) -> ScanFrame:
+    """Load a frame's depth, camera and color from a pickled per-frame depth file. The
+    saved intrinsics are normalized by the image size.
+    """
+    data = np.load(get_depth_path(scan_dir, index), allow_pickle=True).item()
+    color = load_color(scan_dir, index)
+    h, w, _ = color.shape
+    return ScanFrame(
+        index,
+        np.asarray(data["depth"], dtype=np.float32),
+        color,
+        get_pixel_intrinsics(data["intrinsic"], h, w),
+        np.asarray(data["extrinsic"], dtype=np.float64),
+    )
+
+
+def get_scan_views(scan_dir: Path) -> list[int]:
+    """The indices of the views with saved depth."""
+    if has_scene_depths(scan_dir):
+        _, cameras = load_scene_depths(scan_dir)
+        return sorted(cameras["index"])
+    return sorted(int(path.stem) for path in (scan_dir / "depth").glob("*.npy"))
+
+
+def load_scan(scan_dir: Path, views: list[int], skip_missing: bool) -> list[ScanFrame]:
+    """Load every frame of a scan once, from the per-scene depth file written by the
+    test step if there is one, or else from pickled per-frame depth files. With
+    skip_missing, views without saved depth are left out.
+    """
+    if not has_scene_depths(scan_dir):
+        if skip_missing:
+            views = [i for i in views if get_depth_path(scan_dir, i).exists()]
+        return [load_frame(scan_dir, i) for i in views]
+
+    depths, cameras = load_scene_depths(scan_dir)
+    position = {index: i for i, index in enumerate(cameras["index"])}
+    if skip_missing:
+        views = [i for i in views if i in position]
+    frames = []
+    for index in views:
+        i = position[index]
+        color = load_color(scan_dir, index)
+        h, w, _ = color.shape
+        frames.append(
+            ScanFrame(
+                index,
+                np.asarray(depths[i], dtype=np.float32),
+                color,
+                get_pixel_intrinsics(cameras["intrinsics"][i], h, w),
+                np.asarray(cameras["extrinsics"][i], dtype=np.float64),
+            )
+        )
+    return frames
+
+
+def get_view_frustum(frame: ScanFrame) -> np.ndarray:
+    """Get the corners [3, 5] of the camera's view frustum up to the maximum depth."""
+    h, w = frame.depth.shape
+    max_depth = frame.depth.max()
+    x = np.array([0, 0, 0, w, w])
+    y = np.array([0, 0, h, 0, h])
+    z = np.array([0, max_depth, max_depth, max_depth, max_depth])
+    k = frame.intrinsics
+    points = np.stack(
+        [(x - k[0, 2]) * z / k[0, 0], (y - k[1, 2]) * z / k[1, 1], z, np.ones(5)]
+    )
+    return (frame.extrinsics @ points)[:3]
+
+
+def get_volume_bounds(frames: list[ScanFrame]) -> np.ndarray:
+    """The [3, 2] bounds of the union of the frames' view frusta and the origin."""
+    bounds = np.zeros((3, 2))
+    for frame in frames:
+        frustum = get_view_frustum(frame)
+        bounds[:, 0] = np.minimum(bounds[:, 0], frustum.min(axis=1))
+        bounds[:, 1] = np.maximum(bounds[:, 1], frustum.max(axis=1))
+    return bounds
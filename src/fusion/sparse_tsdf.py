@@ -0,0 +1,327 @@
+import numpy as np
+import torch
+from einops import rearrange
+from jaxtyping import Bool, Float, Int64
+from skimage import measure
+from torch import Tensor
+
+from .tsdf import Frames, get_device, integrate_points
+
+# Block coordinates are packed into one int64 key, 21 bits per axis.
+KEY_BITS = 21
+KEY_OFFSET = 1 << (KEY_BITS - 1)
+
+
+def pack_keys(coords: Int64[Tensor, "*batch 3"]) -> Int64[Tensor, " *batch"]:
+    x, y, z = (coords + KEY_OFFSET).unbind(dim=-1)
+    return (x << (2 * KEY_BITS)) | (y << KEY_BITS) | z
+
+
+class BlockTable:
+    """Maps block coordinates to slots in the block storage. The keys are kept sorted,
+    so lookups are a binary search.
+    """
+
+    def __init__(self, device: torch.device) -> None:
+        self.keys = torch.empty((0,), dtype=torch.int64, device=device)
+        self.slots = torch.empty((0,), dtype=torch.int64, device=device)
+        self.coords = torch.empty((0, 3), dtype=torch.int64, device=device)
+
+    def __len__(self) -> int:
+        return len(self.coords)
+
+    def lookup(self, coords: Int64[Tensor, "*batch 3"]) -> Int64[Tensor, " *batch"]:
+        """Return the slots of the given blocks, or -1 for blocks that do not exist."""
+        keys = pack_keys(coords)
+        if len(self.keys) == 0:
+            return torch.full_like(keys, -1)
+        index = torch.searchsorted(self.keys, keys).clamp(max=len(self.keys) - 1)
+        return torch.where(self.keys[index] == keys, self.slots[index], -1)
+
+    def insert(self, coords: Int64[Tensor, "block 3"]) -> int:
+        """Add the blocks that do not exist yet and return how many were added. New
+        blocks get the next free slots.
+        """
+        coords = coords.unique(dim=0)
+        coords = coords[self.lookup(coords) < 0]
+        if len(coords) == 0:
+            return 0
+        slots = torch.arange(len(coords), device=coords.device) + len(self.coords)
+        keys, order = torch.cat((self.keys, pack_keys(coords))).sort()
+        self.keys = keys
+        self.slots = torch.cat((self.slots, slots))[order]
+        self.coords = torch.cat((self.coords, coords))
+        return len(coords)
+
+
+class SparseTSDFVolume:
+    """TSDF fusion on a sparse grid. Voxels are stored in blocks of block_size^3 that
+    are only allocated where back-projected depth falls within the truncation band,
+    so memory scales with the observed surface instead of the bounding box. The
+    update rule is the one of TSDFVolumeTorch. The grid is anchored at the origin,
+    so no volume bounds are needed.
+    """
+
+    def __init__(
+        self,
+        voxel_size: float,
+        margin: int = 5,
+        device: str | None = None,
+        block_size: int = 8,
+        chunk_size: int = 256,  # blocks integrated at once
+    ) -> None:
+        self.device = get_device(device)
+        self._voxel_size = float(voxel_size)
+        self._trunc_margin = margin * self._voxel_size
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+
+        self.table = BlockTable(self.device)
+        b = block_size
+        self.tsdf = torch.ones((0, b, b, b), device=self.device)
+        self.weight = torch.zeros((0, b, b, b), device=self.device)
+        self.color = torch.zeros((0, b, b, b, 3), device=self.device)
+
+        # voxel offsets within a block, in the order of the flattened block storage
+        axis = torch.arange(b, device=self.device)
+        offsets = torch.meshgrid(axis, axis, axis, indexing="ij")
+        offsets = torch.stack(offsets, dim=-1)
+        self.voxel_offsets = rearrange(offsets, "x y z c -> (x y z) c")
+        is_corner = ((self.voxel_offsets == 0) | (self.voxel_offsets == b - 1)).all(1)
+        self.corner_offsets = self.voxel_offsets[is_corner]
+
+    @property
+    def num_blocks(self) -> int:
+        return len(self.table)
+
+    def allocate(self, frames: Frames) -> None:
+        """Allocate the blocks that contain the truncation band around the surface
+        points of the frames' depth maps.
+        """
+        h, w = frames.image_shape
+        v, u = torch.meshgrid(
+            torch.arange(h, device=self.device, dtype=torch.float32),
+            torch.arange(w, device=self.device, dtype=torch.float32),
+            indexing="ij",
+        )
+        cam_to_world = torch.linalg.inv(frames.world_to_cam.double()).float()
+
+        # Sample the band once per voxel along the ray.
+        num_steps = int(np.ceil(2 * self._trunc_margin / self._voxel_size)) + 1
+        steps = torch.linspace(
+            -self._trunc_margin, self._trunc_margin, num_steps, device=self.device
+        )
+        block_extent = self._voxel_size * self.block_size
+        for depth, intrinsics, pose in zip(
+            frames.depth, frames.intrinsics, cam_to_world
+        ):
+            valid = depth > 0
+            d = depth[valid]
+            x = (u.reshape(-1)[valid] - intrinsics[0, 2]) / intrinsics[0, 0]
+            y = (v.reshape(-1)[valid] - intrinsics[1, 2]) / intrinsics[1, 1]
+            directions = torch.stack((x, y, torch.ones_like(x)), dim=-1)
+            directions = directions @ pose[:3, :3].T
+
+            # Points at depth d + t lie on the ray through the pixel (z is the depth).
+            t = (d[:, None] + steps).clamp(min=0)
+            points = pose[:3, 3] + t[..., None] * directions[:, None]
+            coords = torch.floor(points / block_extent).long().reshape(-1, 3)
+            self.table.insert(coords.unique(dim=0))
+
+        # Grow the storage for the new blocks.
+        missing = self.num_blocks - len(self.tsdf)
+        if missing > 0:
+            b = self.block_size
+            shape = (missing, b, b, b)
+            device = self.device
+            self.tsdf = torch.cat((self.tsdf, torch.ones(shape, device=device)))
+            self.weight = torch.cat((self.weight, torch.zeros(shape, device=device)))
+            self.color = torch.cat(
+                (self.color, torch.zeros((*shape, 3), device=device))
+            )
+
+    def get_voxel_points(
+        self,
+        block_coords: Int64[Tensor, "block 3"],
+    ) -> Float[Tensor, "block voxel 3"]:
+        voxels = block_coords[:, None] * self.block_size + self.voxel_offsets
+        return voxels.float() * self._voxel_size
+
+    def get_visible_blocks(
+        self,
+        block_coords: Int64[Tensor, "block 3"],
+        frames: Frames,
+    ) -> Bool[Tensor, " block"]:
+        """Conservatively check which blocks any frame can update, using the projected
+        bounding box of their corner voxels. Blocks entirely beyond a frame's farthest
+        depth plus the truncation margin get no observation from it.
+        """
+        corners = block_coords[:, None] * self.block_size + self.corner_offsets
+        corners = corners.float() * self._voxel_size
+        world_to_cam = frames.world_to_cam
+        cam = torch.einsum("fij,bcj->fbci", world_to_cam[:, :3, :3], corners)
+        cam = cam + world_to_cam[:, None, None, :3, 3]
+        z = cam[..., 2]
+
+        # A block that reaches behind the camera may still be visible.
+        behind = (z <= 0).any(dim=-1)
+        intrinsics = frames.intrinsics[:, None, None]
+        xy = cam[..., :2] / z.clamp(min=1e-8)[..., None]
+        xy = xy * intrinsics[..., [0, 1], [0, 1]] + intrinsics[..., [0, 1], 2]
+        h, w = frames.image_shape
+        xy_min = xy.min(dim=-2).values
+        xy_max = xy.max(dim=-2).values
+        in_image = (xy_max[..., 0] >= -0.5) & (xy_min[..., 0] < w - 0.5)
+        in_image &= (xy_max[..., 1] >= -0.5) & (xy_min[..., 1] < h - 0.5)
+
+        max_depth = frames.depth.max(dim=1).values[:, None]
+        in_range = (max_depth > 0) & (
+            z.min(dim=-1).values <= max_depth + self._trunc_margin
+        )
+        return ((behind | in_image) & in_range).any(dim=0)
+
+    @torch.no_grad()
+    def integrate_batch(
+        self,
+        color_ims: np.ndarray | Tensor | None,  # [frame, height, width, 3], RGB 0-255
+        depth_ims: np.ndarray | Tensor,  # [frame, height, width]
+        cam_intrs: np.ndarray | Tensor,  # [frame, 3, 3]
+        cam_poses: np.ndarray | Tensor,  # [frame, 4, 4], camera to world
+        obs_weight: float = 1.0,
+    ) -> None:
+        """Allocate the blocks the frames observe, then integrate the frames into the
+        allocated blocks they can update, chunk_size blocks at a time.
+        """
+        frames = Frames.create(color_ims, depth_ims, cam_intrs, cam_poses, self.device)
+        self.allocate(frames)
+
+        visible = torch.cat(
+            [
+                self.get_visible_blocks(
+                    self.table.coords[start : start + self.chunk_size], frames
+                )
+                for start in range(0, self.num_blocks, self.chunk_size)
+            ]
+        )
+        b = self.block_size
+        for slots in torch.nonzero(visible)[:, 0].split(self.chunk_size):
+            tsdf = self.tsdf[slots].reshape(-1)
+            weight = self.weight[slots].reshape(-1)
+            color = self.color[slots].reshape(-1, 3)
+            if integrate_points(
+                self.get_voxel_points(self.table.coords[slots]).reshape(-1, 3),
+                tsdf,
+                weight,
+                color,
+                frames,
+                self._trunc_margin,
+                obs_weight,
+            ):
+                self.tsdf[slots] = tsdf.view(-1, b, b, b)
+                self.weight[slots] = weight.view(-1, b, b, b)
+                self.color[slots] = color.view(-1, b, b, b, 3)
+
+    def integrate(
+        self,
+        color_im: np.ndarray | Tensor | None,  # [height, width, 3], RGB 0-255
+        depth_im: np.ndarray | Tensor,  # [height, width]
+        cam_intr: np.ndarray | Tensor,  # [3, 3]
+        cam_pose: np.ndarray | Tensor,  # [4, 4], camera to world
+        obs_weight: float = 1.0,
+    ) -> None:
+        self.integrate_batch(
+            None if color_im is None else np.asarray(color_im)[None],
+            np.asarray(depth_im)[None],
+            np.asarray(cam_intr)[None],
+            np.asarray(cam_pose)[None],
+            obs_weight,
+        )
+
+    def get_padded_blocks(
+        self,
+        slots: Int64[Tensor, " block"],
+    ) -> tuple[
+        Float[Tensor, "block size size size"],  # TSDF
+        Float[Tensor, "block size size size"],  # weight
+        Float[Tensor, "block size size size 3"],  # color
+    ]:
+        """Return the blocks with one extra layer of voxels from the neighboring
+        blocks on the positive side of each axis, so that marching cubes on
+        neighboring blocks produces a closed surface. Missing neighbors count as
+        unobserved.
+        """
+        b = self.block_size
+        coords = self.table.coords[slots]
+        tsdf = torch.ones((len(slots), b + 1, b + 1, b + 1), device=self.device)
+        weight = torch.zeros((len(slots), b + 1, b + 1, b + 1), device=self.device)
+        color = torch.zeros((len(slots), b + 1, b + 1, b + 1, 3), device=self.device)
+        for dx in (0, 1):
+            for dy in (0, 1):
+                for dz in (0, 1):
+                    offset = torch.tensor((dx, dy, dz), device=self.device)
+                    neighbors = self.table.lookup(coords + offset)
+                    present = neighbors >= 0
+                    neighbors = neighbors[present]
+
+                    # The part of the neighbor that lies inside the padded block.
+                    target = tuple(
+                        slice(b, b + 1) if o else slice(0, b) for o in (dx, dy, dz)
+                    )
+                    source = tuple(
+                        slice(0, 1) if o else slice(0, b) for o in (dx, dy, dz)
+                    )
+                    tsdf[(present, *target)] = self.tsdf[(neighbors, *source)]
+                    weight[(present, *target)] = self.weight[(neighbors, *source)]
+                    color[(present, *target)] = self.color[(neighbors, *source)]
+        return tsdf, weight, color
+
+    def get_mesh(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Run marching cubes on every block that contains the surface and merge the
+        vertices that neighboring blocks share.
+        """
+        b = self.block_size
+        verts, faces, norms, colors = [], [], [], []
+        num_verts = 0
+        for start in range(0, self.num_blocks, self.chunk_size):
+            slots = torch.arange(
+                start, min(start + self.chunk_size, self.num_blocks), device=self.device
+            )
+            tsdf, weight, color = self.get_padded_blocks(slots)
+            tsdf = tsdf.masked_fill(weight == 0, 1)
+
+            # Only blocks with a sign change contain the surface.
+            flat = tsdf.reshape(len(slots), -1)
+            has_surface = (flat.min(dim=1).values < 0) & (flat.max(dim=1).values > 0)
+            origins = (self.table.coords[slots] * b).cpu().numpy()
+            tsdf = tsdf.cpu().numpy()
+            color = color.cpu().numpy()
+            for i in torch.nonzero(has_surface)[:, 0].tolist():
+                v, f, n, _ = measure.marching_cubes(tsdf[i], level=0)
+                index = np.round(v).astype(int)
+                colors.append(color[i, index[:, 0], index[:, 1], index[:, 2]])
+                verts.append(v + origins[i])
+                faces.append(f + num_verts)
+                norms.append(n)
+                num_verts += len(v)
+
+        if num_verts == 0:
+            empty = np.zeros((0, 3))
+            return empty, empty.astype(int), empty, empty.astype(np.uint8)
+        verts = np.concatenate(verts)
+        faces = np.concatenate(faces)
+        norms = np.concatenate(norms)
+        colors = np.concatenate(colors)
+
+        # Vertices on shared block faces are computed from the same voxels by both
+        # blocks, so they match exactly.
+        verts, index, inverse = np.unique(
+            verts, axis=0, return_index=True, return_inverse=True
+        )
+        faces = inverse.reshape(-1)[faces]
+        verts = verts * self._voxel_size
+        return verts, faces, norms[index], colors[index].astype(np.uint8)
+
+    def get_point_cloud(self) -> np.ndarray:
+        """Extract a point cloud (xyz and RGB) from the voxel volume."""
+        verts, _, _, colors = self.get_mesh()
+        return np.hstack([verts, colors])
@@ -0,0 +1,263 @@
+from dataclasses import dataclass
+from itertools import product
+
+import numpy as np
+import torch
+from jaxtyping import Float
+from skimage import measure
+from torch import Tensor
+
+
+def get_device(device: str | None) -> torch.device:
+    if device is None:
+        return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return torch.device(device)
+
+
+@dataclass
+class Frames:
+    depth: Float[Tensor, "frame pixel"]
+    color: Float[Tensor, "frame pixel 3"] | None
+    intrinsics: Float[Tensor, "frame 3 3"]
+    world_to_cam: Float[Tensor, "frame 4 4"]
+    image_shape: tuple[int, int]
+
+    @staticmethod
+    def create(
+        color_ims: np.ndarray | Tensor | None,  # [frame, height, width, 3], RGB 0-255
+        depth_ims: np.ndarray | Tensor,  # [frame, height, width]
+        cam_intrs: np.ndarray | Tensor,  # [frame, 3, 3]
+        cam_poses: np.ndarray | Tensor,  # [frame, 4, 4], camera to world
+        device: torch.device,
+    ) -> "Frames":
+        def to_tensor(x):
+            return torch.as_tensor(np.asarray(x), device=device)
+
+        depth = to_tensor(depth_ims).float()
+        f, h, w = depth.shape
+        if color_ims is not None:
+            color_ims = to_tensor(color_ims).float().reshape(f, h * w, 3)
+        return Frames(
+            depth.reshape(f, h * w),
+            color_ims,
+            to_tensor(cam_intrs).float(),
+            torch.linalg.inv(to_tensor(cam_poses).double()).float(),
+            (h, w),
+        )
+
+
+@torch.no_grad()
+def integrate_points(
+    points: Float[Tensor, "voxel 3"],
+    tsdf: Float[Tensor, " voxel"],
+    weight: Float[Tensor, " voxel"],
+    color: Float[Tensor, "voxel 3"],
+    frames: Frames,
+    trunc_margin: float,
+    obs_weight: float,
+) -> bool:
+    """Update the TSDF, weights and colors of the voxels at the given world positions
+    in place with the observations of all frames. Return whether any voxel changed.
+    """
+    f, _ = frames.depth.shape
+    h, w = frames.image_shape
+    world_to_cam = frames.world_to_cam
+    intrinsics = frames.intrinsics
+
+    # Project the voxels into every frame.
+    cam = torch.einsum("fij,vj->fvi", world_to_cam[:, :3, :3], points)
+    cam = cam + world_to_cam[:, None, :3, 3]
+    z = cam[..., 2]
+    fx, fy = intrinsics[:, 0, 0, None], intrinsics[:, 1, 1, None]
+    cx, cy = intrinsics[:, 0, 2, None], intrinsics[:, 1, 2, None]
+    pix_x = torch.round(cam[..., 0] * fx / z + cx)
+    pix_y = torch.round(cam[..., 1] * fy / z + cy)
+    in_view = (pix_x >= 0) & (pix_x < w) & (pix_y >= 0) & (pix_y < h) & (z > 0)
+    pixel = (pix_y.clamp(0, h - 1) * w + pix_x.clamp(0, w - 1)).long()
+    pixel = pixel + torch.arange(f, device=pixel.device)[:, None] * (h * w)
+    depth = torch.where(in_view, frames.depth.reshape(-1)[pixel], 0)
+
+    # Combine the frames' observations of every voxel.
+    depth_diff = depth - z
+    valid = (depth > 0) & (depth_diff >= -trunc_margin)
+    if not valid.any():
+        return False
+    obs = valid.float() * obs_weight
+    dist = (depth_diff / trunc_margin).clamp(max=1)
+    obs_sum = obs.sum(dim=0)
+    dist_sum = (obs * torch.where(valid, dist, 0)).sum(dim=0)
+
+    updated = obs_sum > 0
+    w_old = weight[updated]
+    w_new = w_old + obs_sum[updated]
+    tsdf[updated] = (w_old * tsdf[updated] + dist_sum[updated]) / w_new
+    weight[updated] = w_new
+
+    if frames.color is not None:
+        colors = frames.color.reshape(-1, 3)[pixel]
+        color_sum = (obs[..., None] * colors).sum(dim=0)
+        color_new = w_old[:, None] * color[updated] + color_sum[updated]
+        color[updated] = (color_new / w_new[:, None]).round().clamp(max=255)
+    return True
+
+
+class TSDFVolumeTorch:
+    """Volumetric TSDF fusion of RGB-D frames on a dense voxel grid, with the update
+    rule of TSDFVolume in tsdf_fusion.py. The grid is processed in cubic blocks of
+    block_size voxels per side, so the memory used for voxel coordinates is bounded
+    by the block size instead of the volume. Several frames are integrated at once.
+    Colors are stored as RGB in 0-255.
+    """
+
+    def __init__(
+        self,
+        vol_bnds: np.ndarray,  # [3, 2], xyz min/max
+        voxel_size: float,
+        margin: int = 5,
+        device: str | None = None,
+        block_size: int = 32,
+    ) -> None:
+        vol_bnds = np.array(vol_bnds, dtype=np.float64)
+        assert vol_bnds.shape == (3, 2), "[!] `vol_bnds` should be of shape (3, 2)."
+        self.device = get_device(device)
+        self.block_size = block_size
+
+        self._voxel_size = float(voxel_size)
+        self._trunc_margin = margin * self._voxel_size
+
+        # Adjust volume bounds as TSDFVolume does.
+        self._vol_dim = np.round((vol_bnds[:, 1] - vol_bnds[:, 0]) / self._voxel_size)
+        self._vol_dim = self._vol_dim.astype(int)
+        vol_bnds[:, 1] = vol_bnds[:, 0] + self._vol_dim * self._voxel_size
+        self._vol_bnds = vol_bnds
+        self._vol_origin = vol_bnds[:, 0].astype(np.float32)
+
+        shape = tuple(self._vol_dim.tolist())
+        self.tsdf = torch.ones(shape, dtype=torch.float32, device=self.device)
+        self.weight = torch.zeros(shape, dtype=torch.float32, device=self.device)
+        self.color = torch.zeros((*shape, 3), dtype=torch.float32, device=self.device)
+
+    def get_blocks(self) -> list[tuple[slice, slice, slice]]:
+        starts = [range(0, dim, self.block_size) for dim in self._vol_dim]
+        return [
+            tuple(
+                slice(s, min(s + self.block_size, dim))
+                for s, dim in zip(start, self._vol_dim)
+            )
+            for start in product(*starts)
+        ]
+
+    def get_block_points(
+        self,
+        block: tuple[slice, slice, slice],
+    ) -> Float[Tensor, "x y z 3"]:
+        axes = [
+            torch.arange(s.start, s.stop, device=self.device, dtype=torch.float32)
+            for s in block
+        ]
+        coords = torch.stack(torch.meshgrid(*axes, indexing="ij"), dim=-1)
+        origin = torch.tensor(self._vol_origin, device=self.device)
+        return origin + self._voxel_size * coords
+
+    def is_block_visible(
+        self,
+        block: tuple[slice, slice, slice],
+        world_to_cam: Float[Tensor, "frame 4 4"],
+        intrinsics: Float[Tensor, "frame 3 3"],
+        image_shape: tuple[int, int],
+    ) -> bool:
+        """Conservatively check whether any frame sees the block, using the projected
+        bounding box of its corners.
+        """
+        corners = [(s.start, s.stop - 1) for s in block]
+        corners = torch.tensor(list(product(*corners)), dtype=torch.float32)
+        corners = torch.tensor(self._vol_origin) + self._voxel_size * corners
+        corners = corners.to(self.device)
+        cam = torch.einsum("fij,cj->fci", world_to_cam[:, :3, :3], corners)
+        cam = cam + world_to_cam[:, None, :3, 3]
+        z = cam[..., 2]
+
+        # A block that reaches behind the camera may still be visible.
+        behind = (z <= 0).any(dim=1)
+        xy = cam[..., :2] / z.clamp(min=1e-8)[..., None]
+        xy = xy * intrinsics[:, None, [0, 1], [0, 1]] + intrinsics[:, None, [0, 1], 2]
+        h, w = image_shape
+        xy_min = xy.min(dim=1).values
+        xy_max = xy.max(dim=1).values
+        in_image = (xy_max[:, 0] >= -0.5) & (xy_min[:, 0] < w - 0.5)
+        in_image &= (xy_max[:, 1] >= -0.5) & (xy_min[:, 1] < h - 0.5)
+        return bool((behind | in_image).any())
+
+    @torch.no_grad()
+    def integrate_batch(
+        self,
+        color_ims: np.ndarray | Tensor | None,  # [frame, height, width, 3], RGB 0-255
+        depth_ims: np.ndarray | Tensor,  # [frame, height, width]
+        cam_intrs: np.ndarray | Tensor,  # [frame, 3, 3]
+        cam_poses: np.ndarray | Tensor,  # [frame, 4, 4], camera to world
+        obs_weight: float = 1.0,
+    ) -> None:
+        """Integrate several frames at once. The result equals integrating them one
+        after another, except that colors are rounded once instead of after every
+        frame.
+        """
+        frames = Frames.create(color_ims, depth_ims, cam_intrs, cam_poses, self.device)
+        for block in self.get_blocks():
+            if not self.is_block_visible(
+                block, frames.world_to_cam, frames.intrinsics, frames.image_shape
+            ):
+                continue
+
+            shape = self.tsdf[block].shape
+            tsdf = self.tsdf[block].reshape(-1)
+            weight = self.weight[block].reshape(-1)
+            color = self.color[block].reshape(-1, 3)
+            if integrate_points(
+                self.get_block_points(block).reshape(-1, 3),
+                tsdf,
+                weight,
+                color,
+                frames,
+                self._trunc_margin,
+                obs_weight,
+            ):
+                self.tsdf[block] = tsdf.view(shape)
+                self.weight[block] = weight.view(shape)
+                self.color[block] = color.view(*shape, 3)
+
+    def integrate(
+        self,
+        color_im: np.ndarray | Tensor | None,  # [height, width, 3], RGB 0-255
+        depth_im: np.ndarray | Tensor,  # [height, width]
+        cam_intr: np.ndarray | Tensor,  # [3, 3]
+        cam_pose: np.ndarray | Tensor,  # [4, 4], camera to world
+        obs_weight: float = 1.0,
+    ) -> None:
+        self.integrate_batch(
+            None if color_im is None else np.asarray(color_im)[None],
+            np.asarray(depth_im)[None],
+            np.asarray(cam_intr)[None],
+            np.asarray(cam_pose)[None],
+            obs_weight,
+        )
+
+    def get_volume(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return (
+            self.tsdf.cpu().numpy(),
+            self.color.cpu().numpy(),
+            self.weight.cpu().numpy(),
+        )
+
+    def get_mesh(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Compute a mesh from the voxel volume using marching cubes."""
+        tsdf_vol, color_vol, _ = self.get_volume()
+        verts, faces, norms, _ = measure.marching_cubes(tsdf_vol, level=0)
+        verts_ind = np.round(verts).astype(int)
+        verts = verts * self._voxel_size + self._vol_origin
+        colors = color_vol[verts_ind[:, 0], verts_ind[:, 1], verts_ind[:, 2]]
+        return verts, faces, norms, colors.astype(np.uint8)
+
+    def get_point_cloud(self) -> np.ndarray:
+        """Extract a point cloud (xyz and RGB) from the voxel volume."""
+        verts, _, _, colors = self.get_mesh()
+        return np.hstack([verts, colors])
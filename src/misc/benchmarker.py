@@ -1,40 +1,204 @@
 import json
 from collections import defaultdict
 from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
-from time import time
+from time import perf_counter_ns
+from typing import Literal, Optional
 
 import numpy as np
 import torch
 
+# wall: host clock only, so asynchronous CUDA work may be attributed to a later scope.
+# synchronized: synchronize the device when entering and leaving a scope.
+# cuda_event: time on the device with CUDA events, without synchronizing.
+TimingMode = Literal["wall", "synchronized", "cuda_event"]
+
+
+@dataclass
+class Scope:
+    tag: str
+    num_calls: int
+    start_ns: int
+    base_memory: int = 0
+    peak_memory: int = 0
+    start_event: Optional[torch.cuda.Event] = None
+    end_event: Optional[torch.cuda.Event] = None
+    children_peak_memory: int = 0
+
+
+# The benchmarker that is currently timing a scope, which benchmark_scope reports to.
+_active: Optional["Benchmarker"] = None
+
 
 class Benchmarker:
-    def __init__(self):
-        self.execution_times = defaultdict(list)
+    def __init__(self, timing: TimingMode = "wall"):
+        self.timing = timing
+        self.use_cuda = torch.cuda.is_available()
+        self.scopes: list[Scope] = []
+        self.pending: list[Scope] = []  # scopes waiting for their CUDA events
+        self.clear_history()
 
     @contextmanager
     def time(self, tag: str, num_calls: int = 1):
+        """Time a scope. Scopes nest: a scope opened inside another one is recorded as
+        "outer/inner". Peak memory is recorded relative to the allocated memory when
+        the scope is entered.
+        """
+        global _active
+        previous_active, _active = _active, self
+        if self.scopes:
+            tag = f"{self.scopes[-1].tag}/{tag}"
+        scope = self.enter(tag, num_calls)
         try:
-            start_time = time()
             yield
         finally:
-            end_time = time()
-            for _ in range(num_calls):
-                self.execution_times[tag].append((end_time - start_time) / num_calls)
+            self.exit(scope)
+            _active = previous_active
+
+    def enter(self, tag: str, num_calls: int) -> Scope:
+        if self.use_cuda:
+            if self.timing == "synchronized":
+                torch.cuda.synchronize()
+
+            # The peak counter is reset for every scope, so the enclosing scope keeps
+            # track of the peak reached before.
+            if self.scopes:
+                parent = self.scopes[-1]
+                parent.children_peak_memory = max(
+                    parent.children_peak_memory, torch.cuda.max_memory_allocated()
+                )
+            self.max_memory = max(self.max_memory, torch.cuda.max_memory_allocated())
+            torch.cuda.reset_peak_memory_stats()
+
+        scope = Scope(tag, num_calls, perf_counter_ns())
+        if self.use_cuda:
+            scope.base_memory = torch.cuda.memory_allocated()
+            if self.timing == "cuda_event":
+                scope.start_event = torch.cuda.Event(enable_timing=True)
+                scope.end_event = torch.cuda.Event(enable_timing=True)
+                scope.start_event.record()
+        self.scopes.append(scope)
+        return scope
+
+    def exit(self, scope: Scope) -> None:
+        assert self.scopes.pop() is scope
+        if self.use_cuda:
+            if self.timing == "synchronized":
+                torch.cuda.synchronize()
+            elif self.timing == "cuda_event":
+                scope.end_event.record()
+
+            peak = max(scope.children_peak_memory, torch.cuda.max_memory_allocated())
+            scope.peak_memory = peak - scope.base_memory
+            self.max_memory = max(self.max_memory, peak)
+            if self.scopes:
+                parent = self.scopes[-1]
+                parent.children_peak_memory = max(parent.children_peak_memory, peak)
+
+        end_ns = perf_counter_ns()
+        if scope.end_event is not None:
+            self.pending.append(scope)
+        else:
+            self.record(scope, (end_ns - scope.start_ns) / 1e9)
+
+    def record(self, scope: Scope, duration: float) -> None:
+        for _ in range(scope.num_calls):
+            self._execution_times[scope.tag].append(duration / scope.num_calls)
+        event = {
+            "name": scope.tag.split("/")[-1],
+            "cat": scope.tag,
+            "ph": "X",
+            "ts": (scope.start_ns - self.origin_ns) / 1e3,
+            "dur": duration * 1e6,
+            "pid": 0,
+            "tid": 0,
+        }
+        if self.use_cuda:
+            self.peak_memories[scope.tag].append(scope.peak_memory)
+            event["args"] = {"peak_memory_mb": scope.peak_memory / 2**20}
+        self.trace_events.append(event)
+
+    def flush(self) -> None:
+        """Read the CUDA events of finished scopes. This waits for the device."""
+        for scope in self.pending:
+            scope.end_event.synchronize()
+            self.record(scope, scope.start_event.elapsed_time(scope.end_event) / 1e3)
+        self.pending = []
+
+    @property
+    def execution_times(self) -> dict[str, list[float]]:
+        self.flush()
+        return self._execution_times
+
+    def get_summary(self) -> dict[str, dict[str, float]]:
+        summary = {}
+        for tag, times in self.execution_times.items():
+            summary[tag] = {
+                "calls": len(times),
+                "mean": float(np.mean(times)),
+                "p50": float(np.percentile(times, 50)),
+                "p90": float(np.percentile(times, 90)),
+                "p99": float(np.percentile(times, 99)),
+            }
+            if tag in self.peak_memories:
+                summary[tag]["peak_memory"] = int(np.max(self.peak_memories[tag]))
+        return summary
 
     def dump(self, path: Path) -> None:
         path.parent.mkdir(exist_ok=True, parents=True)
         with path.open("w") as f:
             json.dump(dict(self.execution_times), f)
 
+    def dump_summary(self, path: Path) -> None:
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with path.open("w") as f:
+            json.dump(self.get_summary(), f, indent=2)
+
+    def dump_trace(self, path: Path) -> None:
+        """Write the scopes in the Chrome trace format (chrome://tracing, Perfetto)."""
+        self.flush()
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with path.open("w") as f:
+            json.dump({"traceEvents": self.trace_events}, f)
+
     def dump_memory(self, path: Path) -> None:
         path.parent.mkdir(exist_ok=True, parents=True)
         with path.open("w") as f:
-            json.dump(torch.cuda.memory_stats()["allocated_bytes.all.peak"], f)
+            json.dump(self.get_peak_memory(), f)
+
+    def get_peak_memory(self) -> int:
+        """The peak allocated CUDA memory since the history was cleared."""
+        if not self.use_cuda:
+            return self.max_memory
+        return max(self.max_memory, torch.cuda.max_memory_allocated())
 
     def summarize(self) -> None:
-        for tag, times in self.execution_times.items():
-            print(f"{tag}: {len(times)} calls, avg. {np.mean(times)} seconds per call")
+        for tag, summary in self.get_summary().items():
+            memory = summary.get("peak_memory")
+            memory = "" if memory is None else f", peak {memory / 2**20:.1f} MiB"
+            print(
+                f"{tag}: {summary['calls']} calls, avg. {summary['mean']} seconds per "
+                f"call (p50 {summary['p50']:.4f}, p90 {summary['p90']:.4f}, p99 "
+                f"{summary['p99']:.4f}){memory}"
+            )
 
     def clear_history(self) -> None:
-        self.execution_times = defaultdict(list)
+        self.flush()
+        self._execution_times = defaultdict(list)
+        self.peak_memories = defaultdict(list)
+        self.trace_events = []
+        self.max_memory = 0
+        self.origin_ns = perf_counter_ns()
+
+
+@contextmanager
+def benchmark_scope(tag: str, num_calls: int = 1):
+    """Time a nested stage with the benchmarker that is timing the enclosing scope.
+    Without one, this does nothing.
+    """
+    if _active is None:
+        yield
+    else:
+        with _active.time(tag, num_calls):
+            yield
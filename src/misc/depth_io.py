@@ -0,0 +1,93 @@
+import json
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from jaxtyping import Float, Int
+from torch import Tensor
+
+# Every scene directory holds one float16 array with the depths of all its saved
+# views, which np.load can memory-map, and a JSON file with the matching cameras.
+DEPTH_FILE = "depths.npy"
+CAMERA_FILE = "cameras.json"
+
+
+def has_scene_depths(scene_path: Path) -> bool:
+    return (scene_path / DEPTH_FILE).exists() and (scene_path / CAMERA_FILE).exists()
+
+
+def save_scene_depths(
+    scene_path: Path,
+    indices: Int[np.ndarray, " view"],
+    depths: Float[np.ndarray, "view height width"],
+    intrinsics: Float[np.ndarray, "view 3 3"],  # normalized by the image size
+    extrinsics: Float[np.ndarray, "view 4 4"],  # camera to world
+) -> None:
+    # Write to temporary files first so an interrupted run never leaves a truncated
+    # result behind. The depths are replaced last, since they mark the scene as saved.
+    scene_path.mkdir(parents=True, exist_ok=True)
+    cameras = {
+        "index": np.asarray(indices).tolist(),
+        "intrinsics": np.asarray(intrinsics).tolist(),
+        "extrinsics": np.asarray(extrinsics).tolist(),
+    }
+    camera_path = scene_path / CAMERA_FILE
+    tmp_camera_path = camera_path.with_suffix(".tmp")
+    with tmp_camera_path.open("w") as f:
+        json.dump(cameras, f)
+
+    depth_path = scene_path / DEPTH_FILE
+    tmp_depth_path = depth_path.with_suffix(".tmp")
+    with tmp_depth_path.open("wb") as f:
+        np.save(f, np.asarray(depths, dtype=np.float16))
+    tmp_camera_path.replace(camera_path)
+    tmp_depth_path.replace(depth_path)
+
+
+def load_scene_depths(
+    scene_path: Path,
+) -> tuple[
+    Float[np.ndarray, "view height width"],  # float16, memory-mapped
+    dict[str, list],  # index, intrinsics, extrinsics
+]:
+    depths = np.load(scene_path / DEPTH_FILE, mmap_mode="r", allow_pickle=False)
+    with (scene_path / CAMERA_FILE).open("r") as f:
+        cameras = json.load(f)
+    return depths, cameras
+
+
+class AsyncDepthWriter:
+    """Saves scene depths on a background thread, so that the next test step does not
+    wait for the disk. Only the device-to-host copy happens on the calling thread.
+    """
+
+    def __init__(self) -> None:
+        self.executor = ThreadPoolExecutor(1)
+        self.pending: list[Future] = []
+
+    def save(
+        self,
+        scene_path: Path,
+        indices: Int[Tensor, " view"],
+        depths: Float[Tensor, "view height width"],
+        intrinsics: Float[Tensor, "view 3 3"],
+        extrinsics: Float[Tensor, "view 4 4"],
+    ) -> None:
+        # Raise errors of finished writes early instead of only at the end.
+        done = [future for future in self.pending if future.done()]
+        self.pending = [future for future in self.pending if future not in done]
+        for future in done:
+            future.result()
+
+        arrays = [
+            x.detach().cpu().numpy()
+            for x in (indices, depths.half(), intrinsics, extrinsics)
+        ]
+        future = self.executor.submit(save_scene_depths, scene_path, *arrays)
+        self.pending.append(future)
+
+    def flush(self) -> None:
+        """Wait for all pending writes and raise the first error."""
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
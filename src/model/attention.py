@@ -0,0 +1,60 @@
+from typing import Literal
+
+import torch
+import torch.nn.functional as F
+from jaxtyping import Float
+from torch import Tensor, nn
+
+# "sdpa" dispatches to torch.nn.functional.scaled_dot_product_attention, which picks
+# a flash, memory-efficient or math kernel for the device and inputs. "math" is the
+# explicit softmax(q @ k^T) @ v reference that materializes the attention matrix.
+AttentionBackend = Literal["sdpa", "math"]
+
+
+def set_attention_backend(module: nn.Module, backend: AttentionBackend) -> None:
+    """Select the backend of every attention layer in a module tree. The backend is
+    stored on each layer, so separately built models keep their own settings.
+    """
+    assert backend in ("sdpa", "math")
+    for submodule in module.modules():
+        if hasattr(submodule, "attention_backend"):
+            submodule.attention_backend = backend
+
+
+def attention_math(
+    q: Float[Tensor, "*batch query dim"],
+    k: Float[Tensor, "*batch key dim"],
+    v: Float[Tensor, "*batch key dim_v"],
+    attn_mask: Tensor | None = None,  # broadcastable to [*batch, query, key]
+    scale: float | None = None,
+) -> Float[Tensor, "*batch query dim_v"]:
+    if scale is None:
+        scale = q.shape[-1] ** -0.5
+    scores = torch.matmul(q, k.transpose(-1, -2)) * scale
+    if attn_mask is not None:
+        if attn_mask.dtype == torch.bool:
+            scores = scores.masked_fill(~attn_mask, -torch.inf)
+        else:
+            scores = scores + attn_mask
+    # The softmax runs in float32 for stability with half-precision inputs.
+    attn = torch.softmax(scores.float(), dim=-1).type(scores.dtype)
+    return torch.matmul(attn, v)
+
+
+def scaled_dot_product_attention(
+    q: Float[Tensor, "*batch query dim"],
+    k: Float[Tensor, "*batch key dim"],
+    v: Float[Tensor, "*batch key dim_v"],
+    attn_mask: Tensor | None = None,  # broadcastable to [*batch, query, key]
+    scale: float | None = None,
+    backend: AttentionBackend = "sdpa",
+) -> Float[Tensor, "*batch query dim_v"]:
+    """Attention over the last two dimensions. A float mask is added to the scores,
+    a boolean mask marks the keys each query may attend to. The scale defaults to
+    1 / sqrt(dim).
+    """
+    if backend == "math":
+        return attention_math(q, k, v, attn_mask, scale)
+    if attn_mask is not None and attn_mask.dtype != torch.bool:
+        attn_mask = attn_mask.to(q.dtype)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, scale=scale)
@@ -0,0 +1,138 @@
+from dataclasses import dataclass
+
+import torch
+from einops import einsum
+from jaxtyping import Bool, Float
+from torch import Tensor
+
+from ..geometry.projection import homogenize_points
+from .types import Gaussians
+
+# The rasterizers cull Gaussians closer than this (scaled by the near plane), so there
+# is no point in keeping them around.
+NEAR_PLANE = 0.2
+
+
+@dataclass
+class CompactionCfg:
+    # Gaussians with opacity at or below this are dropped.
+    opacity_threshold: float = 0.0
+    # Drop Gaussians whose centers fall outside every target frustum. The margin is in
+    # normalized image coordinates and keeps Gaussians whose footprint reaches inside.
+    cull_frustum: bool = False
+    frustum_margin: float = 0.1
+    # Merge Gaussians whose centers share a voxel (e.g. the same surface predicted from
+    # several context views). None disables merging.
+    voxel_size: float | None = None
+
+
+def get_frustum_mask(
+    means: Float[Tensor, "batch gaussian 3"],
+    extrinsics: Float[Tensor, "batch view 4 4"],
+    intrinsics: Float[Tensor, "batch view 3 3"],
+    near: Float[Tensor, "batch view"],
+    margin: float,
+) -> Bool[Tensor, "batch gaussian"]:
+    """Whether each Gaussian center lies inside the union of the target frusta."""
+    xyz = einsum(
+        extrinsics.inverse(),
+        homogenize_points(means),
+        "b v i j, b g j -> b v g i",
+    )[..., :3]
+    z = xyz[..., 2]
+    in_front = z > NEAR_PLANE * near[..., None]
+    xy = einsum(intrinsics, xyz / z[..., None].clip(min=1e-8), "b v i j, b v g j -> b v g i")
+    in_image = ((xy[..., :2] >= -margin) & (xy[..., :2] <= 1 + margin)).all(dim=-1)
+    return (in_front & in_image).any(dim=1)
+
+
+def merge_voxels(
+    means: Float[Tensor, "gaussian 3"],
+    covariances: Float[Tensor, "gaussian 3 3"],
+    harmonics: Float[Tensor, "gaussian 3 d_sh"],
+    opacities: Float[Tensor, " gaussian"],
+    voxel_size: float,
+) -> tuple[
+    Float[Tensor, "voxel 3"],
+    Float[Tensor, "voxel 3 3"],
+    Float[Tensor, "voxel 3 d_sh"],
+    Float[Tensor, " voxel"],
+]:
+    """Merge all Gaussians whose centers fall into the same voxel. Attributes are
+    averaged with opacity weights and the merged opacity composites the inputs, i.e.
+    1 - prod(1 - opacity).
+    """
+    voxels = torch.floor(means / voxel_size).long()
+    _, index, counts = torch.unique(
+        voxels, dim=0, return_inverse=True, return_counts=True
+    )
+    num_voxels = counts.shape[0]
+
+    def scatter_sum(values: Tensor) -> Tensor:
+        out = values.new_zeros((num_voxels, *values.shape[1:]))
+        return out.index_add_(0, index, values)
+
+    weights = opacities.clip(min=1e-6)
+    total = scatter_sum(weights)
+
+    def scatter_mean(values: Tensor) -> Tensor:
+        shape = (-1,) + (1,) * (values.ndim - 1)
+        return scatter_sum(values * weights.view(shape)) / total.view(shape)
+
+    transmittance = scatter_sum(torch.log1p(-opacities.clip(max=1 - 1e-6)))
+    return (
+        scatter_mean(means),
+        scatter_mean(covariances),
+        scatter_mean(harmonics),
+        1 - transmittance.exp(),
+    )
+
+
+def compact_gaussians(
+    gaussians: Gaussians,
+    cfg: CompactionCfg,
+    extrinsics: Float[Tensor, "batch view 4 4"] | None = None,
+    intrinsics: Float[Tensor, "batch view 3 3"] | None = None,
+    near: Float[Tensor, "batch view"] | None = None,
+) -> Gaussians:
+    """Drop and merge Gaussians that cannot contribute to the target views. Batch
+    elements keep different numbers of Gaussians, so each one is packed to the front
+    and padded with zero-opacity Gaussians up to the largest count in the batch.
+    """
+    keep = gaussians.opacities > cfg.opacity_threshold
+    if cfg.cull_frustum:
+        assert extrinsics is not None and intrinsics is not None and near is not None
+        keep &= get_frustum_mask(
+            gaussians.means, extrinsics, intrinsics, near, cfg.frustum_margin
+        )
+
+    compacted = []
+    for i in range(keep.shape[0]):
+        attributes = (
+            gaussians.means[i][keep[i]],
+            gaussians.covariances[i][keep[i]],
+            gaussians.harmonics[i][keep[i]],
+            gaussians.opacities[i][keep[i]],
+        )
+        if cfg.voxel_size is not None and keep[i].any():
+            attributes = merge_voxels(*attributes, cfg.voxel_size)
+        compacted.append(attributes)
+
+    # Padding Gaussians have zero opacity and a zero covariance, so every rasterizer
+    # skips them.
+    num_gaussians = max(means.shape[0] for means, *_ in compacted)
+    packed = []
+    for template, values in zip(
+        (
+            gaussians.means,
+            gaussians.covariances,
+            gaussians.harmonics,
+            gaussians.opacities,
+        ),
+        zip(*compacted),
+    ):
+        out = template.new_zeros((len(compacted), num_gaussians, *template.shape[2:]))
+        for i, value in enumerate(values):
+            out[i, : value.shape[0]] = value
+        packed.append(out)
+    return Gaussians(*packed)
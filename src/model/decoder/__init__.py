@@ -1,12 +1,14 @@
 from ...dataset import DatasetCfg
 from .decoder import Decoder
 from .decoder_splatting_cuda import DecoderSplattingCUDA, DecoderSplattingCUDACfg
+from .decoder_splatting_torch import DecoderSplattingTorch, DecoderSplattingTorchCfg
 
 DECODERS = {
     "splatting_cuda": DecoderSplattingCUDA,
+    "splatting_torch": DecoderSplattingTorch,
 }
 
-DecoderCfg = DecoderSplattingCUDACfg
+DecoderCfg = DecoderSplattingCUDACfg | DecoderSplattingTorchCfg
 
 
 def get_decoder(decoder_cfg: DecoderCfg, dataset_cfg: DatasetCfg) -> Decoder:
@@ -2,10 +2,6 @@ from math import isqrt
 from typing import Literal
 
 import torch
-from diff_gaussian_rasterization import (
-    GaussianRasterizationSettings,
-    GaussianRasterizer,
-)
 from einops import einsum, rearrange, repeat
 from jaxtyping import Float
 from torch import Tensor
@@ -13,6 +9,16 @@ from torch import Tensor
 from ...geometry.projection import get_fov, homogenize_points
 from ..encoder.costvolume.conversions import depth_to_relative_disparity
 
+try:
+    from diff_gaussian_rasterization import (
+        GaussianRasterizationSettings,
+        GaussianRasterizer,
+    )
+except ImportError:
+    # Only the render_cuda* functions need the rasterizer. Machines without it can use
+    # the PyTorch backend in torch_splatting.py.
+    GaussianRasterizationSettings = GaussianRasterizer = None
+
 
 def get_projection_matrix(
     near: Float[Tensor, " batch"],
@@ -86,6 +92,13 @@ def render_cuda(
     view_matrix = rearrange(extrinsics.inverse(), "b i j -> b j i")
     full_projection = view_matrix @ projection_matrix
 
+    # Transfer the FOVs to the host once instead of syncing for every camera.
+    tan_fov_x = tan_fov_x.tolist()
+    tan_fov_y = tan_fov_y.tolist()
+
+    row, col = torch.triu_indices(3, 3)
+    covariances = gaussian_covariances[:, :, row, col]
+
     all_images = []
     all_radii = []
     for i in range(b):
@@ -99,8 +112,8 @@ def render_cuda(
         settings = GaussianRasterizationSettings(
             image_height=h,
             image_width=w,
-            tanfovx=tan_fov_x[i].item(),
-            tanfovy=tan_fov_y[i].item(),
+            tanfovx=tan_fov_x[i],
+            tanfovy=tan_fov_y[i],
             bg=background_color[i],
             scale_modifier=1.0,
             viewmatrix=view_matrix[i],
@@ -112,21 +125,54 @@ def render_cuda(
         )
         rasterizer = GaussianRasterizer(settings)
 
-        row, col = torch.triu_indices(3, 3)
-
         image, radii = rasterizer(
             means3D=gaussian_means[i],
             means2D=mean_gradients,
             shs=shs[i] if use_sh else None,
             colors_precomp=None if use_sh else shs[i, :, 0, :],
             opacities=gaussian_opacities[i, ..., None],
-            cov3D_precomp=gaussian_covariances[i, :, row, col],
+            cov3D_precomp=covariances[i],
         )
         all_images.append(image)
         all_radii.append(radii)
     return torch.stack(all_images)
 
 
+def get_orthographic_camera(
+    extrinsics: Float[Tensor, "batch 4 4"],
+    width: Float[Tensor, " batch"],
+    height: Float[Tensor, " batch"],
+    near: Float[Tensor, " batch"],
+    far: Float[Tensor, " batch"],
+    fov_degrees: float,
+) -> tuple[
+    Float[Tensor, "batch 4 4"],  # extrinsics
+    Float[Tensor, ""],  # fov_x
+    Float[Tensor, " batch"],  # fov_y
+    Float[Tensor, ""],  # tan_fov_x (passed to the rasterizer)
+    Float[Tensor, " batch"],  # tan_fov_y (passed to the rasterizer)
+    Float[Tensor, " batch"],  # near
+    Float[Tensor, " batch"],  # far
+]:
+    # Create fake "orthographic" projection by moving the camera back and picking a
+    # small field of view.
+    fov_x = torch.tensor(fov_degrees, device=extrinsics.device).deg2rad()
+    tan_fov_x = (0.5 * fov_x).tan()
+    distance_to_near = (0.5 * width) / tan_fov_x
+    tan_fov_y = 0.5 * height / distance_to_near
+    fov_y = (2 * tan_fov_y).atan()
+    near = near + distance_to_near
+    far = far + distance_to_near
+    move_back = repeat(
+        torch.eye(4, dtype=torch.float32, device=extrinsics.device),
+        "i j -> b i j",
+        b=extrinsics.shape[0],
+    ).clone()
+    move_back[:, 2, 3] = -distance_to_near
+    extrinsics = extrinsics @ move_back
+    return extrinsics, fov_x, fov_y, tan_fov_x, tan_fov_y, near, far
+
+
 def render_cuda_orthographic(
     extrinsics: Float[Tensor, "batch 4 4"],
     width: Float[Tensor, " batch"],
@@ -151,18 +197,9 @@ def render_cuda_orthographic(
     degree = isqrt(n) - 1
     shs = rearrange(gaussian_sh_coefficients, "b g xyz n -> b g n xyz").contiguous()
 
-    # Create fake "orthographic" projection by moving the camera back and picking a
-    # small field of view.
-    fov_x = torch.tensor(fov_degrees, device=extrinsics.device).deg2rad()
-    tan_fov_x = (0.5 * fov_x).tan()
-    distance_to_near = (0.5 * width) / tan_fov_x
-    tan_fov_y = 0.5 * height / distance_to_near
-    fov_y = (2 * tan_fov_y).atan()
-    near = near + distance_to_near
-    far = far + distance_to_near
-    move_back = torch.eye(4, dtype=torch.float32, device=extrinsics.device)
-    move_back[2, 3] = -distance_to_near
-    extrinsics = extrinsics @ move_back
+    extrinsics, fov_x, fov_y, tan_fov_x, tan_fov_y, near, far = (
+        get_orthographic_camera(extrinsics, width, height, near, far, fov_degrees)
+    )
 
     # Escape hatch for visualization/figures.
     if dump is not None:
@@ -179,6 +216,13 @@ def render_cuda_orthographic(
     view_matrix = rearrange(extrinsics.inverse(), "b i j -> b j i")
     full_projection = view_matrix @ projection_matrix
 
+    # Transfer the FOVs to the host once instead of syncing for every camera.
+    tan_fov_x = tan_fov_x.item()
+    tan_fov_y = tan_fov_y.tolist()
+
+    row, col = torch.triu_indices(3, 3)
+    covariances = gaussian_covariances[:, :, row, col]
+
     all_images = []
     all_radii = []
     for i in range(b):
@@ -193,7 +237,7 @@ def render_cuda_orthographic(
             image_height=h,
             image_width=w,
             tanfovx=tan_fov_x,
-            tanfovy=tan_fov_y,
+            tanfovy=tan_fov_y[i],
             bg=background_color[i],
             scale_modifier=1.0,
             viewmatrix=view_matrix[i],
@@ -205,24 +249,147 @@ def render_cuda_orthographic(
         )
         rasterizer = GaussianRasterizer(settings)
 
-        row, col = torch.triu_indices(3, 3)
-
         image, radii = rasterizer(
             means3D=gaussian_means[i],
             means2D=mean_gradients,
             shs=shs[i] if use_sh else None,
             colors_precomp=None if use_sh else shs[i, :, 0, :],
             opacities=gaussian_opacities[i, ..., None],
-            cov3D_precomp=gaussian_covariances[i, :, row, col],
+            cov3D_precomp=covariances[i],
         )
         all_images.append(image)
         all_radii.append(radii)
     return torch.stack(all_images)
 
 
+def render_cuda_batched(
+    extrinsics: Float[Tensor, "batch view 4 4"],
+    intrinsics: Float[Tensor, "batch view 3 3"],
+    near: Float[Tensor, "batch view"],
+    far: Float[Tensor, "batch view"],
+    image_shape: tuple[int, int],
+    background_color: Float[Tensor, "batch view 3"],
+    gaussian_means: Float[Tensor, "batch gaussian 3"],
+    gaussian_covariances: Float[Tensor, "batch gaussian 3 3"],
+    gaussian_sh_coefficients: Float[Tensor, "batch gaussian 3 d_sh"]
+    | Float[Tensor, "batch view gaussian 3 d_sh"],
+    gaussian_opacities: Float[Tensor, "batch gaussian"],
+    scale_invariant: bool = True,
+    use_sh: bool = True,
+) -> Float[Tensor, "batch view 3 height width"]:
+    """Render several views per scene. Unlike render_cuda, which expects the Gaussians
+    to be repeated for every view, each scene's Gaussian buffers are prepared once and
+    shared by all of its views, and the camera parameters that the rasterizer needs on
+    the host are transferred with a single sync. Colors may optionally be given per
+    view (e.g., for depth rendering).
+    """
+    assert use_sh or gaussian_sh_coefficients.shape[-1] == 1
+    b, v, _, _ = extrinsics.shape
+    h, w = image_shape
+
+    # Make sure everything is in a range where numerical issues don't appear. The
+    # rendering is invariant to the scale, so one scale per scene is enough.
+    if scale_invariant:
+        scale = 1 / near[:, 0]
+        extrinsics = extrinsics.clone()
+        extrinsics[..., :3, 3] = extrinsics[..., :3, 3] * scale[:, None, None]
+        gaussian_covariances = gaussian_covariances * (scale[:, None, None, None] ** 2)
+        gaussian_means = gaussian_means * scale[:, None, None]
+        near = near * scale[:, None]
+        far = far * scale[:, None]
+
+    n = gaussian_sh_coefficients.shape[-1]
+    degree = isqrt(n) - 1
+    shs = rearrange(gaussian_sh_coefficients, "... g xyz n -> ... g n xyz").contiguous()
+    shs_per_view = shs.ndim == 5
+
+    row, col = torch.triu_indices(3, 3)
+    covariances = gaussian_covariances[:, :, row, col]
+    opacities = gaussian_opacities[..., None]
+
+    fov_x, fov_y = get_fov(rearrange(intrinsics, "b v i j -> (b v) i j")).unbind(dim=-1)
+    tan_fov_x = (0.5 * fov_x).tan()
+    tan_fov_y = (0.5 * fov_y).tan()
+
+    projection_matrix = get_projection_matrix(
+        rearrange(near, "b v -> (b v)"), rearrange(far, "b v -> (b v)"), fov_x, fov_y
+    )
+    projection_matrix = rearrange(projection_matrix, "(b v) i j -> b v j i", b=b, v=v)
+    view_matrix = rearrange(extrinsics.inverse(), "b v i j -> b v j i")
+    full_projection = view_matrix @ projection_matrix
+
+    # Transfer the FOVs to the host once instead of syncing for every camera.
+    tan_fov = rearrange(
+        torch.stack((tan_fov_x, tan_fov_y), dim=-1), "(b v) xy -> b v xy", b=b, v=v
+    ).tolist()
+
+    all_images = []
+    for i in range(b):
+        for j in range(v):
+            # Set up a tensor for the gradients of the screen-space means.
+            mean_gradients = torch.zeros_like(gaussian_means[i], requires_grad=True)
+            try:
+                mean_gradients.retain_grad()
+            except Exception:
+                pass
+
+            settings = GaussianRasterizationSettings(
+                image_height=h,
+                image_width=w,
+                tanfovx=tan_fov[i][j][0],
+                tanfovy=tan_fov[i][j][1],
+                bg=background_color[i, j],
+                scale_modifier=1.0,
+                viewmatrix=view_matrix[i, j],
+                projmatrix=full_projection[i, j],
+                sh_degree=degree,
+                campos=extrinsics[i, j, :3, 3],
+                prefiltered=False,  # This matches the original usage.
+                debug=False,
+            )
+            rasterizer = GaussianRasterizer(settings)
+
+            view_shs = shs[i, j] if shs_per_view else shs[i]
+            image, _ = rasterizer(
+                means3D=gaussian_means[i],
+                means2D=mean_gradients,
+                shs=view_shs if use_sh else None,
+                colors_precomp=None if use_sh else view_shs[:, 0, :],
+                opacities=opacities[i],
+                cov3D_precomp=covariances[i],
+            )
+            all_images.append(image)
+    return rearrange(torch.stack(all_images), "(b v) c h w -> b v c h w", b=b, v=v)
+
+
 DepthRenderingMode = Literal["depth", "disparity", "relative_disparity", "log"]
 
 
+def get_depth_color(
+    extrinsics: Float[Tensor, "*batch 4 4"],
+    gaussian_means: Float[Tensor, "*#batch gaussian 3"],
+    near: Float[Tensor, "*batch"],
+    far: Float[Tensor, "*batch"],
+    mode: DepthRenderingMode,
+) -> Float[Tensor, "*batch gaussian"]:
+    camera_space_gaussians = einsum(
+        extrinsics.inverse(),
+        homogenize_points(gaussian_means),
+        "... i j, ... g j -> ... g i",
+    )
+    fake_color = camera_space_gaussians[..., 2]
+
+    if mode == "disparity":
+        fake_color = 1 / fake_color
+    elif mode == "relative_disparity":
+        fake_color = depth_to_relative_disparity(
+            fake_color, near[..., None], far[..., None]
+        )
+    elif mode == "log":
+        fake_color = fake_color.minimum(near[..., None]).maximum(far[..., None]).log()
+    return fake_color
+
+
 def render_depth_cuda(
     extrinsics: Float[Tensor, "batch 4 4"],
     intrinsics: Float[Tensor, "batch 3 3"],
@@ -236,19 +403,7 @@ def render_depth_cuda(
     mode: DepthRenderingMode = "depth",
 ) -> Float[Tensor, "batch height width"]:
     # Specify colors according to Gaussian depths.
-    camera_space_gaussians = einsum(
-        extrinsics.inverse(), homogenize_points(gaussian_means), "b i j, b g j -> b g i"
-    )
-    fake_color = camera_space_gaussians[..., 2]
-
-    if mode == "disparity":
-        fake_color = 1 / fake_color
-    elif mode == "relative_disparity":
-        fake_color = depth_to_relative_disparity(
-            fake_color, near[:, None], far[:, None]
-        )
-    elif mode == "log":
-        fake_color = fake_color.minimum(near[:, None]).maximum(far[:, None]).log()
+    fake_color = get_depth_color(extrinsics, gaussian_means, near, far, mode)
 
     # Render using depth as color.
     b, _ = fake_color.shape
@@ -267,3 +422,39 @@ def render_depth_cuda(
         use_sh=False,
     )
     return result.mean(dim=1)
+
+
+def render_depth_cuda_batched(
+    extrinsics: Float[Tensor, "batch view 4 4"],
+    intrinsics: Float[Tensor, "batch view 3 3"],
+    near: Float[Tensor, "batch view"],
+    far: Float[Tensor, "batch view"],
+    image_shape: tuple[int, int],
+    gaussian_means: Float[Tensor, "batch gaussian 3"],
+    gaussian_covariances: Float[Tensor, "batch gaussian 3 3"],
+    gaussian_opacities: Float[Tensor, "batch gaussian"],
+    scale_invariant: bool = True,
+    mode: DepthRenderingMode = "depth",
+) -> Float[Tensor, "batch view height width"]:
+    # Specify colors according to Gaussian depths. Only the colors depend on the view.
+    fake_color = get_depth_color(
+        extrinsics, gaussian_means[:, None], near, far, mode
+    )
+
+    # Render using depth as color.
+    b, v, _ = fake_color.shape
+    result = render_cuda_batched(
+        extrinsics,
+        intrinsics,
+        near,
+        far,
+        image_shape,
+        torch.zeros((b, v, 3), dtype=fake_color.dtype, device=fake_color.device),
+        gaussian_means,
+        gaussian_covariances,
+        repeat(fake_color, "b v g -> b v g c ()", c=3),
+        gaussian_opacities,
+        scale_invariant=scale_invariant,
+        use_sh=False,
+    )
+    return result.mean(dim=2)
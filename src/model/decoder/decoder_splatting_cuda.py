@@ -2,13 +2,18 @@ from dataclasses import dataclass
 from typing import Literal
 
 import torch
-from einops import rearrange, repeat
+from einops import repeat
 from jaxtyping import Float
 from torch import Tensor
 
 from ...dataset import DatasetCfg
+from ...misc.benchmarker import benchmark_scope
 from ..types import Gaussians
-from .cuda_splatting import DepthRenderingMode, render_cuda, render_depth_cuda
+from .cuda_splatting import (
+    DepthRenderingMode,
+    render_cuda_batched,
+    render_depth_cuda_batched,
+)
 from .decoder import Decoder, DecoderOutput
 
 
@@ -43,19 +48,19 @@ class DecoderSplattingCUDA(Decoder[DecoderSplattingCUDACfg]):
         depth_mode: DepthRenderingMode | None = None,
     ) -> DecoderOutput:
         b, v, _, _ = extrinsics.shape
-        color = render_cuda(
-            rearrange(extrinsics, "b v i j -> (b v) i j"),
-            rearrange(intrinsics, "b v i j -> (b v) i j"),
-            rearrange(near, "b v -> (b v)"),
-            rearrange(far, "b v -> (b v)"),
-            image_shape,
-            repeat(self.background_color, "c -> (b v) c", b=b, v=v),
-            repeat(gaussians.means, "b g xyz -> (b v) g xyz", v=v),
-            repeat(gaussians.covariances, "b g i j -> (b v) g i j", v=v),
-            repeat(gaussians.harmonics, "b g c d_sh -> (b v) g c d_sh", v=v),
-            repeat(gaussians.opacities, "b g -> (b v) g", v=v),
-        )
-        color = rearrange(color, "(b v) c h w -> b v c h w", b=b, v=v)
+        with benchmark_scope("color"):
+            color = render_cuda_batched(
+                extrinsics,
+                intrinsics,
+                near,
+                far,
+                image_shape,
+                repeat(self.background_color, "c -> b v c", b=b, v=v),
+                gaussians.means,
+                gaussians.covariances,
+                gaussians.harmonics,
+                gaussians.opacities,
+            )
 
         return DecoderOutput(
             color,
@@ -76,16 +81,15 @@ class DecoderSplattingCUDA(Decoder[DecoderSplattingCUDACfg]):
         image_shape: tuple[int, int],
         mode: DepthRenderingMode = "depth",
     ) -> Float[Tensor, "batch view height width"]:
-        b, v, _, _ = extrinsics.shape
-        result = render_depth_cuda(
-            rearrange(extrinsics, "b v i j -> (b v) i j"),
-            rearrange(intrinsics, "b v i j -> (b v) i j"),
-            rearrange(near, "b v -> (b v)"),
-            rearrange(far, "b v -> (b v)"),
-            image_shape,
-            repeat(gaussians.means, "b g xyz -> (b v) g xyz", v=v),
-            repeat(gaussians.covariances, "b g i j -> (b v) g i j", v=v),
-            repeat(gaussians.opacities, "b g -> (b v) g", v=v),
-            mode=mode,
-        )
-        return rearrange(result, "(b v) h w -> b v h w", b=b, v=v)
+        with benchmark_scope("depth"):
+            return render_depth_cuda_batched(
+                extrinsics,
+                intrinsics,
+                near,
+                far,
+                image_shape,
+                gaussians.means,
+                gaussians.covariances,
+                gaussians.opacities,
+                mode=mode,
+            )
@@ -0,0 +1,99 @@
+from dataclasses import dataclass
+from typing import Literal
+
+import torch
+from einops import repeat
+from jaxtyping import Float
+from torch import Tensor
+
+from ...dataset import DatasetCfg
+from ...misc.benchmarker import benchmark_scope
+from ..types import Gaussians
+from .cuda_splatting import DepthRenderingMode
+from .decoder import Decoder, DecoderOutput
+from .torch_splatting import render_depth_torch, render_torch
+
+
+@dataclass
+class DecoderSplattingTorchCfg:
+    name: Literal["splatting_torch"]
+    tile_size: int = 16
+
+
+class DecoderSplattingTorch(Decoder[DecoderSplattingTorchCfg]):
+    """Reference rasterizer in plain PyTorch. It needs no CUDA extension, so it can be
+    used for CPU smoke tests and low-resolution previews.
+    """
+
+    background_color: Float[Tensor, "3"]
+
+    def __init__(
+        self,
+        cfg: DecoderSplattingTorchCfg,
+        dataset_cfg: DatasetCfg,
+    ) -> None:
+        super().__init__(cfg, dataset_cfg)
+        self.register_buffer(
+            "background_color",
+            torch.tensor(dataset_cfg.background_color, dtype=torch.float32),
+            persistent=False,
+        )
+
+    def forward(
+        self,
+        gaussians: Gaussians,
+        extrinsics: Float[Tensor, "batch view 4 4"],
+        intrinsics: Float[Tensor, "batch view 3 3"],
+        near: Float[Tensor, "batch view"],
+        far: Float[Tensor, "batch view"],
+        image_shape: tuple[int, int],
+        depth_mode: DepthRenderingMode | None = None,
+    ) -> DecoderOutput:
+        b, v, _, _ = extrinsics.shape
+        with benchmark_scope("color"):
+            color = render_torch(
+                extrinsics,
+                intrinsics,
+                near,
+                far,
+                image_shape,
+                repeat(self.background_color, "c -> b v c", b=b, v=v),
+                gaussians.means,
+                gaussians.covariances,
+                gaussians.harmonics,
+                gaussians.opacities,
+                tile_size=self.cfg.tile_size,
+            )
+
+        return DecoderOutput(
+            color,
+            None
+            if depth_mode is None
+            else self.render_depth(
+                gaussians, extrinsics, intrinsics, near, far, image_shape, depth_mode
+            ),
+        )
+
+    def render_depth(
+        self,
+        gaussians: Gaussians,
+        extrinsics: Float[Tensor, "batch view 4 4"],
+        intrinsics: Float[Tensor, "batch view 3 3"],
+        near: Float[Tensor, "batch view"],
+        far: Float[Tensor, "batch view"],
+        image_shape: tuple[int, int],
+        mode: DepthRenderingMode = "depth",
+    ) -> Float[Tensor, "batch view height width"]:
+        with benchmark_scope("depth"):
+            return render_depth_torch(
+                extrinsics,
+                intrinsics,
+                near,
+                far,
+                image_shape,
+                gaussians.means,
+                gaussians.covariances,
+                gaussians.opacities,
+                mode=mode,
+                tile_size=self.cfg.tile_size,
+            )
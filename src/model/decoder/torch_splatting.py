@@ -0,0 +1,361 @@
+from math import ceil, isqrt
+
+import torch
+import torch.nn.functional as F
+from einops import einsum, rearrange, repeat
+from jaxtyping import Float
+from torch import Tensor
+
+from ...geometry.projection import get_fov
+from .cuda_splatting import DepthRenderingMode, get_depth_color, get_orthographic_camera
+
+# Real spherical harmonics constants, as used by the CUDA rasterizer.
+SH_C0 = 0.28209479177387814
+SH_C1 = 0.4886025119029199
+SH_C2 = (
+    1.0925484305920792,
+    -1.0925484305920792,
+    0.31539156525252005,
+    -1.0925484305920792,
+    0.5462742152960396,
+)
+SH_C3 = (
+    -0.5900435899266435,
+    2.890611442640554,
+    -0.4570457994644658,
+    0.3731763325901154,
+    -0.4570457994644658,
+    1.445305721320277,
+    -0.5900435899266435,
+)
+
+# Constants of the CUDA rasterizer.
+NEAR_PLANE = 0.2
+MIN_ALPHA = 1 / 255
+MAX_ALPHA = 0.99
+MIN_TRANSMITTANCE = 1e-4
+
+# Number of Gaussians per tile that are composited in one tensor operation.
+COMPOSITE_BATCH_SIZE = 256
+
+
+def evaluate_sh(
+    degree: int,
+    shs: Float[Tensor, "gaussian n 3"],
+    directions: Float[Tensor, "gaussian 3"],
+) -> Float[Tensor, "gaussian 3"]:
+    result = SH_C0 * shs[:, 0]
+    if degree > 0:
+        x, y, z = directions[:, :, None].unbind(dim=1)
+        result = (
+            result - SH_C1 * y * shs[:, 1] + SH_C1 * z * shs[:, 2] - SH_C1 * x * shs[:, 3]
+        )
+        if degree > 1:
+            xx, yy, zz = x * x, y * y, z * z
+            xy, yz, xz = x * y, y * z, x * z
+            result = (
+                result
+                + SH_C2[0] * xy * shs[:, 4]
+                + SH_C2[1] * yz * shs[:, 5]
+                + SH_C2[2] * (2 * zz - xx - yy) * shs[:, 6]
+                + SH_C2[3] * xz * shs[:, 7]
+                + SH_C2[4] * (xx - yy) * shs[:, 8]
+            )
+            if degree > 2:
+                result = (
+                    result
+                    + SH_C3[0] * y * (3 * xx - yy) * shs[:, 9]
+                    + SH_C3[1] * xy * z * shs[:, 10]
+                    + SH_C3[2] * y * (4 * zz - xx - yy) * shs[:, 11]
+                    + SH_C3[3] * z * (2 * zz - 3 * xx - 3 * yy) * shs[:, 12]
+                    + SH_C3[4] * x * (4 * zz - xx - yy) * shs[:, 13]
+                    + SH_C3[5] * z * (xx - yy) * shs[:, 14]
+                    + SH_C3[6] * x * (xx - 3 * yy) * shs[:, 15]
+                )
+    return (result + 0.5).clamp(min=0)
+
+
+def rasterize_gaussians(
+    w2c: Float[Tensor, "4 4"],
+    tan_fov_x: float,
+    tan_fov_y: float,
+    image_shape: tuple[int, int],
+    background_color: Float[Tensor, "3"],
+    gaussian_means: Float[Tensor, "gaussian 3"],
+    gaussian_covariances: Float[Tensor, "gaussian 3 3"],
+    gaussian_colors: Float[Tensor, "gaussian n 3"] | Float[Tensor, "gaussian 3"],
+    gaussian_opacities: Float[Tensor, " gaussian"],
+    use_sh: bool = True,
+    tile_size: int = 16,
+) -> Float[Tensor, "3 height width"]:
+    """Render one view with EWA splatting, following the CUDA rasterizer: Gaussians are
+    binned into screen tiles, sorted by depth and alpha-composited front to back. Tiles
+    are processed as (pixel x Gaussian) tensor operations rather than per Gaussian.
+    """
+    h, w = image_shape
+    device = gaussian_means.device
+    focal_x = w / (2 * tan_fov_x)
+    focal_y = h / (2 * tan_fov_y)
+
+    # Transform the Gaussians into camera space.
+    rotation = w2c[:3, :3]
+    xyz = einsum(rotation, gaussian_means, "i j, g j -> g i") + w2c[:3, 3]
+    x, y, z = xyz.unbind(dim=-1)
+
+    # Project the covariances (EWA) using the clamped Jacobian of the projection.
+    tx = (x / z).clamp(-1.3 * tan_fov_x, 1.3 * tan_fov_x) * z
+    ty = (y / z).clamp(-1.3 * tan_fov_y, 1.3 * tan_fov_y) * z
+    zeros = torch.zeros_like(z)
+    jacobian = torch.stack(
+        (
+            torch.stack((focal_x / z, zeros, -focal_x * tx / z**2), dim=-1),
+            torch.stack((zeros, focal_y / z, -focal_y * ty / z**2), dim=-1),
+        ),
+        dim=-2,
+    )
+    t = jacobian @ rotation
+    covariances = t @ gaussian_covariances @ t.transpose(-1, -2)
+    a = covariances[:, 0, 0] + 0.3
+    b = covariances[:, 0, 1]
+    c = covariances[:, 1, 1] + 0.3
+    det = a * c - b * b
+    conic = torch.stack((c, -b, a), dim=-1) / det[:, None]
+
+    # Compute the screen-space extent from the larger eigenvalue.
+    mid = 0.5 * (a + c)
+    lambda_max = mid + (mid * mid - det).clamp(min=0.1).sqrt()
+    radii = (3 * lambda_max.sqrt()).ceil()
+    px = focal_x * x / z + 0.5 * w - 0.5
+    py = focal_y * y / z + 0.5 * h - 0.5
+
+    if use_sh:
+        degree = isqrt(gaussian_colors.shape[1]) - 1
+        directions = F.normalize(gaussian_means - w2c.inverse()[:3, 3], dim=-1)
+        colors = evaluate_sh(degree, gaussian_colors, directions)
+    else:
+        colors = gaussian_colors
+
+    # Find the tiles that every Gaussian touches.
+    tiles_x = ceil(w / tile_size)
+    tiles_y = ceil(h / tile_size)
+    with torch.no_grad():
+        x_min = ((px - radii) / tile_size).floor().clamp(0, tiles_x).long()
+        x_max = ((px + radii + tile_size - 1) / tile_size).floor().clamp(0, tiles_x)
+        y_min = ((py - radii) / tile_size).floor().clamp(0, tiles_y).long()
+        y_max = ((py + radii + tile_size - 1) / tile_size).floor().clamp(0, tiles_y)
+        x_max, y_max = x_max.long(), y_max.long()
+        valid = (z > NEAR_PLANE) & (det != 0)
+        num_tiles = ((x_max - x_min) * (y_max - y_min)) * valid
+
+        # Emit one (tile, Gaussian) pair per touched tile in depth order, then sort the
+        # pairs by tile. The sort is stable, so each tile's Gaussians stay depth-sorted.
+        order = z.argsort()
+        order = order[num_tiles[order] > 0]
+        counts = num_tiles[order]
+        gaussian_ids = order.repeat_interleave(counts)
+        starts = counts.cumsum(dim=0) - counts
+        local = torch.arange(len(gaussian_ids), device=device)
+        local = local - starts.repeat_interleave(counts)
+        tile_width = (x_max - x_min)[gaussian_ids]
+        tile_ids = (y_min[gaussian_ids] + local // tile_width) * tiles_x + (
+            x_min[gaussian_ids] + local % tile_width
+        )
+        tile_ids, index = tile_ids.sort(stable=True)
+        gaussian_ids = gaussian_ids[index]
+        ends = torch.bincount(tile_ids, minlength=tiles_x * tiles_y).cumsum(dim=0)
+        ends = ends.tolist()
+
+    image = repeat(background_color, "c -> c h w", h=h, w=w).clone()
+    start = 0
+    for tile, end in enumerate(ends):
+        if end == start:
+            continue
+        tile_gaussians = gaussian_ids[start:end]
+        start = end
+
+        row, col = divmod(tile, tiles_x)
+        y0, x0 = row * tile_size, col * tile_size
+        y1, x1 = min(y0 + tile_size, h), min(x0 + tile_size, w)
+        ys, xs = torch.meshgrid(
+            torch.arange(y0, y1, device=device, dtype=xyz.dtype),
+            torch.arange(x0, x1, device=device, dtype=xyz.dtype),
+            indexing="ij",
+        )
+        xs, ys = xs.reshape(-1, 1), ys.reshape(-1, 1)
+
+        # Composite front to back, evaluating a batch of the tile's Gaussians at all of
+        # its pixels at once. Like the CUDA kernel, a pixel stops before the Gaussian
+        # that would bring its transmittance below the threshold, and the tile stops
+        # once all of its pixels have.
+        color = torch.zeros((len(xs), 3), dtype=xyz.dtype, device=device)
+        transmittance = torch.ones((len(xs), 1), dtype=xyz.dtype, device=device)
+        active = torch.ones((len(xs), 1), dtype=torch.bool, device=device)
+        for ids in tile_gaussians.split(COMPOSITE_BATCH_SIZE):
+            dx = px[ids] - xs
+            dy = py[ids] - ys
+            con_a, con_b, con_c = conic[ids].unbind(dim=-1)
+            power = -0.5 * (con_a * dx * dx + con_c * dy * dy) - con_b * dx * dy
+            alpha = (gaussian_opacities[ids] * power.exp()).clamp(max=MAX_ALPHA)
+            alpha = alpha * ((power <= 0) & (alpha >= MIN_ALPHA))
+
+            with torch.no_grad():
+                test_transmittance = transmittance * (1 - alpha).cumprod(dim=-1)
+                keep = active & (test_transmittance >= MIN_TRANSMITTANCE)
+                active = keep[:, -1:]
+            alpha = alpha * keep
+
+            batch_transmittance = (1 - alpha).cumprod(dim=-1)
+            weights = alpha * torch.cat(
+                (transmittance, transmittance * batch_transmittance[:, :-1]), dim=-1
+            )
+            color = color + weights @ colors[ids]
+            transmittance = transmittance * batch_transmittance[:, -1:]
+            if not active.any():
+                break
+
+        color = color + transmittance * background_color
+        image[:, y0:y1, x0:x1] = rearrange(
+            color, "(h w) c -> c h w", h=y1 - y0, w=x1 - x0
+        )
+    return image
+
+
+def render_torch(
+    extrinsics: Float[Tensor, "batch view 4 4"],
+    intrinsics: Float[Tensor, "batch view 3 3"],
+    near: Float[Tensor, "batch view"],
+    far: Float[Tensor, "batch view"],
+    image_shape: tuple[int, int],
+    background_color: Float[Tensor, "batch view 3"],
+    gaussian_means: Float[Tensor, "batch gaussian 3"],
+    gaussian_covariances: Float[Tensor, "batch gaussian 3 3"],
+    gaussian_sh_coefficients: Float[Tensor, "batch gaussian 3 d_sh"]
+    | Float[Tensor, "batch view gaussian 3 d_sh"],
+    gaussian_opacities: Float[Tensor, "batch gaussian"],
+    scale_invariant: bool = True,
+    use_sh: bool = True,
+    tile_size: int = 16,
+) -> Float[Tensor, "batch view 3 height width"]:
+    """PyTorch counterpart of render_cuda_batched. Runs on any device."""
+    assert use_sh or gaussian_sh_coefficients.shape[-1] == 1
+    b, v, _, _ = extrinsics.shape
+
+    # Match the CUDA path, which culls Gaussians in scaled units.
+    if scale_invariant:
+        scale = 1 / near[:, 0]
+        extrinsics = extrinsics.clone()
+        extrinsics[..., :3, 3] = extrinsics[..., :3, 3] * scale[:, None, None]
+        gaussian_covariances = gaussian_covariances * (scale[:, None, None, None] ** 2)
+        gaussian_means = gaussian_means * scale[:, None, None]
+
+    shs = rearrange(gaussian_sh_coefficients, "... g xyz n -> ... g n xyz")
+    shs_per_view = shs.ndim == 5
+
+    fov = get_fov(rearrange(intrinsics, "b v i j -> (b v) i j"))
+    tan_fov = rearrange((0.5 * fov).tan(), "(b v) xy -> b v xy", b=b, v=v).tolist()
+    w2c = extrinsics.inverse()
+
+    all_images = []
+    for i in range(b):
+        for j in range(v):
+            view_shs = shs[i, j] if shs_per_view else shs[i]
+            image = rasterize_gaussians(
+                w2c[i, j],
+                tan_fov[i][j][0],
+                tan_fov[i][j][1],
+                image_shape,
+                background_color[i, j],
+                gaussian_means[i],
+                gaussian_covariances[i],
+                view_shs if use_sh else view_shs[:, 0],
+                gaussian_opacities[i],
+                use_sh=use_sh,
+                tile_size=tile_size,
+            )
+            all_images.append(image)
+    return rearrange(torch.stack(all_images), "(b v) c h w -> b v c h w", b=b, v=v)
+
+
+def render_depth_torch(
+    extrinsics: Float[Tensor, "batch view 4 4"],
+    intrinsics: Float[Tensor, "batch view 3 3"],
+    near: Float[Tensor, "batch view"],
+    far: Float[Tensor, "batch view"],
+    image_shape: tuple[int, int],
+    gaussian_means: Float[Tensor, "batch gaussian 3"],
+    gaussian_covariances: Float[Tensor, "batch gaussian 3 3"],
+    gaussian_opacities: Float[Tensor, "batch gaussian"],
+    scale_invariant: bool = True,
+    mode: DepthRenderingMode = "depth",
+    tile_size: int = 16,
+) -> Float[Tensor, "batch view height width"]:
+    # Specify colors according to Gaussian depths.
+    fake_color = get_depth_color(
+        extrinsics, gaussian_means[:, None], near, far, mode
+    )
+
+    # Render using depth as color.
+    b, v, _ = fake_color.shape
+    result = render_torch(
+        extrinsics,
+        intrinsics,
+        near,
+        far,
+        image_shape,
+        torch.zeros((b, v, 3), dtype=fake_color.dtype, device=fake_color.device),
+        gaussian_means,
+        gaussian_covariances,
+        repeat(fake_color, "b v g -> b v g c ()", c=3),
+        gaussian_opacities,
+        scale_invariant=scale_invariant,
+        use_sh=False,
+        tile_size=tile_size,
+    )
+    return result.mean(dim=2)
+
+
+def render_torch_orthographic(
+    extrinsics: Float[Tensor, "batch 4 4"],
+    width: Float[Tensor, " batch"],
+    height: Float[Tensor, " batch"],
+    near: Float[Tensor, " batch"],
+    far: Float[Tensor, " batch"],
+    image_shape: tuple[int, int],
+    background_color: Float[Tensor, "batch 3"],
+    gaussian_means: Float[Tensor, "batch gaussian 3"],
+    gaussian_covariances: Float[Tensor, "batch gaussian 3 3"],
+    gaussian_sh_coefficients: Float[Tensor, "batch gaussian 3 d_sh"],
+    gaussian_opacities: Float[Tensor, "batch gaussian"],
+    fov_degrees: float = 0.1,
+    use_sh: bool = True,
+    tile_size: int = 16,
+) -> Float[Tensor, "batch 3 height width"]:
+    """PyTorch counterpart of render_cuda_orthographic."""
+    b, _, _ = extrinsics.shape
+    assert use_sh or gaussian_sh_coefficients.shape[-1] == 1
+    shs = rearrange(gaussian_sh_coefficients, "b g xyz n -> b g n xyz")
+
+    extrinsics, _, _, tan_fov_x, tan_fov_y, _, _ = get_orthographic_camera(
+        extrinsics, width, height, near, far, fov_degrees
+    )
+    tan_fov_x = tan_fov_x.item()
+    tan_fov_y = tan_fov_y.tolist()
+    w2c = extrinsics.inverse()
+
+    all_images = []
+    for i in range(b):
+        image = rasterize_gaussians(
+            w2c[i],
+            tan_fov_x,
+            tan_fov_y[i],
+            image_shape,
+            background_color[i],
+            gaussian_means[i],
+            gaussian_covariances[i],
+            shs[i] if use_sh else shs[i, :, 0],
+            gaussian_opacities[i],
+            use_sh=use_sh,
+            tile_size=tile_size,
+        )
+        all_images.append(image)
+    return torch.stack(all_images)
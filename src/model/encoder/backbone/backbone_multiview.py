@@ -7,6 +7,7 @@ from .unimatch.utils import split_feature, merge_splits
 from .unimatch.position import PositionEmbeddingSine
 
 from ..costvolume.conversions import depth_to_relative_disparity
+from ....misc.benchmarker import benchmark_scope
 from ....geometry.epipolar_lines import get_depth
 
 
@@ -49,6 +50,7 @@ class BackboneMultiview(torch.nn.Module):
         global_attn_fast=True,
         downscale_factor=8,
         use_epipolar_trans=False,
+        shared_kv=False,
     ):
         super(BackboneMultiview, self).__init__()
         self.feature_channels = feature_channels
@@ -69,6 +71,7 @@ class BackboneMultiview(torch.nn.Module):
             nhead=num_head,
             ffn_dim_expansion=ffn_dim_expansion,
             no_cross_attn=no_cross_attn,
+            shared_kv=shared_kv,
         )
 
     def normalize_images(self, images):
@@ -108,11 +111,13 @@ class BackboneMultiview(torch.nn.Module):
         attn_splits=2,
         return_cnn_features=False,
         epipolar_kwargs=None,
+        neighbors=None,
     ):
         ''' images: (B, N_Views, C, H, W), range [0, 1] '''
         # resolution low to high
-        features_list = self.extract_feature(
-            self.normalize_images(images))  # list of features
+        with benchmark_scope("cnn"):
+            features_list = self.extract_feature(
+                self.normalize_images(images))  # list of features
 
         cur_features_list = [x[0] for x in features_list]
 
@@ -170,8 +175,9 @@ class BackboneMultiview(torch.nn.Module):
                 cur_features_list, attn_splits, self.feature_channels)
 
             # Transformer
-            cur_features_list = self.transformer(
-                cur_features_list, attn_num_splits=attn_splits)
+            with benchmark_scope("transformer"):
+                cur_features_list = self.transformer(
+                    cur_features_list, attn_num_splits=attn_splits, neighbors=neighbors)
 
             features = torch.stack(cur_features_list, dim=1)  # [B, V, C, H, W]
 
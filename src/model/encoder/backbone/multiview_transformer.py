@@ -2,16 +2,15 @@ import torch
 import torch.nn as nn
 from einops import rearrange
 
+from ...attention import scaled_dot_product_attention
 from .unimatch.utils import split_feature, merge_splits
 
 
-def single_head_full_attention(q, k, v):
+def single_head_full_attention(q, k, v, backend="sdpa"):
     # q, k, v: [B, L, C]
     assert q.dim() == k.dim() == v.dim() == 3
 
-    scores = torch.matmul(q, k.permute(0, 2, 1)) / (q.size(2) ** 0.5)  # [B, L, L]
-    attn = torch.softmax(scores, dim=2)  # [B, L, L]
-    out = torch.matmul(attn, v)  # [B, L, C]
+    out = scaled_dot_product_attention(q, k, v, backend=backend)  # [B, L, C]
 
     return out
 
@@ -66,6 +65,7 @@ def single_head_split_window_attention(
     h=None,
     w=None,
     attn_mask=None,
+    backend="sdpa",
 ):
     # Ref: https://github.com/microsoft/Swin-Transformer/blob/main/models/swin_transformer.py
     # q, k, v: [B, L, C] for 2-view
@@ -90,8 +90,6 @@ def single_head_split_window_attention(
         k = k.view(b, m, h, w, c)  # [B, N-1, H, W, C]
         v = v.view(b, m, h, w, c)
 
-        scale_factor = c**0.5
-
         if with_shift:
             assert attn_mask is not None  # compute once
             shift_size_h = window_size_h // 2
@@ -117,25 +115,22 @@ def single_head_split_window_attention(
 
         k = (
             k.view(b_new, h // num_splits, w // num_splits, c, m)
-            .permute(0, 3, 1, 2, 4)
-            .reshape(b_new, c, -1)
-        )  # [B*K*K, C, H/K*W/K*(N-1)]
+            .permute(0, 1, 2, 4, 3)
+            .reshape(b_new, -1, c)
+        )  # [B*K*K, H/K*W/K*(N-1), C]
         v = (
             v.view(b_new, h // num_splits, w // num_splits, c, m)
             .permute(0, 1, 2, 4, 3)
             .reshape(b_new, -1, c)
         )  # [B*K*K, H/K*W/K*(N-1), C]
 
-        scores = (
-            torch.matmul(q.view(b_new, -1, c), k) / scale_factor
-        )  # [B*K*K, H/K*W/K, H/K*W/K*(N-1)]
-
-        if with_shift:
-            scores += attn_mask.repeat(b, 1, m)
-
-        attn = torch.softmax(scores, dim=-1)
-
-        out = torch.matmul(attn, v)  # [B*K*K, H/K*W/K, C]
+        out = scaled_dot_product_attention(
+            q.view(b_new, -1, c),
+            k,
+            v,
+            attn_mask=attn_mask.repeat(b, 1, m) if with_shift else None,
+            backend=backend,
+        )  # [B*K*K, H/K*W/K, C]
 
         out = merge_splits(
             out.view(b_new, h // num_splits, w // num_splits, c),
@@ -166,8 +161,6 @@ def single_head_split_window_attention(
         k = k.view(b, h, w, c)
         v = v.view(b, h, w, c)
 
-        scale_factor = c**0.5
-
         if with_shift:
             assert attn_mask is not None  # compute once
             shift_size_h = window_size_h // 2
@@ -183,17 +176,13 @@ def single_head_split_window_attention(
         k = split_feature(k, num_splits=num_splits, channel_last=True)
         v = split_feature(v, num_splits=num_splits, channel_last=True)
 
-        scores = (
-            torch.matmul(q.view(b_new, -1, c), k.view(b_new, -1, c).permute(0, 2, 1))
-            / scale_factor
-        )  # [B*K*K, H/K*W/K, H/K*W/K]
-
-        if with_shift:
-            scores += attn_mask.repeat(b, 1, 1)
-
-        attn = torch.softmax(scores, dim=-1)
-
-        out = torch.matmul(attn, v.view(b_new, -1, c))  # [B*K*K, H/K*W/K, C]
+        out = scaled_dot_product_attention(
+            q.view(b_new, -1, c),
+            k.view(b_new, -1, c),
+            v.view(b_new, -1, c),
+            attn_mask=attn_mask.repeat(b, 1, 1) if with_shift else None,
+            backend=backend,
+        )  # [B*K*K, H/K*W/K, C]
 
         out = merge_splits(
             out.view(b_new, h // num_splits, w // num_splits, c),
@@ -210,6 +199,103 @@ def single_head_split_window_attention(
     return out
 
 
+def single_head_split_window_multiview_attention(
+    q,
+    k,
+    v,
+    neighbors,
+    num_splits=1,
+    with_shift=False,
+    h=None,
+    w=None,
+    attn_mask=None,
+):
+    """Multi-view cross-attention over keys and values projected once per view
+    Args:
+        q, k, v: [N, B, L, C] for N views
+        neighbors: [B, N, M], the M views each query view attends to
+    Returns:
+        out: [N, B, L, C]
+
+    Matches single_head_split_window_attention on stacked [B, M, L, C] keys and
+    values, but the softmax is accumulated one neighbor at a time, so only one
+    gathered copy of the keys and values and one window score matrix exist at once.
+
+    This does not go through scaled_dot_product_attention: merging the per-neighbor
+    partial results needs each chunk's softmax normalizer, which the fused kernels do
+    not return, and handing them all neighbors at once would gather the M copies of
+    the keys and values this function exists to avoid. It computes the math
+    formulation under either attention backend.
+    """
+    # NOTE: the stacked version tiles the shifted-window mask along the interleaved
+    # (position, view) key axis, so key position p of the j-th stacked view is masked
+    # with column (p * M + j) % L. This is reproduced to keep multi-view checkpoints
+    # producing the same features.
+    assert h is not None and w is not None
+    assert q.size(2) == h * w
+
+    n, b, _, c = q.size()
+    kk = num_splits * num_splits
+    window_size_h = h // num_splits
+    window_size_w = w // num_splits
+    shift_size_h = window_size_h // 2
+    shift_size_w = window_size_w // 2
+
+    def to_windows(x):
+        x = x.reshape(n * b, h, w, c)
+        if with_shift:
+            x = torch.roll(x, shifts=(-shift_size_h, -shift_size_w), dims=(1, 2))
+        x = split_feature(x, num_splits=num_splits, channel_last=True)
+        return x.view(n, b, kk, -1, c)  # [N, B, K*K, H/K*W/K, C]
+
+    if with_shift:
+        assert attn_mask is not None  # compute once
+
+    q = to_windows(q) / (c**0.5)
+    k = to_windows(k)
+    v = to_windows(v)
+
+    m = neighbors.size(-1)
+    window_index = torch.arange(window_size_h * window_size_w, device=q.device)
+    batch_index = torch.arange(b, device=q.device)[None]  # [1, B]
+    max_scores = None
+    for j, index in enumerate(neighbors.unbind(dim=-1)):
+        index = index.t()  # [N, B]
+        scores = torch.matmul(q, k[index, batch_index].transpose(-1, -2))
+        if with_shift:
+            # [N, B, K*K, H/K*W/K, H/K*W/K]
+            scores = scores + attn_mask[..., (window_index * m + j) % window_index.numel()]
+
+        # online softmax over the concatenated neighbor keys
+        cur_max_scores = scores.amax(dim=-1, keepdim=True)
+        if max_scores is None:
+            max_scores = cur_max_scores
+            probs = torch.exp(scores - max_scores)
+            normalizer = probs.sum(dim=-1, keepdim=True)
+            out = torch.matmul(probs, v[index, batch_index])
+        else:
+            new_max_scores = torch.maximum(max_scores, cur_max_scores)
+            rescale = torch.exp(max_scores - new_max_scores)
+            probs = torch.exp(scores - new_max_scores)
+            normalizer = normalizer * rescale + probs.sum(dim=-1, keepdim=True)
+            out = out * rescale + torch.matmul(probs, v[index, batch_index])
+            max_scores = new_max_scores
+
+    out = out / normalizer  # [N, B, K*K, H/K*W/K, C]
+
+    out = merge_splits(
+        out.view(n * b * kk, window_size_h, window_size_w, c),
+        num_splits=num_splits,
+        channel_last=True,
+    )  # [N*B, H, W, C]
+
+    # shift back
+    if with_shift:
+        out = torch.roll(out, shifts=(shift_size_h, shift_size_w), dims=(1, 2))
+
+    return out.view(n, b, -1, c)
+
+
 def multi_head_split_window_attention(
     q,
     k,
@@ -220,6 +306,7 @@ def multi_head_split_window_attention(
     w=None,
     attn_mask=None,
     num_head=1,
+    backend="sdpa",
 ):
     """Multi-head scaled dot-product attention
     Args:
@@ -246,8 +333,6 @@ def multi_head_split_window_attention(
 
     assert c % num_head == 0
 
-    scale_factor = (c // num_head) ** 0.5
-
     if with_shift:
         assert attn_mask is not None  # compute once
         shift_size_h = window_size_h // 2
@@ -263,16 +348,14 @@ def multi_head_split_window_attention(
 
     # multi-head attn
     q = q.view(b_new, -1, num_head, c // num_head).permute(0, 2, 1, 3)  # [B, N, H*W, C]
-    k = k.view(b_new, -1, num_head, c // num_head).permute(0, 2, 3, 1)  # [B, N, C, H*W]
-    scores = torch.matmul(q, k) / scale_factor  # [B*K*K, N, H/K*W/K, H/K*W/K]
-
-    if with_shift:
-        scores += attn_mask.unsqueeze(1).repeat(b, num_head, 1, 1)
-
-    attn = torch.softmax(scores, dim=-1)  # [B*K*K, N, H/K*W/K, H/K*W/K]
-
-    out = torch.matmul(
-        attn, v.view(b_new, -1, num_head, c // num_head).permute(0, 2, 1, 3)
+    k = k.view(b_new, -1, num_head, c // num_head).permute(0, 2, 1, 3)  # [B, N, H*W, C]
+    v = v.view(b_new, -1, num_head, c // num_head).permute(0, 2, 1, 3)  # [B, N, H*W, C]
+    out = scaled_dot_product_attention(
+        q,
+        k,
+        v,
+        attn_mask=attn_mask.unsqueeze(1).repeat(b, 1, 1, 1) if with_shift else None,
+        backend=backend,
     )  # [B*K*K, N, H/K*W/K, C]
 
     out = merge_splits(
@@ -310,6 +393,7 @@ class TransformerLayer(nn.Module):
         self.add_per_view_attn = add_per_view_attn
 
         self.with_shift = with_shift
+        self.attention_backend = "sdpa"
 
         # multi-head attention
         self.q_proj = nn.Linear(d_model, d_model, bias=False)
@@ -339,6 +423,7 @@ class TransformerLayer(nn.Module):
         width=None,
         shifted_window_attn_mask=None,
         attn_num_splits=None,
+        neighbors=None,
         **kwargs,
     ):
         if "attn_type" in kwargs:
@@ -348,6 +433,7 @@ class TransformerLayer(nn.Module):
 
         # source, target: [B, L, C] for 2-view
         # for multi-view cross-attention, source: [B, L, C], target: [B, N-1, L, C]
+        # or, with neighbors [B, N, M], source and target are both [N*B, L, C]
         query, key, value = source, target, target
 
         # single-head attention
@@ -355,7 +441,22 @@ class TransformerLayer(nn.Module):
         key = self.k_proj(key)  # [B, L, C] or [B, N-1, L, C]
         value = self.v_proj(value)  # [B, L, C] or [B, N-1, L, C]
 
-        if attn_type == "swin" and attn_num_splits > 1:
+        if neighbors is not None:
+            assert self.nhead == 1 and not self.add_per_view_attn
+            n = neighbors.size(1)
+            message = single_head_split_window_multiview_attention(
+                rearrange(query, "(n b) l c -> n b l c", n=n),
+                rearrange(key, "(n b) l c -> n b l c", n=n),
+                rearrange(value, "(n b) l c -> n b l c", n=n),
+                neighbors,
+                num_splits=attn_num_splits if attn_type == "swin" else 1,
+                with_shift=self.with_shift and attn_num_splits > 1,
+                h=height,
+                w=width,
+                attn_mask=shifted_window_attn_mask,
+            )
+            message = rearrange(message, "n b l c -> (n b) l c")
+        elif attn_type == "swin" and attn_num_splits > 1:
             if self.nhead > 1:
                 message = multi_head_split_window_attention(
                     query,
@@ -367,6 +468,7 @@ class TransformerLayer(nn.Module):
                     w=width,
                     attn_mask=shifted_window_attn_mask,
                     num_head=self.nhead,
+                    backend=self.attention_backend,
                 )
             else:
                 if self.add_per_view_attn:
@@ -387,6 +489,7 @@ class TransformerLayer(nn.Module):
                         h=height,
                         w=width,
                         attn_mask=shifted_window_attn_mask,
+                        backend=self.attention_backend,
                     )
                     # [B, L, C]  # add per view attn
                     message = message.view(b, -1, l, c).sum(1)
@@ -400,9 +503,12 @@ class TransformerLayer(nn.Module):
                         h=height,
                         w=width,
                         attn_mask=shifted_window_attn_mask,
+                        backend=self.attention_backend,
                     )
         else:
-            message = single_head_full_attention(query, key, value)  # [B, L, C]
+            message = single_head_full_attention(
+                query, key, value, backend=self.attention_backend
+            )  # [B, L, C]
 
         message = self.merge(message)  # [B, L, C]
         message = self.norm1(message)
@@ -468,6 +574,7 @@ class TransformerBlock(nn.Module):
         width=None,
         shifted_window_attn_mask=None,
         attn_num_splits=None,
+        neighbors=None,
         **kwargs,
     ):
         # source, target: [B, L, C]
@@ -494,12 +601,21 @@ class TransformerBlock(nn.Module):
             width=width,
             shifted_window_attn_mask=shifted_window_attn_mask,
             attn_num_splits=attn_num_splits,
+            neighbors=neighbors,
             **kwargs,
         )
 
         return source
 
 
+def get_other_views(b, num_views, device):
+    # the views batch_features stacks for every query view, in the same order
+    view_index = torch.arange(num_views, device=device)
+    other_index = torch.arange(num_views - 1, device=device)
+    others = other_index[None] + (other_index[None] >= view_index[:, None]).long()
+    return others.expand(b, -1, -1)  # [B, N, N-1]
+
+
 def batch_features(features):
     # construct inputs to multi-view transformer in batch
     # features: list of [B, C, H, W] or [B, H*W, C]
@@ -533,11 +649,15 @@ class MultiViewFeatureTransformer(nn.Module):
         ffn_dim_expansion=4,
         add_per_view_attn=False,
         no_cross_attn=False,
+        shared_kv=False,
         **kwargs,
     ):
         super(MultiViewFeatureTransformer, self).__init__()
 
         self.attention_type = attention_type
+        # attend to the other views' keys and values in place (memory linear in the
+        # number of views) instead of stacking N-1 copies for every view
+        self.shared_kv = shared_kv
 
         self.d_model = d_model
         self.nhead = nhead
@@ -575,6 +695,7 @@ class MultiViewFeatureTransformer(nn.Module):
         self,
         multi_view_features,
         attn_num_splits=None,
+        neighbors=None,
         **kwargs,
     ):
         if "attn_type" in kwargs and kwargs["attn_type"] == "epipolar":
@@ -605,6 +726,29 @@ class MultiViewFeatureTransformer(nn.Module):
         else:
             shifted_window_attn_mask = None
 
+        if self.shared_kv or neighbors is not None:
+            # neighbors: [B, N, M], defaults to all other views
+            if neighbors is None:
+                neighbors = get_other_views(b, num_views, multi_view_features[0].device)
+
+            concat0 = rearrange(
+                torch.stack(multi_view_features), "n b c h w -> (n b) (h w) c"
+            )  # [N*B, H*W, C]
+            for layer in self.layers:
+                concat0 = layer(
+                    concat0,
+                    concat0,
+                    height=h,
+                    width=w,
+                    shifted_window_attn_mask=shifted_window_attn_mask,
+                    attn_num_splits=attn_num_splits,
+                    neighbors=neighbors,
+                )
+
+            return list(
+                rearrange(concat0, "(n b) (h w) c -> n b c h w", n=num_views, h=h)
+            )
+
         # [N*B, C, H, W], [N*B, N-1, C, H, W]
         concat0, concat1 = batch_features(multi_view_features)
         concat0 = concat0.reshape(num_views * b, c, -1).permute(
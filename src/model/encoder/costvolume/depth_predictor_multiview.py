@@ -2,9 +2,12 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange, repeat
+from torch.utils.checkpoint import checkpoint
 
+from ....misc.benchmarker import benchmark_scope
 from ..backbone.unimatch.geometry import coords_grid
 from .ldm_unet.unet import UNetModel
+from .view_selection import get_all_neighbors
 
 
 def warp_with_pose_depth_candidates(
@@ -70,36 +73,91 @@ def warp_with_pose_depth_candidates(
     return warped_feature
 
 
+def correlate_with_pose_depth_candidates(
+    feature0,
+    feature1,
+    intrinsics,
+    pose,
+    depth,
+    depth_chunk_size=None,
+    recompute_warp=False,
+    clamp_min_depth=1e-3,
+    warp_padding_mode="zeros",
+):
+    """
+    feature0: [B, C, H, W]
+    feature1: [B, C, H, W]
+    intrinsics: [B, 3, 3]
+    pose: [B, 4, 4]
+    depth: [B, D, H, W]
+    return: [B, D, H, W], scaled dot product of feature0 and feature1 warped to
+        every depth candidate
+
+    Depth candidates are warped depth_chunk_size at a time, so the [B, C, D, H, W]
+    warped volume is never materialized as a whole. With recompute_warp, each chunk is
+    warped again in backward instead of keeping its warped features for it.
+    """
+
+    def correlate(feature0, feature1, depth):
+        warped_feature = warp_with_pose_depth_candidates(
+            feature1,
+            intrinsics,
+            pose,
+            depth,
+            clamp_min_depth=clamp_min_depth,
+            warp_padding_mode=warp_padding_mode,
+        )  # [B, C, D, H, W]
+        return (feature0.unsqueeze(2) * warped_feature).sum(1) / (
+            feature0.size(1) ** 0.5
+        )  # [B, D, H, W]
+
+    if depth_chunk_size is None:
+        depth_chunk_size = depth.size(1)
+
+    correlation = []
+    for depth_chunk in depth.split(depth_chunk_size, dim=1):
+        if recompute_warp and torch.is_grad_enabled():
+            correlation.append(
+                checkpoint(
+                    correlate, feature0, feature1, depth_chunk, use_reentrant=False
+                )
+            )
+        else:
+            correlation.append(correlate(feature0, feature1, depth_chunk))
+    return torch.cat(correlation, dim=1)
+
+
 def prepare_feat_proj_data_lists(
-    features, intrinsics, extrinsics, near, far, num_samples
+    features, intrinsics, extrinsics, near, far, num_samples, neighbors=None
 ):
+    """
+    neighbors: [B, V, K], the source views each reference view builds its cost volume
+        from. Defaults to all other views.
+    """
     # prepare features
     b, v, _, h, w = features.shape
 
     feat_lists = []
     pose_curr_lists = []
-    init_view_order = list(range(v))
     feat_lists.append(rearrange(features, "b v ... -> (v b) ..."))  # (vxb c h w)
-    for idx in range(1, v):
-        cur_view_order = init_view_order[idx:] + init_view_order[:idx]
-        cur_feat = features[:, cur_view_order]
-        feat_lists.append(rearrange(cur_feat, "b v ... -> (v b) ..."))  # (vxb c h w)
-
-        # calculate reference pose
-        # NOTE: not efficient, but clearer for now
-        if v > 2:
-            cur_ref_pose_to_v0_list = []
-            for v0, v1 in zip(init_view_order, cur_view_order):
-                cur_ref_pose_to_v0_list.append(
-                    extrinsics[:, v1].clone().detach().inverse()
-                    @ extrinsics[:, v0].clone().detach()
-                )
-            cur_ref_pose_to_v0s = torch.cat(cur_ref_pose_to_v0_list, dim=0)  # (vxb c h w)
-            pose_curr_lists.append(cur_ref_pose_to_v0s)
-    
+    if v > 2:
+        if neighbors is None:
+            neighbors = get_all_neighbors(b, v, features.device)
+        extrinsics = extrinsics.detach()
+        extrinsics_inv = extrinsics.inverse()
+        batch_index = torch.arange(b, device=features.device)[:, None]
+        for idx in neighbors.unbind(dim=-1):
+            cur_feat = features[batch_index, idx]
+            feat_lists.append(rearrange(cur_feat, "b v ... -> (v b) ..."))  # (vxb c h w)
+
+            # calculate reference pose
+            cur_ref_pose_to_v0s = extrinsics_inv[batch_index, idx] @ extrinsics
+            pose_curr_lists.append(rearrange(cur_ref_pose_to_v0s, "b v ... -> (v b) ..."))
+
     # get 2 views reference pose
     # NOTE: do it in such a way to reproduce the exact same value as reported in paper
     if v == 2:
+        feat_lists.append(rearrange(features[:, [1, 0]], "b v ... -> (v b) ..."))
         pose_ref = extrinsics[:, 0].clone().detach()
         pose_tgt = extrinsics[:, 1].clone().detach()
         pose = pose_tgt.inverse() @ pose_ref
@@ -123,6 +181,71 @@ def prepare_feat_proj_data_lists(
     return feat_lists, intr_curr, pose_curr_lists, depth_candi_curr
 
 
+def sample_disparity_band(
+    pdf, disp_candi, num_samples, size, band_width, near, far
+):
+    """
+    pdf: [VB, D, H, W], probabilities of the previous stage's candidates
+    disp_candi: [VB, D, 1, 1] or [VB, D, H, W], the previous stage's candidates
+    size: (H', W') of the next stage
+    near, far: [VB, 1, 1, 1]
+    return: [VB, num_samples, H', W'], disparity candidates spread uniformly over
+        mean +- band_width * std of the previous stage's estimate
+
+    The band is never narrower than the previous stage's candidate spacing, and is
+    clipped to the disparity range between far and near.
+    """
+    d = disp_candi.size(1)
+    mean = (disp_candi * pdf).sum(dim=1, keepdim=True)  # [VB, 1, H, W]
+    std = ((disp_candi - mean) ** 2 * pdf).sum(dim=1, keepdim=True).sqrt()
+    spacing = (
+        disp_candi.amax(dim=1, keepdim=True) - disp_candi.amin(dim=1, keepdim=True)
+    ) / (d - 1)
+    half_width = torch.maximum(band_width * std, spacing)
+
+    mean, half_width = (
+        F.interpolate(x, size=size, mode="bilinear", align_corners=True)
+        for x in (mean, half_width)
+    )
+    lower = torch.maximum(mean - half_width, 1.0 / far)
+    upper = torch.minimum(mean + half_width, 1.0 / near)
+    steps = torch.linspace(0.0, 1.0, num_samples, device=pdf.device)
+    return lower + steps.view(1, -1, 1, 1).type_as(pdf) * (upper - lower).clamp(min=0)
+
+
+def get_cost_volume_refiner(
+    input_channels, channels, num_depth_candidates, channel_mult, attn_res, num_views
+):
+    return nn.Sequential(
+        nn.Conv2d(input_channels, channels, 3, 1, 1),
+        nn.GroupNorm(8, channels),
+        nn.GELU(),
+        UNetModel(
+            image_size=None,
+            in_channels=channels,
+            model_channels=channels,
+            out_channels=channels,
+            num_res_blocks=1,
+            attention_resolutions=attn_res,
+            channel_mult=channel_mult,
+            num_head_channels=32,
+            dims=2,
+            postnorm=True,
+            num_frames=num_views,
+            use_cross_view_self_attn=True,
+        ),
+        nn.Conv2d(channels, num_depth_candidates, 3, 1, 1)
+    )
+
+
+def get_depth_head(num_depth_candidates):
+    return nn.Sequential(
+        nn.Conv2d(num_depth_candidates, num_depth_candidates * 2, 3, 1, 1),
+        nn.GELU(),
+        nn.Conv2d(num_depth_candidates * 2, num_depth_candidates, 3, 1, 1),
+    )
+
+
 class DepthPredictorMultiView(nn.Module):
     """IMPORTANT: this model is in (v b), NOT (b v), due to some historical issues.
     keep this in mind when performing any operation related to the view dim"""
@@ -144,10 +267,18 @@ class DepthPredictorMultiView(nn.Module):
         wo_depth_refine=False,
         wo_cost_volume=False,
         wo_cost_volume_refine=False,
+        depth_chunk_size=None,
+        recompute_warp=False,
+        cascade_depth_candidates=(),
+        cascade_band_width=2.0,
         **kwargs,
     ):
         super(DepthPredictorMultiView, self).__init__()
         self.num_depth_candidates = num_depth_candidates
+        self.cascade_depth_candidates = tuple(cascade_depth_candidates)
+        self.cascade_band_width = cascade_band_width
+        self.depth_chunk_size = depth_chunk_size
+        self.recompute_warp = recompute_warp
         self.regressor_feat_dim = costvolume_unet_feat_dim
         self.upscale_factor = upscale_factor
         # ablation settings
@@ -164,37 +295,46 @@ class DepthPredictorMultiView(nn.Module):
         if wo_cost_volume_refine:
             self.corr_project = nn.Conv2d(input_channels, channels, 3, 1, 1)
         else:
-            modules = [
-                nn.Conv2d(input_channels, channels, 3, 1, 1),
-                nn.GroupNorm(8, channels),
-                nn.GELU(),
-                UNetModel(
-                    image_size=None,
-                    in_channels=channels,
-                    model_channels=channels,
-                    out_channels=channels,
-                    num_res_blocks=1,
-                    attention_resolutions=costvolume_unet_attn_res,
-                    channel_mult=costvolume_unet_channel_mult,
-                    num_head_channels=32,
-                    dims=2,
-                    postnorm=True,
-                    num_frames=num_views,
-                    use_cross_view_self_attn=True,
-                ),
-                nn.Conv2d(channels, num_depth_candidates, 3, 1, 1)
-            ]
-            self.corr_refine_net = nn.Sequential(*modules)
+            self.corr_refine_net = get_cost_volume_refiner(
+                input_channels,
+                channels,
+                num_depth_candidates,
+                costvolume_unet_channel_mult,
+                costvolume_unet_attn_res,
+                num_views,
+            )
             # cost volume u-net skip connection
             self.regressor_residual = nn.Conv2d(
                 input_channels, num_depth_candidates, 1, 1, 0
             )
 
         # Depth estimation: project features to get softmax based coarse depth
-        self.depth_head_lowres = nn.Sequential(
-            nn.Conv2d(num_depth_candidates, num_depth_candidates * 2, 3, 1, 1),
-            nn.GELU(),
-            nn.Conv2d(num_depth_candidates * 2, num_depth_candidates, 3, 1, 1),
+        self.depth_head_lowres = get_depth_head(num_depth_candidates)
+
+        # Cascade: coarse stages (coarsest first) that run at 1/2, 1/4, ... of the cost
+        # volume resolution and narrow down the candidates of the stage after them.
+        # The last stage is the cost volume above.
+        assert not (self.cascade_depth_candidates and wo_cost_volume)
+        self.cascade_stages = nn.ModuleList(
+            [
+                nn.ModuleDict(
+                    {
+                        "corr_refine_net": get_cost_volume_refiner(
+                            num_candidates + feature_channels,
+                            channels,
+                            num_candidates,
+                            costvolume_unet_channel_mult,
+                            costvolume_unet_attn_res,
+                            num_views,
+                        ),
+                        "regressor_residual": nn.Conv2d(
+                            num_candidates + feature_channels, num_candidates, 1, 1, 0
+                        ),
+                        "depth_head": get_depth_head(num_candidates),
+                    }
+                )
+                for num_candidates in self.cascade_depth_candidates
+            ]
         )
 
         # CNN-based feature upsampler
@@ -270,67 +410,80 @@ class DepthPredictorMultiView(nn.Module):
         deterministic=True,
         extra_info=None,
         cnn_features=None,
+        neighbors=None,
     ):
         """IMPORTANT: this model is in (v b), NOT (b v), due to some historical issues.
         keep this in mind when performing any operation related to the view dim"""
 
         # format the input
         b, v, c, h, w = features.shape
-        feat_comb_lists, intr_curr, pose_curr_lists, disp_candi_curr = (
-            prepare_feat_proj_data_lists(
-                features,
+        if cnn_features is not None:
+            cnn_features = rearrange(cnn_features, "b v ... -> (v b) ...")
+
+        # coarse cascade stages: each one predicts a disparity distribution at a lower
+        # resolution, which sets the per-pixel candidate band of the next stage
+        pdf, disp_candi_curr = None, None
+        num_stages = len(self.cascade_stages) + 1
+        for stage, stage_modules in enumerate(self.cascade_stages):
+            scale = 2 ** (num_stages - 1 - stage)
+            stage_features = rearrange(
+                F.avg_pool2d(rearrange(features, "b v c h w -> (b v) c h w"), scale),
+                "(b v) c h w -> b v c h w",
+                b=b,
+                v=v,
+            )
+            raw_correlation_in, disp_candi_curr = self.build_cost_volume(
+                stage_features,
                 intrinsics,
                 extrinsics,
                 near,
                 far,
-                num_samples=self.num_depth_candidates,
+                self.cascade_depth_candidates[stage],
+                neighbors,
+                pdf,
+                disp_candi_curr,
             )
-        )
-        if cnn_features is not None:
-            cnn_features = rearrange(cnn_features, "b v ... -> (v b) ...")
+            with benchmark_scope("cost_volume_refine"):
+                raw_correlation = stage_modules["corr_refine_net"](
+                    raw_correlation_in
+                ) + stage_modules["regressor_residual"](raw_correlation_in)
+                pdf = F.softmax(stage_modules["depth_head"](raw_correlation), dim=1)
 
         # cost volume constructions
-        feat01 = feat_comb_lists[0]
+        feat01 = rearrange(features, "b v ... -> (v b) ...")
         if self.wo_cost_volume:
             raw_correlation_in = feat01
+            disp_candi_curr = prepare_feat_proj_data_lists(
+                features, intrinsics, extrinsics, near, far, self.num_depth_candidates
+            )[-1]
         else:
-            raw_correlation_in_lists = []
-            for feat10, pose_curr in zip(feat_comb_lists[1:], pose_curr_lists):
-                # sample feat01 from feat10 via camera projection
-                feat01_warped = warp_with_pose_depth_candidates(
-                    feat10,
-                    intr_curr,
-                    pose_curr,
-                    1.0 / disp_candi_curr.repeat([1, 1, *feat10.shape[-2:]]),
-                    warp_padding_mode="zeros",
-                )  # [B, C, D, H, W]
-                # calculate similarity
-                raw_correlation_in = (feat01.unsqueeze(2) * feat01_warped).sum(
-                    1
-                ) / (
-                    c**0.5
-                )  # [vB, D, H, W]
-                raw_correlation_in_lists.append(raw_correlation_in)
-            # average all cost volumes
-            raw_correlation_in = torch.mean(
-                torch.stack(raw_correlation_in_lists, dim=0), dim=0, keepdim=False
-            )  # [vxb d, h, w]
-            raw_correlation_in = torch.cat((raw_correlation_in, feat01), dim=1)
+            raw_correlation_in, disp_candi_curr = self.build_cost_volume(
+                features,
+                intrinsics,
+                extrinsics,
+                near,
+                far,
+                self.num_depth_candidates,
+                neighbors,
+                pdf,
+                disp_candi_curr,
+            )
 
         # refine cost volume via 2D u-net
-        if self.wo_cost_volume_refine:
-            raw_correlation = self.corr_project(raw_correlation_in)
-        else:
-            raw_correlation = self.corr_refine_net(raw_correlation_in)  # (vb d h w)
-            # apply skip connection
-            raw_correlation = raw_correlation + self.regressor_residual(
-                raw_correlation_in
-            )
+        with benchmark_scope("cost_volume_refine"):
+            if self.wo_cost_volume_refine:
+                raw_correlation = self.corr_project(raw_correlation_in)
+            else:
+                raw_correlation = self.corr_refine_net(raw_correlation_in)  # (vb d h w)
+                # apply skip connection
+                raw_correlation = raw_correlation + self.regressor_residual(
+                    raw_correlation_in
+                )
 
-        # softmax to get coarse depth and density
-        pdf = F.softmax(
-            self.depth_head_lowres(raw_correlation), dim=1
-        )  # [2xB, D, H, W]
+            # softmax to get coarse depth and density
+            pdf = F.softmax(
+                self.depth_head_lowres(raw_correlation), dim=1
+            )  # [2xB, D, H, W]
         coarse_disps = (disp_candi_curr * pdf).sum(
             dim=1, keepdim=True
         )  # (vb, 1, h, w)
@@ -344,17 +497,23 @@ class DepthPredictorMultiView(nn.Module):
         )
 
         # depth refinement
-        proj_feat_in_fullres = self.upsampler(torch.cat((feat01, cnn_features), dim=1))
-        proj_feature = self.proj_feature(proj_feat_in_fullres)
-        refine_out = self.refine_unet(torch.cat(
-            (extra_info["images"], proj_feature, fullres_disps, pdf_max), dim=1
-        ))
+        with benchmark_scope("depth_refine"):
+            proj_feat_in_fullres = self.upsampler(
+                torch.cat((feat01, cnn_features), dim=1)
+            )
+            proj_feature = self.proj_feature(proj_feat_in_fullres)
+            refine_out = self.refine_unet(torch.cat(
+                (extra_info["images"], proj_feature, fullres_disps, pdf_max), dim=1
+            ))
 
         # gaussians head
-        raw_gaussians_in = [refine_out,
-                            extra_info["images"], proj_feat_in_fullres]
-        raw_gaussians_in = torch.cat(raw_gaussians_in, dim=1)
-        raw_gaussians = self.to_gaussians(raw_gaussians_in)
+        with benchmark_scope("gaussian_head"):
+            raw_gaussians_in = [refine_out,
+                                extra_info["images"], proj_feat_in_fullres]
+            raw_gaussians_in = torch.cat(raw_gaussians_in, dim=1)
+            raw_gaussians = self.to_gaussians(raw_gaussians_in)
+            if not self.wo_depth_refine:
+                delta_disps_density = self.to_disparity(refine_out)
         raw_gaussians = rearrange(
             raw_gaussians, "(v b) c h w -> b v (h w) c", v=v, b=b
         )
@@ -377,7 +536,6 @@ class DepthPredictorMultiView(nn.Module):
             )
         else:
             # delta fine depth and density
-            delta_disps_density = self.to_disparity(refine_out)
             delta_disps, raw_densities = delta_disps_density.split(
                 gaussians_per_pixel, dim=1
             )
@@ -405,3 +563,67 @@ class DepthPredictorMultiView(nn.Module):
             )
 
         return depths, densities, raw_gaussians
+
+    def build_cost_volume(
+        self,
+        features,
+        intrinsics,
+        extrinsics,
+        near,
+        far,
+        num_depth_candidates,
+        neighbors=None,
+        prev_pdf=None,
+        prev_disp_candi=None,
+    ):
+        """Correlate every view with its source views at num_depth_candidates disparity
+        candidates: spread uniformly between far and near, or, given the previous
+        cascade stage's pdf, in a band around its estimate. Returns the averaged cost
+        volume concatenated with the reference features, [VB, D + C, H, W], and the
+        candidates, [VB, D, 1, 1] or [VB, D, H, W].
+        """
+        feat_comb_lists, intr_curr, pose_curr_lists, disp_candi_curr = (
+            prepare_feat_proj_data_lists(
+                features,
+                intrinsics,
+                extrinsics,
+                near,
+                far,
+                num_samples=num_depth_candidates,
+                neighbors=neighbors,
+            )
+        )
+        feat01 = feat_comb_lists[0]
+        if prev_pdf is not None:
+            disp_candi_curr = sample_disparity_band(
+                prev_pdf,
+                prev_disp_candi,
+                num_depth_candidates,
+                feat01.shape[-2:],
+                self.cascade_band_width,
+                rearrange(near, "b v -> (v b) () () ()"),
+                rearrange(far, "b v -> (v b) () () ()"),
+            )
+
+        with benchmark_scope("cost_volume"):
+            raw_correlation_in_lists = []
+            for feat10, pose_curr in zip(feat_comb_lists[1:], pose_curr_lists):
+                # sample feat01 from feat10 via camera projection and calculate
+                # similarity
+                raw_correlation_in = correlate_with_pose_depth_candidates(
+                    feat01,
+                    feat10,
+                    intr_curr,
+                    pose_curr,
+                    1.0 / disp_candi_curr.expand(-1, -1, *feat10.shape[-2:]),
+                    depth_chunk_size=self.depth_chunk_size,
+                    recompute_warp=self.recompute_warp,
+                    warp_padding_mode="zeros",
+                )  # [vB, D, H, W]
+                raw_correlation_in_lists.append(raw_correlation_in)
+            # average all cost volumes
+            raw_correlation_in = torch.mean(
+                torch.stack(raw_correlation_in_lists, dim=0), dim=0, keepdim=False
+            )  # [vxb d, h, w]
+        raw_correlation_in = torch.cat((raw_correlation_in, feat01), dim=1)
+        return raw_correlation_in, disp_candi_curr
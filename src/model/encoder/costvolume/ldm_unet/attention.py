@@ -2,9 +2,11 @@ from inspect import isfunction
 import math
 import torch
 import torch.nn.functional as F
-from torch import nn, einsum
+from torch import nn
 from einops import rearrange, repeat
 
+from ....attention import scaled_dot_product_attention
+
 
 def exists(val):
     return val is not None
@@ -120,6 +122,7 @@ class SpatialSelfAttention(nn.Module):
                                         kernel_size=1,
                                         stride=1,
                                         padding=0)
+        self.attention_backend = "sdpa"
 
     def forward(self, x):
         h_ = x
@@ -130,18 +133,9 @@ class SpatialSelfAttention(nn.Module):
 
         # compute attention
         b,c,h,w = q.shape
-        q = rearrange(q, 'b c h w -> b (h w) c')
-        k = rearrange(k, 'b c h w -> b c (h w)')
-        w_ = torch.einsum('bij,bjk->bik', q, k)
-
-        w_ = w_ * (int(c)**(-0.5))
-        w_ = torch.nn.functional.softmax(w_, dim=2)
-
-        # attend to values
-        v = rearrange(v, 'b c h w -> b c (h w)')
-        w_ = rearrange(w_, 'b i j -> b j i')
-        h_ = torch.einsum('bij,bjk->bik', v, w_)
-        h_ = rearrange(h_, 'b c (h w) -> b c h w', h=h)
+        q, k, v = map(lambda t: rearrange(t, 'b c h w -> b (h w) c'), (q, k, v))
+        h_ = scaled_dot_product_attention(q, k, v, backend=self.attention_backend)
+        h_ = rearrange(h_, 'b (h w) c -> b c h w', h=h)
         h_ = self.proj_out(h_)
 
         return x+h_
@@ -164,6 +158,7 @@ class CrossAttention(nn.Module):
             nn.Linear(inner_dim, query_dim),
             nn.Dropout(dropout)
         )
+        self.attention_backend = "sdpa"
 
     def forward(self, x, context=None, mask=None):
         h = self.heads
@@ -175,18 +170,14 @@ class CrossAttention(nn.Module):
 
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
 
-        sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
-
         if exists(mask):
             mask = rearrange(mask, 'b ... -> b (...)')
-            max_neg_value = -torch.finfo(sim.dtype).max
             mask = repeat(mask, 'b j -> (b h) () j', h=h)
-            sim.masked_fill_(~mask, max_neg_value)
 
         # attention, what we cannot get enough of
-        attn = sim.softmax(dim=-1)
-
-        out = einsum('b i j, b j d -> b i d', attn, v)
+        out = scaled_dot_product_attention(
+            q, k, v, attn_mask=mask, scale=self.scale, backend=self.attention_backend
+        )
         out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
         return self.to_out(out)
 
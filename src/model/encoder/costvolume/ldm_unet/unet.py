@@ -20,6 +20,7 @@ from .util import (
     timestep_embedding,
 )
 from .attention import SpatialTransformer
+from ....attention import scaled_dot_product_attention
 
 
 # dummy replace
@@ -412,6 +413,7 @@ class CrossAttentionBlock(nn.Module):
         self.with_norm = with_norm
         self.tanh_gating = tanh_gating
         self.ffn_after_cross_attn = ffn_after_cross_attn
+        self.attention_backend = "sdpa"
 
         self.q_proj = nn.Linear(channels, proj_channels)
         self.k_proj = nn.Linear(condition_channels, proj_channels)
@@ -471,16 +473,18 @@ class CrossAttentionBlock(nn.Module):
             k = k.view(b * d, ly, self.num_head, c // self.num_head)  # [B*D, H*W, N, C]
             v = v.view(b * d, ly, self.num_head, c // self.num_head)  # [B*D, H*W, N, C]
 
-            scores = torch.matmul(q.permute(0, 2, 1, 3), k.permute(0, 2, 3, 1)) / ((c // self.num_head) ** 0.5)  # [B*D, N, H*W, H*W]
-            prob = torch.softmax(scores, dim=-1)
-            out = torch.matmul(prob, v.permute(0, 2, 1, 3))  # [B*D, H*W, N, C]
-            out = out.view(b * d, lx, -1)  # [B*D, H*W, C]
+            out = scaled_dot_product_attention(
+                q.permute(0, 2, 1, 3),
+                k.permute(0, 2, 1, 3),
+                v.permute(0, 2, 1, 3),
+                backend=self.attention_backend,
+            )  # [B*D, N, H*W, C]
+            out = out.reshape(b * d, lx, -1)  # [B*D, H*W, C]
 
         else:
-            scores = torch.matmul(q, k.permute(0, 2, 1)) / (c ** 0.5)  # [B*D, H*W, H*W]
-            prob = torch.softmax(scores, dim=-1)
-
-            out = torch.matmul(prob, v)  # [B*D, H*W, C]
+            out = scaled_dot_product_attention(
+                q, k, v, backend=self.attention_backend
+            )  # [B*D, H*W, C]
 
         out = out.view(b, d, h, w, c).permute(0, 4, 1, 2, 3)  # [B, C, D, H, W]
 
@@ -534,6 +538,7 @@ class QKVAttentionLegacy(nn.Module):
         self.n_heads = n_heads
         self.n_frames = n_frames
         self.use_cross_view_self_attn = use_cross_view_self_attn
+        self.attention_backend = "sdpa"
 
     def forward(self, qkv):
         """
@@ -551,12 +556,13 @@ class QKVAttentionLegacy(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v).reshape(bs, -1, length)
+        a = scaled_dot_product_attention(
+            q.transpose(1, 2),
+            k.transpose(1, 2),
+            v.transpose(1, 2),
+            backend=self.attention_backend,
+        )
+        a = a.transpose(1, 2).reshape(bs, -1, length)
 
         # move view dim back to batch dim in original '(v b)' order if needed
         if self.use_cross_view_self_attn:
@@ -577,6 +583,7 @@ class QKVAttention(nn.Module):
     def __init__(self, n_heads):
         super().__init__()
         self.n_heads = n_heads
+        self.attention_backend = "sdpa"
 
     def forward(self, qkv):
         """
@@ -587,16 +594,12 @@ class QKVAttention(nn.Module):
         bs, width, length = qkv.shape
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
-        q, k, v = qkv.chunk(3, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts",
-            (q * scale).view(bs * self.n_heads, ch, length),
-            (k * scale).view(bs * self.n_heads, ch, length),
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v.reshape(bs * self.n_heads, ch, length))
-        return a.reshape(bs, -1, length)
+        q, k, v = (
+            x.reshape(bs * self.n_heads, ch, length).transpose(1, 2)
+            for x in qkv.chunk(3, dim=1)
+        )
+        a = scaled_dot_product_attention(q, k, v, backend=self.attention_backend)
+        return a.transpose(1, 2).reshape(bs, -1, length)
 
     @staticmethod
     def count_flops(model, _x, y):
@@ -0,0 +1,69 @@
+import math
+
+import torch
+from einops import einsum
+from jaxtyping import Float, Int64
+from torch import Tensor
+
+
+def load_pair_scores(path: str) -> Float[Tensor, "ref src"]:
+    """Read a view pair table in the MVSNet format used by src/dataset/dtu/dtu_pairs.txt:
+    the number of reference views, then per reference view a line with its id and a line with
+    "num_src src_0 score_0 src_1 score_1 ...". Pairs that are not listed score 0.
+    """
+    pairs = []
+    with open(path) as f:
+        num_ref_views = int(f.readline())
+        for _ in range(num_ref_views):
+            ref_view = int(f.readline())
+            entries = f.readline().split()[1:]
+            for src_view, score in zip(entries[::2], entries[1::2]):
+                pairs.append((ref_view, int(src_view), float(score)))
+
+    # Source views may have ids beyond the listed reference views.
+    num_views = max(max(ref_view, src_view) for ref_view, src_view, _ in pairs) + 1
+    scores = torch.zeros((num_views, num_views), dtype=torch.float32)
+    for ref_view, src_view, score in pairs:
+        scores[ref_view, src_view] = score
+    return scores
+
+
+def get_pose_scores(
+    extrinsics: Float[Tensor, "batch view 4 4"],
+    theta_0: float = 5.0,
+    sigma_1: float = 1.0,
+    sigma_2: float = 10.0,
+) -> Float[Tensor, "batch view view"]:
+    """Score view pairs with MVSNet's piecewise Gaussian on the angle (in degrees)
+    between the optical axes, which favors neighbors seen from a few degrees away.
+    """
+    look = extrinsics[..., :3, 2]
+    cos = einsum(look, look, "b i xyz, b j xyz -> b i j")
+    theta = torch.rad2deg(torch.acos(cos.clip(min=-1, max=1)))
+    sigma = torch.where(theta <= theta_0, sigma_1, sigma_2)
+    return torch.exp(-((theta - theta_0) ** 2) / (2 * sigma**2))
+
+
+def select_neighbors(
+    scores: Float[Tensor, "batch view view"],
+    num_neighbors: int,
+) -> Int64[Tensor, "batch view neighbor"]:
+    """Pick the highest-scoring other views for every reference view."""
+    _, v, _ = scores.shape
+    num_neighbors = min(num_neighbors, v - 1)
+    eye = torch.eye(v, dtype=torch.bool, device=scores.device)
+    scores = scores.masked_fill(eye, -math.inf)
+    return scores.topk(num_neighbors, dim=-1).indices
+
+
+def get_all_neighbors(
+    b: int,
+    v: int,
+    device: torch.device,
+) -> Int64[Tensor, "batch view neighbor"]:
+    """Every other view, ordered like the original pairwise loop: neighbor n of view i
+    is view (i + n + 1) % v.
+    """
+    index = torch.arange(v, device=device)
+    neighbors = (index[:, None] + index[None, 1:]) % v
+    return neighbors.expand(b, -1, -1)
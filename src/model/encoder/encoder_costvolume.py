@@ -11,6 +11,8 @@ from ...dataset.shims.bounds_shim import apply_bounds_shim
 from ...dataset.shims.patch_shim import apply_patch_shim
 from ...dataset.types import BatchedExample, DataShim
 from ...geometry.projection import sample_image_grid
+from ...misc.benchmarker import benchmark_scope
+from ..attention import AttentionBackend, set_attention_backend
 from ..types import Gaussians
 from .backbone import (
     BackboneMultiview,
@@ -18,6 +20,11 @@ from .backbone import (
 from .common.gaussian_adapter import GaussianAdapter, GaussianAdapterCfg
 from .encoder import Encoder
 from .costvolume.depth_predictor_multiview import DepthPredictorMultiView
+from .costvolume.view_selection import (
+    get_pose_scores,
+    load_pair_scores,
+    select_neighbors,
+)
 from .visualization.encoder_visualizer_costvolume_cfg import EncoderVisualizerCostVolumeCfg
 
 from ...global_cfg import get_cfg
@@ -58,6 +65,16 @@ class EncoderCostVolumeCfg:
     wo_backbone_cross_attn: bool
     wo_cost_volume_refine: bool
     use_epipolar_trans: bool
+    costvolume_depth_chunk_size: int | None = None
+    costvolume_recompute_warp: bool = False
+    costvolume_num_neighbors: int | None = None
+    costvolume_pairs_path: str | None = None
+    costvolume_cascade_depth_candidates: List[int] | None = None
+    costvolume_cascade_band_width: float = 2.0
+    multiview_trans_shared_kv: bool = False
+    multiview_trans_neighbors: Literal["full", "topk", "random"] = "full"
+    multiview_trans_num_neighbors: int | None = None
+    attention_backend: AttentionBackend = "sdpa"
 
 
 class EncoderCostVolume(Encoder[EncoderCostVolumeCfg]):
@@ -83,6 +100,7 @@ class EncoderCostVolume(Encoder[EncoderCostVolumeCfg]):
             downscale_factor=cfg.downscale_factor,
             no_cross_attn=cfg.wo_backbone_cross_attn,
             use_epipolar_trans=cfg.use_epipolar_trans,
+            shared_kv=cfg.multiview_trans_shared_kv,
         )
         ckpt_path = cfg.unimatch_weights_path
         if get_cfg().mode == 'train':
@@ -122,8 +140,24 @@ class EncoderCostVolume(Encoder[EncoderCostVolumeCfg]):
             wo_depth_refine=cfg.wo_depth_refine,
             wo_cost_volume=cfg.wo_cost_volume,
             wo_cost_volume_refine=cfg.wo_cost_volume_refine,
+            depth_chunk_size=cfg.costvolume_depth_chunk_size,
+            recompute_warp=cfg.costvolume_recompute_warp,
+            cascade_depth_candidates=cfg.costvolume_cascade_depth_candidates or (),
+            cascade_band_width=cfg.costvolume_cascade_band_width,
         )
 
+        # view pair scores for neighbor-limited cost volumes
+        if cfg.costvolume_pairs_path is not None:
+            self.register_buffer(
+                "pair_scores",
+                load_pair_scores(cfg.costvolume_pairs_path),
+                persistent=False,
+            )
+        else:
+            self.pair_scores = None
+
+        set_attention_backend(self, cfg.attention_backend)
+
     def map_pdf_to_opacity(
         self,
         pdf: Float[Tensor, " *batch"],
@@ -139,6 +173,37 @@ class EncoderCostVolume(Encoder[EncoderCostVolumeCfg]):
         # Map the probability density to an opacity.
         return 0.5 * (1 - (1 - pdf) ** exponent + pdf ** (1 / exponent))
 
+    def get_view_scores(self, context: dict) -> Tensor:
+        # Use the pair table when the views can be looked up in it (DTU), otherwise
+        # score the context poses.
+        if self.pair_scores is not None and "view_ids" in context:
+            view_ids = context["view_ids"]
+            if isinstance(view_ids, list):  # collated from per-example lists
+                view_ids = torch.stack(view_ids, dim=1)
+            view_ids = view_ids.to(self.pair_scores.device)
+            return self.pair_scores[view_ids[:, :, None], view_ids[:, None, :]]
+        return get_pose_scores(context["extrinsics"])
+
+    def select_neighbors(self, context: dict) -> Optional[Tensor]:
+        _, v, _, _, _ = context["image"].shape
+        if self.cfg.costvolume_num_neighbors is None or v <= 2:
+            return None
+        return select_neighbors(
+            self.get_view_scores(context), self.cfg.costvolume_num_neighbors
+        )
+
+    def select_attention_neighbors(self, context: dict) -> Optional[Tensor]:
+        b, v, _, _, _ = context["image"].shape
+        if self.cfg.multiview_trans_neighbors == "full" or v <= 2:
+            return None
+        assert self.cfg.multiview_trans_shared_kv
+        assert self.cfg.multiview_trans_num_neighbors is not None
+        if self.cfg.multiview_trans_neighbors == "random":
+            scores = torch.rand((b, v, v), device=context["image"].device)
+        else:
+            scores = self.get_view_scores(context)
+        return select_neighbors(scores, self.cfg.multiview_trans_num_neighbors)
+
     def forward(
         self,
         context: dict,
@@ -162,12 +227,14 @@ class EncoderCostVolume(Encoder[EncoderCostVolumeCfg]):
             }
         else:
             epipolar_kwargs = None
-        trans_features, cnn_features = self.backbone(
-            context["image"],
-            attn_splits=self.cfg.multiview_trans_attn_split,
-            return_cnn_features=True,
-            epipolar_kwargs=epipolar_kwargs,
-        )
+        with benchmark_scope("backbone"):
+            trans_features, cnn_features = self.backbone(
+                context["image"],
+                attn_splits=self.cfg.multiview_trans_attn_split,
+                return_cnn_features=True,
+                epipolar_kwargs=epipolar_kwargs,
+                neighbors=self.select_attention_neighbors(context),
+            )
 
         # Sample depths from the resulting features.
         in_feats = trans_features
@@ -175,17 +242,19 @@ class EncoderCostVolume(Encoder[EncoderCostVolumeCfg]):
         extra_info['images'] = rearrange(context["image"], "b v c h w -> (v b) c h w")
         extra_info["scene_names"] = scene_names
         gpp = self.cfg.gaussians_per_pixel
-        depths, densities, raw_gaussians = self.depth_predictor(
-            in_feats,
-            context["intrinsics"],
-            context["extrinsics"],
-            context["near"],
-            context["far"],
-            gaussians_per_pixel=gpp,
-            deterministic=deterministic,
-            extra_info=extra_info,
-            cnn_features=cnn_features,
-        )
+        with benchmark_scope("depth_predictor"):
+            depths, densities, raw_gaussians = self.depth_predictor(
+                in_feats,
+                context["intrinsics"],
+                context["extrinsics"],
+                context["near"],
+                context["far"],
+                gaussians_per_pixel=gpp,
+                deterministic=deterministic,
+                extra_info=extra_info,
+                cnn_features=cnn_features,
+                neighbors=self.select_neighbors(context),
+            )
 
         # Convert the features and depths into Gaussians.
         xy_ray, _ = sample_image_grid((h, w), device)
@@ -199,18 +268,19 @@ class EncoderCostVolume(Encoder[EncoderCostVolumeCfg]):
         pixel_size = 1 / torch.tensor((w, h), dtype=torch.float32, device=device)
         xy_ray = xy_ray + (offset_xy - 0.5) * pixel_size
         gpp = self.cfg.gaussians_per_pixel
-        gaussians = self.gaussian_adapter.forward(
-            rearrange(context["extrinsics"], "b v i j -> b v () () () i j"),
-            rearrange(context["intrinsics"], "b v i j -> b v () () () i j"),
-            rearrange(xy_ray, "b v r srf xy -> b v r srf () xy"),
-            depths,
-            self.map_pdf_to_opacity(densities, global_step) / gpp,
-            rearrange(
-                gaussians[..., 2:],
-                "b v r srf c -> b v r srf () c",
-            ),
-            (h, w),
-        )
+        with benchmark_scope("gaussian_adapter"):
+            gaussians = self.gaussian_adapter.forward(
+                rearrange(context["extrinsics"], "b v i j -> b v () () () i j"),
+                rearrange(context["intrinsics"], "b v i j -> b v () () () i j"),
+                rearrange(xy_ray, "b v r srf xy -> b v r srf () xy"),
+                depths,
+                self.map_pdf_to_opacity(densities, global_step) / gpp,
+                rearrange(
+                    gaussians[..., 2:],
+                    "b v r srf c -> b v r srf () c",
+                ),
+                (h, w),
+            )
 
         # Dump visualizations if needed.
         if visualization_dump is not None:
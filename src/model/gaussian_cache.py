@@ -0,0 +1,103 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass, fields
+
+import torch
+from torch import Tensor
+
+from ..dataset.types import BatchedViews
+from .types import Gaussians
+
+CacheKey = tuple[tuple[str, ...], tuple[tuple[int, ...], ...], str, int]
+
+
+@dataclass
+class GaussianCacheCfg:
+    max_bytes: int = 2 * 1024**3
+    # Keep cached Gaussians in host memory and copy them back on a hit.
+    offload_to_cpu: bool = False
+
+
+def get_num_bytes(gaussians: Gaussians) -> int:
+    return sum(
+        getattr(gaussians, field.name).nbytes for field in fields(Gaussians)
+    )
+
+
+def hash_tensors(*tensors: Tensor) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for tensor in tensors:
+        digest.update(tensor.detach().float().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def move_gaussians(gaussians: Gaussians, device: torch.device | str) -> Gaussians:
+    return Gaussians(
+        *(
+            getattr(gaussians, field.name).to(device, non_blocking=True)
+            for field in fields(Gaussians)
+        )
+    )
+
+
+class GaussianCache:
+    """Least-recently-used cache of encoder outputs. Entries are keyed on the scenes,
+    the context view indices, a hash of the context cameras and the checkpoint step, so
+    the same context encoded with the same weights is only ever encoded once. Entries
+    are evicted once their total size exceeds max_bytes.
+    """
+
+    cfg: GaussianCacheCfg
+    entries: OrderedDict[CacheKey, Gaussians]
+    num_bytes: int
+    hits: int
+    misses: int
+
+    def __init__(self, cfg: GaussianCacheCfg) -> None:
+        self.cfg = cfg
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(scene: list[str], context: BatchedViews, step: int) -> CacheKey:
+        return (
+            tuple(scene),
+            tuple(tuple(index) for index in context["index"].tolist()),
+            hash_tensors(context["extrinsics"], context["intrinsics"]),
+            step,
+        )
+
+    def get(self, key: CacheKey, device: torch.device | str) -> Gaussians | None:
+        gaussians = self.entries.get(key)
+        if gaussians is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return move_gaussians(gaussians, device)
+
+    def put(self, key: CacheKey, gaussians: Gaussians) -> None:
+        gaussians = Gaussians(
+            *(getattr(gaussians, field.name).detach() for field in fields(Gaussians))
+        )
+        if self.cfg.offload_to_cpu:
+            gaussians = move_gaussians(gaussians, "cpu")
+
+        num_bytes = get_num_bytes(gaussians)
+        if num_bytes > self.cfg.max_bytes:
+            return
+
+        if key in self.entries:
+            self.num_bytes -= get_num_bytes(self.entries.pop(key))
+        self.entries[key] = gaussians
+        self.num_bytes += num_bytes
+
+        while self.num_bytes > self.cfg.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= get_num_bytes(evicted)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.num_bytes = 0
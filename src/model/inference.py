@@ -0,0 +1,132 @@
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import torch
+from einops import repeat
+from jaxtyping import Float
+from torch import Tensor, nn
+
+from ..dataset import DatasetCfg
+from ..dataset.data_module import get_data_shim
+from ..dataset.types import BatchedViews
+from .compaction import CompactionCfg, compact_gaussians
+from .decoder import DecoderCfg, get_decoder
+from .decoder.decoder import Decoder, DecoderOutput, DepthRenderingMode
+from .encoder import Encoder, EncoderCfg, get_encoder
+from .types import Gaussians
+
+CameraChunk = tuple[
+    Float[Tensor, "batch view 4 4"],  # extrinsics
+    Float[Tensor, "batch view 3 3"],  # intrinsics
+]
+
+
+class InferenceModel(nn.Module):
+    """The encoder and decoder without Lightning: encode a set of context views once,
+    then render any number of cameras from the resulting Gaussians.
+    """
+
+    encoder: Encoder
+    decoder: Decoder
+    compaction: CompactionCfg | None
+    global_step: int
+
+    def __init__(
+        self,
+        encoder: Encoder,
+        decoder: Decoder,
+        compaction: CompactionCfg | None = None,
+        global_step: int = 0,
+    ) -> None:
+        super().__init__()
+        self.encoder = encoder
+        self.decoder = decoder
+        self.data_shim = get_data_shim(encoder)
+        self.compaction = compaction
+        self.global_step = global_step
+
+    @classmethod
+    def from_checkpoint(
+        cls,
+        checkpoint_path: Path | str,
+        encoder_cfg: EncoderCfg,
+        decoder_cfg: DecoderCfg,
+        dataset_cfg: DatasetCfg,
+        compaction: CompactionCfg | None = None,
+    ) -> "InferenceModel":
+        """Load the encoder weights from a ModelWrapper checkpoint (or from a bare
+        state dict, as used for released models). Like in src/main.py, the global config
+        has to be set first, since the encoder reads the run mode from it.
+        """
+        encoder, _ = get_encoder(encoder_cfg)
+        decoder = get_decoder(decoder_cfg, dataset_cfg)
+
+        checkpoint = torch.load(checkpoint_path, map_location="cpu")
+        state_dict = checkpoint.get("state_dict", checkpoint)
+        encoder.load_state_dict(
+            {
+                key[len("encoder.") :]: value
+                for key, value in state_dict.items()
+                if key.startswith("encoder.")
+            }
+        )
+        model = cls(encoder, decoder, compaction, checkpoint.get("global_step", 0))
+        return model.eval()
+
+    @property
+    def device(self) -> torch.device:
+        return next(self.encoder.parameters()).device
+
+    @torch.no_grad()
+    def encode(self, context: BatchedViews) -> Gaussians:
+        # The data shim crops both context and target views, so the context stands in
+        # for the (unknown) targets.
+        context = self.data_shim({"context": context, "target": context})["context"]
+        return self.encoder(context, self.global_step, deterministic=False)
+
+    @torch.no_grad()
+    def render(
+        self,
+        gaussians: Gaussians,
+        extrinsics: Float[Tensor, "batch view 4 4"],
+        intrinsics: Float[Tensor, "batch view 3 3"],
+        near: Float[Tensor, "batch view"],
+        far: Float[Tensor, "batch view"],
+        image_shape: tuple[int, int],
+        depth_mode: DepthRenderingMode | None = None,
+    ) -> DecoderOutput:
+        if self.compaction is not None:
+            gaussians = compact_gaussians(
+                gaussians, self.compaction, extrinsics, intrinsics, near
+            )
+        return self.decoder.forward(
+            gaussians, extrinsics, intrinsics, near, far, image_shape, depth_mode
+        )
+
+    def render_stream(
+        self,
+        gaussians: Gaussians,
+        cameras: Iterable[CameraChunk],
+        near: Float[Tensor, " batch"],
+        far: Float[Tensor, " batch"],
+        image_shape: tuple[int, int],
+        depth_mode: DepthRenderingMode | None = None,
+    ) -> Iterator[DecoderOutput]:
+        """Render a stream of camera chunks. Every chunk is moved to the CPU before the
+        next one is rendered, so device memory only depends on the chunk size.
+        """
+        for extrinsics, intrinsics in cameras:
+            v = extrinsics.shape[1]
+            output = self.render(
+                gaussians,
+                extrinsics.to(self.device),
+                intrinsics.to(self.device),
+                repeat(near, "b -> b v", v=v),
+                repeat(far, "b -> b v", v=v),
+                image_shape,
+                depth_mode,
+            )
+            yield DecoderOutput(
+                output.color.cpu(),
+                None if output.depth is None else output.depth.cpu(),
+            )
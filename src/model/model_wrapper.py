@@ -20,7 +20,8 @@ from ..dataset import DatasetCfg
 from ..evaluation.metrics import compute_lpips, compute_psnr, compute_ssim
 from ..global_cfg import get_cfg
 from ..loss import Loss
-from ..misc.benchmarker import Benchmarker
+from ..misc.benchmarker import Benchmarker, TimingMode
+from ..misc.depth_io import AsyncDepthWriter
 from ..misc.image_io import prep_image, save_image, save_video
 from ..misc.LocalLogger import LOG_PATH, LocalLogger
 from ..misc.step_tracker import StepTracker
@@ -37,9 +38,12 @@ from ..visualization.color_map import apply_color_map_to_image
 from ..visualization.layout import add_border, hcat, vcat
 from ..visualization import layout
 from ..visualization.validation_in_3d import render_cameras, render_projections
+from .compaction import CompactionCfg, compact_gaussians
 from .decoder.decoder import Decoder, DepthRenderingMode
 from .encoder import Encoder
 from .encoder.visualization.encoder_visualizer import EncoderVisualizer
+from .gaussian_cache import GaussianCache, GaussianCacheCfg
+from .types import Gaussians
 
 from src.model.cameras.noisy_pose_generator import initialize_noisy_poses
 from src.model.ray_diffusion.eval.utils import full_scene_scale
@@ -65,11 +69,15 @@ class TestCfg:
     compute_scores: bool
     save_image: bool
     save_video: bool
+    save_depth: bool
     eval_time_skip_steps: int
     noisy_pose: bool
     noisy_level: float
 
     pred_pose_path: str | None
+    compaction: CompactionCfg | None = None
+    gaussian_cache: GaussianCacheCfg | None = None
+    benchmark_timing: TimingMode = "synchronized"
 
 @dataclass
 class TrainCfg:
@@ -126,14 +134,20 @@ class ModelWrapper(LightningModule):
         self.losses = nn.ModuleList(losses)
 
         # This is used for testing.
-        self.benchmarker = Benchmarker()
+        self.benchmarker = Benchmarker(self.test_cfg.benchmark_timing)
         self.eval_cnt = 0
+        self.gaussian_cache = (
+            None
+            if self.test_cfg.gaussian_cache is None
+            else GaussianCache(self.test_cfg.gaussian_cache)
+        )
+        self.depth_writer = AsyncDepthWriter() if self.test_cfg.save_depth else None
 
         self.max_memory = 0
 
         if self.test_cfg.compute_scores:
             self.test_step_outputs = {}
-            self.time_skip_steps_dict = {"encoder": 0, "decoder": 0}
+            self.time_skip_steps_dict = {}
         
         if self.test_cfg.pred_pose_path is not None:        # TODO PRED POSE
             try:
@@ -145,6 +159,17 @@ class ModelWrapper(LightningModule):
             self.pred_poses = None
 
 
+    def on_train_epoch_start(self) -> None:
+        # Sharded datasets derive their chunk order from the epoch.
+        dataset = self.trainer.train_dataloader.dataset
+        if hasattr(dataset, "set_epoch"):
+            dataset.set_epoch(self.current_epoch)
+
+    def on_validation_epoch_start(self) -> None:
+        # Entries from earlier validation runs were encoded with older weights.
+        if self.gaussian_cache is not None:
+            self.gaussian_cache.clear()
+
     def training_step(self, batch, batch_idx):
         batch: BatchedExample = self.data_shim(batch)
         _, _, _, h, w = batch["target"]["image"].shape
@@ -294,11 +319,8 @@ class ModelWrapper(LightningModule):
 
         # Render Gaussians.
         with self.benchmarker.time("encoder"):
-            gaussians = self.encoder(
-                batch["context"],
-                self.global_step,
-                deterministic=False,
-            )
+            gaussians = self.encode(batch)
+            gaussians = self.compact_gaussians(gaussians, batch["target"])
         with self.benchmarker.time("decoder", num_calls=v):
             output = self.decoder.forward(
                 gaussians,
@@ -307,13 +329,26 @@ class ModelWrapper(LightningModule):
                 batch["target"]["near"],
                 batch["target"]["far"],
                 (h, w),
-                depth_mode=None,
             )
         #! EFFICIENCY
         elapsed_time = time.time() - start_time
-        memory_used = torch.cuda.max_memory_allocated()
+        memory_used = self.benchmarker.get_peak_memory()
         self.max_memory = max(self.max_memory, memory_used)
 
+        # The exported depth is rendered outside of the timed decoder scope, so that
+        # saving depths does not change the reported latency.
+        if self.depth_writer is not None:
+            with self.benchmarker.time("depth_export", num_calls=v):
+                depth = self.decoder.render_depth(
+                    gaussians,
+                    batch["target"]["extrinsics"],
+                    batch["target"]["intrinsics"],
+                    batch["target"]["near"],
+                    batch["target"]["far"],
+                    (h, w),
+                    "depth",
+                )
+
         (scene,) = batch["scene"]
         name = get_cfg()["wandb"]["name"]
         path = self.test_cfg.output_path / name
@@ -325,6 +360,16 @@ class ModelWrapper(LightningModule):
             for index, color in zip(batch["target"]["index"][0], images_prob):
                 save_image(color, path / scene / f"color/{index:0>6}.png")
 
+        # Save depths, written in the background.
+        if self.depth_writer is not None:
+            self.depth_writer.save(
+                path / scene,
+                batch["target"]["index"][0],
+                depth[0],
+                batch["target"]["intrinsics"][0],
+                batch["target"]["extrinsics"][0],
+            )
+
         # save video
         if self.test_cfg.save_video:
             frame_str = "_".join([str(x.item()) for x in batch["context"]["index"][0]])
@@ -336,8 +381,10 @@ class ModelWrapper(LightningModule):
         # compute scores
         if self.test_cfg.compute_scores:
             if batch_idx < self.test_cfg.eval_time_skip_steps:
-                self.time_skip_steps_dict["encoder"] += 1
-                self.time_skip_steps_dict["decoder"] += v
+                self.time_skip_steps_dict = {
+                    tag: len(times)
+                    for tag, times in self.benchmarker.execution_times.items()
+                }
             rgb = images_prob
 
             if f"psnr" not in self.test_step_outputs:
@@ -395,12 +442,16 @@ class ModelWrapper(LightningModule):
 
 
     def on_test_end(self) -> None:
+        if self.depth_writer is not None:
+            self.depth_writer.flush()
         name = get_cfg()["wandb"]["name"]
         out_dir = self.test_cfg.output_path / name
         saved_scores = {}
         if self.test_cfg.compute_scores:
             self.benchmarker.dump_memory(out_dir / "peak_memory.json")
             self.benchmarker.dump(out_dir / "benchmark.json")
+            self.benchmarker.dump_summary(out_dir / "benchmark_summary.json")
+            self.benchmarker.dump_trace(out_dir / "benchmark_trace.json")
 
             for metric_name, metric_scores in self.test_step_outputs.items():
                 avg_scores = sum(metric_scores) / len(metric_scores)
@@ -411,21 +462,27 @@ class ModelWrapper(LightningModule):
                 metric_scores.clear()
 
             for tag, times in self.benchmarker.execution_times.items():
-                times = times[int(self.time_skip_steps_dict[tag]) :]
+                times = times[self.time_skip_steps_dict.get(tag, 0) :]
                 saved_scores[tag] = [len(times), np.mean(times)]
                 print(
                     f"{tag}: {len(times)} calls, avg. {np.mean(times)} seconds per call"
                 )
-                self.time_skip_steps_dict[tag] = 0
 
             with (out_dir / f"scores_all_avg.json").open("w") as f:
                 json.dump(saved_scores, f)
             self.benchmarker.clear_history()
+            self.time_skip_steps_dict = {}
         else:
             self.benchmarker.dump(self.test_cfg.output_path / name / "benchmark.json")
             self.benchmarker.dump_memory(
                 self.test_cfg.output_path / name / "peak_memory.json"
             )
+            self.benchmarker.dump_summary(
+                self.test_cfg.output_path / name / "benchmark_summary.json"
+            )
+            self.benchmarker.dump_trace(
+                self.test_cfg.output_path / name / "benchmark_trace.json"
+            )
             self.benchmarker.summarize()
 
     @rank_zero_only
@@ -442,11 +499,7 @@ class ModelWrapper(LightningModule):
         # Render Gaussians.
         b, _, _, h, w = batch["target"]["image"].shape
         assert b == 1
-        gaussians_softmax = self.encoder(
-            batch["context"],
-            self.global_step,
-            deterministic=False,
-        )
+        gaussians_softmax = self.encode(batch)
         output_softmax = self.decoder.forward(
             gaussians_softmax,
             batch["target"]["extrinsics"],
@@ -610,6 +663,39 @@ class ModelWrapper(LightningModule):
             loop_reverse=False,
         )
 
+    def encode(self, batch: BatchedExample) -> Gaussians:
+        # Gaussians are only reused outside of training, where the encoder output does
+        # not need gradients and the weights are fixed for the current step.
+        if (
+            self.gaussian_cache is None
+            or self.training
+            or torch.is_grad_enabled()
+        ):
+            return self.encoder(batch["context"], self.global_step, deterministic=False)
+
+        key = self.gaussian_cache.get_key(
+            batch["scene"], batch["context"], self.global_step
+        )
+        gaussians = self.gaussian_cache.get(key, self.device)
+        if gaussians is None:
+            gaussians = self.encoder(
+                batch["context"], self.global_step, deterministic=False
+            )
+            self.gaussian_cache.put(key, gaussians)
+        return gaussians
+
+    def compact_gaussians(self, gaussians: Gaussians, target: dict) -> Gaussians:
+        # Compaction only helps rendering, so training always sees the full set.
+        if self.test_cfg.compaction is None:
+            return gaussians
+        return compact_gaussians(
+            gaussians,
+            self.test_cfg.compaction,
+            target["extrinsics"],
+            target["intrinsics"],
+            target["near"],
+        )
+
     @rank_zero_only
     def render_video_generic(
         self,
@@ -621,7 +707,7 @@ class ModelWrapper(LightningModule):
         loop_reverse: bool = True,
     ) -> None:
         # Render probabilistic estimate of scene.
-        gaussians_prob = self.encoder(batch["context"], self.global_step, False)
+        gaussians_prob = self.encode(batch)
         # gaussians_det = self.encoder(batch["context"], self.global_step, True)
 
         t = torch.linspace(0, 1, num_frames, dtype=torch.float32, device=self.device)
@@ -643,6 +729,10 @@ class ModelWrapper(LightningModule):
         # TODO: Interpolate near and far planes?
         near = repeat(batch["context"]["near"][:, 0], "b -> b v", v=num_frames)
         far = repeat(batch["context"]["far"][:, 0], "b -> b v", v=num_frames)
+        gaussians_prob = self.compact_gaussians(
+            gaussians_prob,
+            {"extrinsics": extrinsics, "intrinsics": intrinsics, "near": near},
+        )
         output_prob = self.decoder.forward(
             gaussians_prob, extrinsics, intrinsics, near, far, (h, w), "depth"
         )
@@ -70,12 +70,12 @@ class DiTBlock(nn.Module):
         hidden_size,
         num_heads,
         mlp_ratio=4.0,
-        use_xformers_attention=False,
+        use_memory_efficient_attention=True,
         **block_kwargs
     ):
         super().__init__()
         self.norm1 = nn.LayerNorm(hidden_size, eps=1e-6)
-        attn = MEAttention if use_xformers_attention else Attention
+        attn = MEAttention if use_memory_efficient_attention else Attention
         self.attn = attn(
             hidden_size, num_heads=num_heads, qkv_bias=True, **block_kwargs
         )
@@ -164,19 +164,12 @@ class DiT(nn.Module):
             self.max_num_images, self.hidden_size, self.width**2, P=self.P
         )
 
-        try:
-            import xformers
-            use_xformers_attention = True
-        except ImportError:
-            use_xformers_attention = False
-
         self.blocks = nn.ModuleList(
             [
                 DiTBlock(
                     self.hidden_size,
                     self.num_heads,
                     mlp_ratio=self.mlp_ratio,
-                    use_xformers_attention=use_xformers_attention,
                 )
                 for _ in range(self.depth)
             ]
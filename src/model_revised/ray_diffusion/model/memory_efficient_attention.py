@@ -1,6 +1,6 @@
-import ipdb
 import torch.nn as nn
-from xformers.ops import memory_efficient_attention
+
+from ....model.attention import scaled_dot_product_attention
 
 
 class MEAttention(nn.Module):
@@ -26,6 +26,7 @@ class MEAttention(nn.Module):
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
+        self.attention_backend = "sdpa"
 
     def forward(self, x):
         B, N, C = x.shape
@@ -37,14 +38,10 @@ class MEAttention(nn.Module):
         q, k, v = qkv.unbind(0)
         q, k = self.q_norm(q), self.k_norm(k)
 
-        # MEA expects [B, N, H, D], whereas timm uses [B, H, N, D]
-        x = memory_efficient_attention(
-            q.transpose(1, 2),
-            k.transpose(1, 2),
-            v.transpose(1, 2),
-            scale=self.scale,
+        x = scaled_dot_product_attention(
+            q, k, v, scale=self.scale, backend=self.attention_backend
         )
-        x = x.reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
 
         # Equivalent to doing the following:
         # q = q * self.scale
@@ -0,0 +1,98 @@
+''' Time every stage of the encoder/decoder pipeline on synthetic inputs with random
+    weights, sweeping the number of views, the resolution, the number of depth
+    candidates and the batch size. Results (time percentiles, peak CUDA memory and
+    FLOP estimates) are written to benchmark.output_path as JSON. With
+    benchmark.baseline_path, they are compared against a stored run, and the script
+    fails if a stage got slower or uses more memory than the tolerance allows.
+
+    Usage: python -m src.scripts.benchmark "benchmark.views=[2,4]" \
+               benchmark.baseline_path=benchmarks/baseline.json
+'''
+
+from dataclasses import dataclass
+
+import hydra
+import torch
+from jaxtyping import install_import_hook
+from omegaconf import DictConfig
+
+# Configure beartype and jaxtyping.
+with install_import_hook(
+    ("src",),
+    ("beartype", "beartype"),
+):
+    from src.benchmarks.runner import (
+        BenchmarkCfg,
+        compare_benchmarks,
+        load_benchmarks,
+        run_benchmarks,
+        save_benchmarks,
+    )
+    from src.config import load_typed_config
+    from src.dataset import DatasetCfg
+    from src.global_cfg import set_cfg
+    from src.model.decoder import DecoderCfg
+    from src.model.encoder import EncoderCfg
+
+
+@dataclass
+class ModelCfg:
+    encoder: EncoderCfg
+    decoder: DecoderCfg
+
+
+@dataclass
+class RootCfg:
+    dataset: DatasetCfg
+    model: ModelCfg
+    benchmark: BenchmarkCfg
+    seed: int
+
+
+@hydra.main(
+    version_base=None,
+    config_path="../../config",
+    config_name="benchmark",
+)
+def benchmark(cfg_dict: DictConfig):
+    cfg = load_typed_config(cfg_dict, RootCfg)
+    set_cfg(cfg_dict)
+    torch.manual_seed(cfg.seed)
+
+    if cfg.benchmark.run:
+        results = run_benchmarks(
+            cfg.benchmark, cfg.model.encoder, cfg.model.decoder, cfg.dataset
+        )
+        save_benchmarks(results, cfg.benchmark.output_path)
+    else:
+        results = load_benchmarks(cfg.benchmark.output_path)
+
+    for result in results["results"]:
+        name = "{stage:>16} views={views} {height}x{width} D={depth_candidates} " \
+            "batch={batch_size}".format(**result)
+        if "error" in result:
+            print(f"{name}: {result['error']}")
+        else:
+            memory = result["peak_memory_mb"]
+            memory = "" if memory is None else f", {memory:.1f} MiB"
+            print(
+                f"{name}: {result['time_ms']['p50']:.2f} ms (p90 "
+                f"{result['time_ms']['p90']:.2f}), {result['gflops']:.2f} GFLOP{memory}"
+            )
+
+    if cfg.benchmark.baseline_path is not None:
+        regressions = compare_benchmarks(
+            results,
+            load_benchmarks(cfg.benchmark.baseline_path),
+            cfg.benchmark.tolerance,
+        )
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            raise SystemExit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+    benchmark()
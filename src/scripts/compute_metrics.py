@@ -14,9 +14,15 @@ with install_import_hook(
     ("beartype", "beartype"),
 ):
     from src.config import load_typed_config
+    from src.dataset import get_dataset
     from src.dataset.data_module import DataLoaderCfg, DataModule, DatasetCfg
     from src.evaluation.evaluation_cfg import EvaluationCfg
     from src.evaluation.metric_computer import MetricComputer
+    from src.evaluation.offline_metrics import (
+        OfflineMetricsCfg,
+        compute_offline_metrics,
+        print_metrics,
+    )
     from src.global_cfg import set_cfg
 
 
@@ -27,6 +33,7 @@ class RootCfg:
     data_loader: DataLoaderCfg
     seed: int
     output_metrics_path: Path
+    offline_metrics: OfflineMetricsCfg
 
 
 @hydra.main(
@@ -38,13 +45,32 @@ def evaluate(cfg_dict: DictConfig):
     cfg = load_typed_config(cfg_dict, RootCfg)
     set_cfg(cfg_dict)
     torch.manual_seed(cfg.seed)
-    trainer = Trainer(max_epochs=-1, accelerator="gpu")
-    computer = MetricComputer(cfg.evaluation)
-    data_module = DataModule(cfg.dataset, cfg.data_loader)
-    metrics = trainer.test(computer, datamodule=data_module)
+
+    if cfg.evaluation.side_by_side_path is None:
+        cache_path = cfg.offline_metrics.cache_path
+        if cache_path is None:
+            cache_path = cfg.output_metrics_path.with_name(
+                f"{cfg.output_metrics_path.stem}_scenes"
+            )
+        metrics = compute_offline_metrics(
+            cfg.offline_metrics,
+            cfg.evaluation,
+            get_dataset(cfg.dataset, "test", None),
+            cfg.data_loader.test,
+            cache_path,
+        )
+        if metrics:
+            print_metrics(cfg.evaluation, metrics)
+    else:
+        # Side-by-side comparisons are still rendered by the Lightning module.
+        trainer = Trainer(max_epochs=-1, accelerator="auto")
+        computer = MetricComputer(cfg.evaluation)
+        data_module = DataModule(cfg.dataset, cfg.data_loader)
+        metrics = trainer.test(computer, datamodule=data_module)[0]
+
     cfg.output_metrics_path.parent.mkdir(exist_ok=True, parents=True)
     with cfg.output_metrics_path.open("w") as f:
-        json.dump(metrics[0], f)
+        json.dump(metrics, f)
 
 
 if __name__ == "__main__":
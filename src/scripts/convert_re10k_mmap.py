@@ -0,0 +1,114 @@
+''' Convert RE10k/ACID .torch chunks (JPEG bytes inside pickles) into the pre-decoded,
+    memory-mapped layout read by DatasetRE10kMmap.
+
+    For every <stage>/<chunk>.torch this writes <stage>/<chunk>.bin, holding one aligned
+    block per scene (float32 cameras followed by decoded uint8 frames), and
+    <stage>/<chunk>.json, the table of SceneRecords locating those blocks. index.json is
+    rewritten to map every scene key to its chunk table, and scene_index.json maps every
+    key straight to its block and frame offsets. Pass --index_only to (re)build
+    scene_index.json for an already converted directory.
+
+    Usage: python -m src.scripts.convert_re10k_mmap --input_dir datasets/re10k \
+               --output_dir datasets/re10k_mmap
+'''
+
+import argparse
+import json
+from io import BytesIO
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+from src.dataset.dataset_re10k_mmap import (
+    SceneRecord,
+    build_scene_index,
+    get_block_padding,
+    get_camera_bytes,
+    save_chunk_table,
+    save_scene_index,
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--input_dir", type=str, help="directory with train/test chunks")
+parser.add_argument("--output_dir", type=str, help="output directory")
+parser.add_argument("--stages", type=str, nargs="+", default=["train", "test"])
+parser.add_argument("--num_workers", type=int, default=8)
+parser.add_argument("--index_only", action="store_true")
+args = parser.parse_args()
+
+INPUT_DIR = Path(args.input_dir)
+OUTPUT_DIR = Path(args.output_dir)
+
+
+def decode_image(image: torch.Tensor) -> np.ndarray:
+    image = Image.open(BytesIO(image.numpy().tobytes())).convert("RGB")
+    return np.asarray(image, dtype=np.uint8)
+
+
+def convert_chunk(paths: tuple[Path, Path]) -> list[str]:
+    chunk_path, output_stage_dir = paths
+    chunk = torch.load(chunk_path)
+    bin_path = output_stage_dir / f"{chunk_path.stem}.bin"
+
+    table = []
+    offset = 0
+    with bin_path.open("wb") as f:
+        for example in chunk:
+            cameras = example["cameras"].numpy().astype(np.float32)
+            frames = np.stack([decode_image(image) for image in example["images"]])
+            num_frames = frames.shape[0]
+            assert cameras.shape == (num_frames, 18)
+
+            length = get_camera_bytes(num_frames) + frames.nbytes
+            f.write(cameras.tobytes())
+            f.write(frames.tobytes())
+            padding = get_block_padding(length)
+            f.write(b"\0" * padding)
+
+            table.append(
+                SceneRecord(
+                    key=example["key"],
+                    offset=offset,
+                    length=length,
+                    num_frames=num_frames,
+                    frame_shape=tuple(frames.shape[1:]),
+                )
+            )
+            offset += length + padding
+
+    save_chunk_table(output_stage_dir / f"{chunk_path.stem}.json", table)
+    return [record.key for record in table]
+
+
+if __name__ == "__main__":
+    for stage in args.stages:
+        input_stage_dir = INPUT_DIR / stage
+        output_stage_dir = OUTPUT_DIR / stage
+        output_stage_dir.mkdir(exist_ok=True, parents=True)
+
+        if args.index_only:
+            save_scene_index(output_stage_dir, build_scene_index(output_stage_dir))
+            continue
+
+        chunk_paths = sorted(
+            path for path in input_stage_dir.iterdir() if path.suffix == ".torch"
+        )
+        jobs = [(path, output_stage_dir) for path in chunk_paths]
+
+        index = {}
+        with Pool(args.num_workers) as pool:
+            converted = pool.imap(convert_chunk, jobs)
+            for chunk_path, keys in tqdm(
+                zip(chunk_paths, converted), total=len(jobs), desc=f"Converting {stage}"
+            ):
+                for key in keys:
+                    index[key] = f"{chunk_path.stem}.json"
+
+        with (output_stage_dir / "index.json").open("w") as f:
+            json.dump(index, f)
+
+        save_scene_index(output_stage_dir, build_scene_index(output_stage_dir))
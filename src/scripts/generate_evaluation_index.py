@@ -4,7 +4,6 @@ import hydra
 import torch
 from jaxtyping import install_import_hook
 from omegaconf import DictConfig
-from pytorch_lightning import Trainer
 
 # Configure beartype and jaxtyping.
 with install_import_hook(
@@ -12,11 +11,12 @@ with install_import_hook(
     ("beartype", "beartype"),
 ):
     from src.config import load_typed_config
-    from src.dataset import DatasetCfg
-    from src.dataset.data_module import DataLoaderCfg, DataModule
+    from src.dataset import DatasetCfg, get_dataset
+    from src.dataset.data_module import DataLoaderCfg
     from src.evaluation.evaluation_index_generator import (
-        EvaluationIndexGenerator,
         EvaluationIndexGeneratorCfg,
+        generate_evaluation_index,
+        save_index,
     )
     from src.global_cfg import set_cfg
 
@@ -38,11 +38,12 @@ def train(cfg_dict: DictConfig):
     cfg = load_typed_config(cfg_dict, RootCfg)
     set_cfg(cfg_dict)
     torch.manual_seed(cfg.seed)
-    trainer = Trainer(max_epochs=1, accelerator="gpu", devices="auto", strategy="auto")
-    data_module = DataModule(cfg.dataset, cfg.data_loader, None)
-    evaluation_index_generator = EvaluationIndexGenerator(cfg.index_generator)
-    trainer.test(evaluation_index_generator, datamodule=data_module)
-    evaluation_index_generator.save_index()
+    index = generate_evaluation_index(
+        cfg.index_generator,
+        get_dataset(cfg.dataset, "test", None),
+        cfg.data_loader.test.num_workers,
+    )
+    save_index(index, cfg.index_generator.output_path)
 
 
 if __name__ == "__main__":
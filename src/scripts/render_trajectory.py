@@ -0,0 +1,174 @@
+''' Render a camera trajectory through a scene without the Lightning test loop. The
+    context views are encoded once, then the trajectory is generated and rendered in
+    chunks of chunk_size frames that are written out as they arrive, so memory does not
+    grow with num_frames.
+
+    Usage: python -m src.scripts.render_trajectory +experiment=re10k \
+               checkpoint_path=checkpoints/re10k.ckpt trajectory=wobble num_frames=600
+'''
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Literal
+
+import hydra
+import skvideo.io
+import torch
+from jaxtyping import install_import_hook
+from omegaconf import DictConfig
+from torch.utils.data import default_collate
+from tqdm import tqdm
+
+# Configure beartype and jaxtyping.
+with install_import_hook(
+    ("src",),
+    ("beartype", "beartype"),
+):
+    from src.config import load_typed_config
+    from src.dataset import DatasetCfg, MapStyleWrapper, get_dataset
+    from src.dataset.types import BatchedViews
+    from src.global_cfg import set_cfg
+    from src.misc.image_io import prep_image, save_image
+    from src.model.compaction import CompactionCfg
+    from src.model.decoder import DecoderCfg
+    from src.model.encoder import EncoderCfg
+    from src.model.inference import CameraChunk, InferenceModel
+    from src.visualization.camera_trajectory.interpolation import (
+        interpolate_extrinsics,
+        interpolate_intrinsics,
+    )
+    from src.visualization.camera_trajectory.wobble import generate_wobble
+
+
+@dataclass
+class ModelCfg:
+    encoder: EncoderCfg
+    decoder: DecoderCfg
+
+
+@dataclass
+class RootCfg:
+    dataset: DatasetCfg
+    model: ModelCfg
+    checkpoint_path: Path
+    scene: str | None
+    trajectory: Literal["interpolation", "wobble"]
+    num_frames: int
+    chunk_size: int
+    smooth: bool
+    compaction: CompactionCfg | None
+    save_frames: bool
+    output_path: Path
+    seed: int
+
+
+def get_example(cfg: RootCfg) -> dict:
+    """Load the requested scene of the test split, or its first example if no scene
+    is given.
+    """
+    dataset = get_dataset(cfg.dataset, "test", None)
+    if isinstance(dataset, MapStyleWrapper):
+        dataset = dataset.dataset
+    if cfg.scene is None:
+        example = next(iter(dataset), None)
+        if example is None:
+            raise ValueError("The test split does not contain any valid examples.")
+        return example
+
+    if cfg.scene not in dataset.index:
+        raise ValueError(f'Scene "{cfg.scene}" is not in the test split.')
+    example = dataset.get_example(dataset.load_scene(cfg.scene), 0)
+    if example is None:
+        raise ValueError(f'The view sampler cannot sample scene "{cfg.scene}".')
+    return example
+
+
+def get_trajectory(
+    context: BatchedViews,
+    trajectory: Literal["interpolation", "wobble"],
+    t: torch.Tensor,
+) -> CameraChunk:
+    # These match the validation videos in ModelWrapper.
+    if trajectory == "wobble":
+        origin_a = context["extrinsics"][:, 0, :3, 3]
+        origin_b = context["extrinsics"][:, -1, :3, 3]
+        delta = (origin_a - origin_b).norm(dim=-1)
+        extrinsics = generate_wobble(context["extrinsics"][:, 0], delta * 0.25, t)
+        intrinsics = context["intrinsics"][:, :1].expand(-1, t.shape[0], -1, -1)
+        return extrinsics, intrinsics
+
+    extrinsics = interpolate_extrinsics(
+        context["extrinsics"][0, 0], context["extrinsics"][0, -1], t
+    )
+    intrinsics = interpolate_intrinsics(
+        context["intrinsics"][0, 0], context["intrinsics"][0, -1], t
+    )
+    return extrinsics[None].float(), intrinsics[None].float()
+
+
+def generate_trajectory_chunks(
+    context: BatchedViews,
+    cfg: RootCfg,
+) -> Iterator[CameraChunk]:
+    t = torch.linspace(0, 1, cfg.num_frames, dtype=torch.float32)
+    if cfg.smooth:
+        t = (torch.cos(torch.pi * (t + 1)) + 1) / 2
+    for t_chunk in t.split(cfg.chunk_size):
+        yield get_trajectory(context, cfg.trajectory, t_chunk.to(context["image"].device))
+
+
+@hydra.main(
+    version_base=None,
+    config_path="../../config",
+    config_name="render_trajectory",
+)
+@torch.no_grad()
+def render_trajectory(cfg_dict: DictConfig):
+    cfg = load_typed_config(cfg_dict, RootCfg)
+    set_cfg(cfg_dict)
+    torch.manual_seed(cfg.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    model = InferenceModel.from_checkpoint(
+        cfg.checkpoint_path,
+        cfg.model.encoder,
+        cfg.model.decoder,
+        cfg.dataset,
+        cfg.compaction,
+    ).to(device)
+
+    example = get_example(cfg)
+    batch = default_collate([example])
+    context = {key: value.to(device) for key, value in batch["context"].items()}
+
+    gaussians = model.encode(context)
+    _, _, _, h, w = context["image"].shape
+    chunks = model.render_stream(
+        gaussians,
+        generate_trajectory_chunks(context, cfg),
+        context["near"][:, 0],
+        context["far"][:, 0],
+        (h, w),
+    )
+
+    path = cfg.output_path / example["scene"]
+    path.mkdir(exist_ok=True, parents=True)
+    writer = skvideo.io.FFmpegWriter(
+        path / f"{cfg.trajectory}.mp4",
+        outputdict={"-pix_fmt": "yuv420p", "-crf": "21"},
+    )
+    index = 0
+    with tqdm(total=cfg.num_frames, desc=example["scene"]) as progress:
+        for output in chunks:
+            for frame in output.color[0]:
+                writer.writeFrame(prep_image(frame))
+                if cfg.save_frames:
+                    save_image(frame, path / "frames" / f"{index:0>6}.png")
+                index += 1
+            progress.update(output.color.shape[1])
+    writer.close()
+
+
+if __name__ == "__main__":
+    torch.set_float32_matmul_precision("high")
+    render_trajectory()
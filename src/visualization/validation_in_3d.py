@@ -3,6 +3,7 @@ from jaxtyping import Float, Shaped
 from torch import Tensor
 
 from ..model.decoder.cuda_splatting import render_cuda_orthographic
+from ..model.decoder.torch_splatting import render_torch_orthographic
 from ..model.types import Gaussians
 from ..visualization.annotation import add_label
 from ..visualization.drawing.cameras import draw_cameras
@@ -65,7 +66,13 @@ def render_projections(
         width = extents[:, right_axis]
         height = extents[:, down_axis]
 
-        projection = render_cuda_orthographic(
+        # The CUDA rasterizer only runs on the GPU.
+        render = (
+            render_cuda_orthographic
+            if device.type == "cuda"
+            else render_torch_orthographic
+        )
+        projection = render(
             extrinsics,
             width,
             height,
@@ -0,0 +1,154 @@
+import pytest
+import torch
+
+from src.model.attention import (
+    attention_math,
+    scaled_dot_product_attention,
+    set_attention_backend,
+)
+from src.model.encoder.backbone.multiview_transformer import (
+    MultiViewFeatureTransformer,
+    single_head_full_attention,
+)
+from src.model.encoder.costvolume.ldm_unet.attention import (
+    CrossAttention,
+    SpatialSelfAttention,
+)
+from src.model.encoder.costvolume.ldm_unet.unet import (
+    CrossAttentionBlock,
+    QKVAttention,
+    QKVAttentionLegacy,
+)
+from src.model.ray_diffusion.model.memory_efficient_attention import MEAttention
+
+ATOL = 1e-5
+
+
+def compare_backends(module, *inputs, atol=1e-4):
+    """Run a module under both backends with the same weights and inputs."""
+    module = module.eval()
+    with torch.no_grad():
+        set_attention_backend(module, "math")
+        expected = module(*inputs)
+        set_attention_backend(module, "sdpa")
+        actual = module(*inputs)
+    if isinstance(expected, (list, tuple)):
+        for e, a in zip(expected, actual):
+            torch.testing.assert_close(a, e, atol=atol, rtol=0)
+    else:
+        torch.testing.assert_close(actual, expected, atol=atol, rtol=0)
+
+
+@pytest.mark.parametrize("mask", [None, "bool", "float"])
+def test_scaled_dot_product_attention(mask):
+    generator = torch.Generator().manual_seed(0)
+    q = torch.randn(2, 3, 17, 8, generator=generator)
+    k = torch.randn(2, 3, 23, 8, generator=generator)
+    v = torch.randn(2, 3, 23, 5, generator=generator)
+    if mask == "bool":
+        attn_mask = torch.rand(2, 1, 17, 23, generator=generator) > 0.3
+        attn_mask[..., 0] = True
+    elif mask == "float":
+        attn_mask = torch.randn(2, 1, 17, 23, generator=generator)
+    else:
+        attn_mask = None
+
+    for scale in (None, 0.2):
+        expected = attention_math(q, k, v, attn_mask, scale)
+        for backend in ("sdpa", "math"):
+            actual = scaled_dot_product_attention(
+                q, k, v, attn_mask, scale, backend=backend
+            )
+            torch.testing.assert_close(actual, expected, atol=ATOL, rtol=0)
+
+
+def test_single_head_full_attention():
+    generator = torch.Generator().manual_seed(0)
+    q, k, v = torch.randn(3, 2, 40, 16, generator=generator)
+    expected = single_head_full_attention(q, k, v, backend="math")
+    actual = single_head_full_attention(q, k, v, backend="sdpa")
+    torch.testing.assert_close(actual, expected, atol=ATOL, rtol=0)
+
+
+# Every second layer uses shifted windows and the shift mask. Multi-head windows
+# only take two views.
+@pytest.mark.parametrize(
+    "num_views, nhead, attn_num_splits",
+    [(2, 1, 2), (3, 1, 2), (2, 2, 2), (3, 1, 4)],
+)
+def test_multiview_transformer(num_views, nhead, attn_num_splits):
+    torch.manual_seed(0)
+    model = MultiViewFeatureTransformer(num_layers=2, d_model=32, nhead=nhead)
+    features = [torch.randn(2, 32, 8, 12) for _ in range(num_views)]
+    compare_backends(model, features, attn_num_splits)
+
+
+def test_spatial_self_attention():
+    torch.manual_seed(0)
+    compare_backends(SpatialSelfAttention(32), torch.randn(2, 32, 6, 7))
+
+
+@pytest.mark.parametrize("with_mask", [False, True])
+def test_cross_attention(with_mask):
+    torch.manual_seed(0)
+    model = CrossAttention(24, context_dim=16, heads=3, dim_head=8)
+    x = torch.randn(2, 11, 24)
+    context = torch.randn(2, 9, 16)
+    mask = None
+    if with_mask:
+        mask = torch.rand(2, 9) > 0.4
+        mask[:, 0] = True
+    model.eval()
+    with torch.no_grad():
+        set_attention_backend(model, "math")
+        expected = model(x, context, mask)
+        set_attention_backend(model, "sdpa")
+        actual = model(x, context, mask)
+    torch.testing.assert_close(actual, expected, atol=ATOL, rtol=0)
+
+
+@pytest.mark.parametrize("num_heads", [1, 4])
+def test_cross_attention_block(num_heads):
+    torch.manual_seed(0)
+    model = CrossAttentionBlock(16, 8, num_heads=num_heads, proj_channels=32)
+    # The output projection is zero-initialized, which would hide the attention.
+    torch.nn.init.normal_(model.out_proj.weight)
+    x = torch.randn(2, 16, 3, 4, 5)
+    y = torch.randn(2, 7, 3, 8)
+    compare_backends(model, x, y)
+
+
+@pytest.mark.parametrize("use_cross_view_self_attn", [False, True])
+def test_qkv_attention_legacy(use_cross_view_self_attn):
+    torch.manual_seed(0)
+    model = QKVAttentionLegacy(
+        2, n_frames=2, use_cross_view_self_attn=use_cross_view_self_attn
+    )
+    compare_backends(model, torch.randn(4, 3 * 2 * 8, 15))
+
+
+def test_qkv_attention():
+    torch.manual_seed(0)
+    compare_backends(QKVAttention(2), torch.randn(3, 3 * 2 * 8, 15))
+
+
+def test_me_attention():
+    torch.manual_seed(0)
+    compare_backends(MEAttention(32, num_heads=4, qk_norm=True), torch.randn(2, 13, 32))
+
+
+def test_set_attention_backend_is_per_model():
+    a = MultiViewFeatureTransformer(num_layers=2, d_model=32)
+    b = MultiViewFeatureTransformer(num_layers=2, d_model=32)
+    set_attention_backend(a, "math")
+    set_attention_backend(b, "sdpa")
+    assert all(
+        layer.attention_backend == "math"
+        for layer in a.modules()
+        if hasattr(layer, "attention_backend")
+    )
+    assert all(
+        layer.attention_backend == "sdpa"
+        for layer in b.modules()
+        if hasattr(layer, "attention_backend")
+    )
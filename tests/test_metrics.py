@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+import torch
+from skimage.metrics import structural_similarity
+
+from src.evaluation.metrics import compute_ssim
+
+
+def compute_ssim_skimage(ground_truth, predicted):
+    return np.array(
+        [
+            structural_similarity(
+                gt,
+                hat,
+                win_size=11,
+                gaussian_weights=True,
+                channel_axis=0,
+                data_range=1.0,
+            )
+            for gt, hat in zip(ground_truth.numpy(), predicted.numpy())
+        ]
+    )
+
+
+@pytest.mark.parametrize("shape", [(3, 1, 32, 40), (4, 3, 64, 80)])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float64])
+def test_compute_ssim(shape, dtype):
+    generator = torch.Generator().manual_seed(0)
+    ground_truth = torch.rand(shape, generator=generator, dtype=dtype)
+    noise = torch.randn(shape, generator=generator, dtype=dtype)
+    predicted = (ground_truth + 0.1 * noise).clip(0, 1)
+
+    expected = compute_ssim_skimage(ground_truth.double(), predicted.double())
+    actual = compute_ssim(ground_truth, predicted)
+    assert actual.dtype == dtype
+    atol = 1e-5 if dtype == torch.float32 else 1e-10
+    np.testing.assert_allclose(actual.numpy(), expected, rtol=0, atol=atol)
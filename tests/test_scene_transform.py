@@ -0,0 +1,118 @@
+import cv2
+import numpy as np
+import pytest
+import torch
+from transforms3d.quaternions import mat2quat
+
+from src.dataset.scene_transform import get_boundingbox, normalize_cameras
+
+IMAGE_SHAPE = (512, 640)
+
+
+def load_K_Rt_from_P(P):
+    # The per-view decomposition DatasetDTU used before normalize_cameras.
+    out = cv2.decomposeProjectionMatrix(P)
+    K = out[0]
+    R = out[1]
+    t = out[2]
+
+    K = K / K[2, 2]
+    intrinsics = np.eye(4)
+    intrinsics[:3, :3] = K
+
+    pose = np.eye(4, dtype=np.float32)
+    pose[:3, :3] = R.transpose()
+    pose[:3, 3] = (t[:3] / t[3])[:, 0]
+
+    return intrinsics, pose
+
+
+def cal_scale_mat(img_hw, intrinsics, extrinsics, near_fars, factor=1.0):
+    center, radius, _ = get_boundingbox(img_hw, intrinsics, extrinsics, near_fars)
+
+    radius = radius * factor
+    scale_mat = np.diag([radius, radius, radius, 1.0])
+    scale_mat[:3, 3] = center.cpu().numpy()
+    scale_mat = scale_mat.astype(np.float32)
+
+    return scale_mat, 1.0 / radius.cpu().numpy()
+
+
+def normalize_cameras_loop(intrinsics, w2cs, near_fars, factor):
+    scale_mat, scale_factor = cal_scale_mat(
+        IMAGE_SHAPE, intrinsics, w2cs, near_fars, factor=factor
+    )
+    c2ws, new_w2cs, qs, origins, new_near_fars = [], [], [], [], []
+    for i, (intrinsic, extrinsic) in enumerate(zip(intrinsics, w2cs)):
+        P = (intrinsic @ extrinsic @ scale_mat)[:3, :4]
+        c2w = load_K_Rt_from_P(P)[1]
+        camera_o = c2w[:3, 3].copy()
+        if i == 0:
+            camera_o_canonical = camera_o.copy()
+        c2w[:3, 3] -= camera_o_canonical
+        w2c = np.linalg.inv(c2w)
+
+        c2ws.append(c2w)
+        new_w2cs.append(w2c)
+        qs.append(mat2quat(w2c[:3, :3]))
+        origins.append(camera_o)
+        dist = np.sqrt(np.sum(camera_o**2))
+        near = dist - 1 if dist > 1 else 0.1
+        far = dist + 1
+        new_near_fars.append([0.95 * near, 1.05 * far])
+    return scale_mat, scale_factor, c2ws, new_w2cs, qs, origins, new_near_fars
+
+
+def random_rotation(rng):
+    q, r = np.linalg.qr(rng.normal(size=(3, 3)))
+    q = q * np.sign(np.diag(r))
+    return q if np.linalg.det(q) > 0 else -q
+
+
+def get_dtu_like_rig(rng, num_views):
+    """Cameras about 600 mm from the origin looking at it, with w2c extrinsics
+    relative to the first view, like DatasetDTU builds them.
+    """
+    intrinsics, extrinsics = [], []
+    for _ in range(num_views):
+        k = np.eye(4, dtype=np.float32)
+        k[0, 0] = k[1, 1] = rng.uniform(1000, 1200)
+        k[0, 2], k[1, 2] = rng.uniform(300, 340), rng.uniform(240, 270)
+        w2c = np.eye(4)
+        w2c[:3, :3] = random_rotation(rng)
+        w2c[:3, 3] = rng.normal(size=3) * 50 + (0, 0, 600)
+        intrinsics.append(k)
+        extrinsics.append(w2c)
+    ref_inv = np.linalg.inv(extrinsics[0])
+    w2cs = [(w2c @ ref_inv).astype(np.float32) for w2c in extrinsics]
+    near_fars = [np.array([425.0, 905.0], dtype=np.float32) for _ in range(num_views)]
+    return intrinsics, w2cs, near_fars
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_normalize_cameras_matches_loop(seed):
+    rng = np.random.default_rng(seed)
+    intrinsics, w2cs, near_fars = get_dtu_like_rig(rng, int(rng.integers(2, 12)))
+    expected = normalize_cameras_loop(intrinsics, w2cs, near_fars, factor=1.1)
+    scale_mat, scale_factor, c2ws, new_w2cs, qs, origins, new_near_fars = expected
+
+    cameras = normalize_cameras(
+        IMAGE_SHAPE,
+        torch.from_numpy(np.stack(intrinsics)),
+        torch.from_numpy(np.stack(w2cs)),
+        torch.from_numpy(np.stack(near_fars)),
+        factor=1.1,
+    )
+
+    def check(actual, expected, atol):
+        np.testing.assert_allclose(
+            actual.numpy(), np.asarray(expected), rtol=1e-5, atol=atol
+        )
+
+    check(cameras.scale_mat, scale_mat, 1e-3)
+    check(cameras.scale_factor, scale_factor, 1e-8)
+    check(cameras.c2ws, c2ws, 1e-5)
+    check(cameras.w2cs, new_w2cs, 1e-5)
+    check(cameras.quaternions, qs, 1e-5)
+    check(cameras.origins, origins, 1e-5)
+    check(cameras.near_fars, new_near_fars, 1e-5)
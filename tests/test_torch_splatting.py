@@ -0,0 +1,135 @@
+from math import ceil, isqrt
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from src.model.decoder.torch_splatting import (
+    MAX_ALPHA,
+    MIN_ALPHA,
+    MIN_TRANSMITTANCE,
+    NEAR_PLANE,
+    evaluate_sh,
+    rasterize_gaussians,
+)
+
+
+def rasterize_naive(
+    w2c, tan_fov_x, tan_fov_y, image_shape, background_color, means, covariances,
+    shs, opacities, tile_size,
+):
+    """Composite one Gaussian at a time over all pixels, in depth order. A Gaussian
+    only reaches the pixels of the screen tiles its 3-sigma rectangle overlaps, as in
+    the CUDA rasterizer.
+    """
+    h, w = image_shape
+    focal_x = w / (2 * tan_fov_x)
+    focal_y = h / (2 * tan_fov_y)
+    ys, xs = torch.meshgrid(
+        torch.arange(h, dtype=torch.float64),
+        torch.arange(w, dtype=torch.float64),
+        indexing="ij",
+    )
+    tile_x = (xs // tile_size).long()
+    tile_y = (ys // tile_size).long()
+    tiles_x, tiles_y = ceil(w / tile_size), ceil(h / tile_size)
+
+    camera_center = w2c.inverse()[:3, 3]
+    colors = evaluate_sh(
+        isqrt(shs.shape[1]) - 1, shs, F.normalize(means - camera_center, dim=-1)
+    )
+    xyz = means @ w2c[:3, :3].T + w2c[:3, 3]
+
+    image = torch.zeros((h, w, 3), dtype=torch.float64)
+    transmittance = torch.ones((h, w), dtype=torch.float64)
+    done = torch.zeros((h, w), dtype=torch.bool)
+    for g in xyz[:, 2].argsort().tolist():
+        x, y, z = xyz[g].tolist()
+        if z <= NEAR_PLANE:
+            continue
+        tx = min(max(x / z, -1.3 * tan_fov_x), 1.3 * tan_fov_x) * z
+        ty = min(max(y / z, -1.3 * tan_fov_y), 1.3 * tan_fov_y) * z
+        jacobian = torch.tensor(
+            [
+                [focal_x / z, 0, -focal_x * tx / z**2],
+                [0, focal_y / z, -focal_y * ty / z**2],
+            ],
+            dtype=torch.float64,
+        )
+        t = jacobian @ w2c[:3, :3]
+        cov = t @ covariances[g] @ t.T
+        a, b, c = cov[0, 0] + 0.3, cov[0, 1], cov[1, 1] + 0.3
+        det = a * c - b * b
+        if det == 0:
+            continue
+        mid = 0.5 * (a + c)
+        radius = (3 * (mid + (mid * mid - det).clamp(min=0.1).sqrt()).sqrt()).ceil()
+        px = focal_x * x / z + 0.5 * w - 0.5
+        py = focal_y * y / z + 0.5 * h - 0.5
+
+        x_min = min(max(int((px - radius) // tile_size), 0), tiles_x)
+        x_max = min(max(int((px + radius + tile_size - 1) // tile_size), 0), tiles_x)
+        y_min = min(max(int((py - radius) // tile_size), 0), tiles_y)
+        y_max = min(max(int((py + radius + tile_size - 1) // tile_size), 0), tiles_y)
+        covered = (tile_x >= x_min) & (tile_x < x_max)
+        covered &= (tile_y >= y_min) & (tile_y < y_max)
+
+        dx, dy = px - xs, py - ys
+        power = -0.5 * (c * dx * dx + a * dy * dy) / det + b * dx * dy / det
+        alpha = (opacities[g] * power.exp()).clamp(max=MAX_ALPHA)
+        contributes = covered & ~done & (power <= 0) & (alpha >= MIN_ALPHA)
+        next_transmittance = transmittance * (1 - alpha)
+        done |= contributes & (next_transmittance < MIN_TRANSMITTANCE)
+        contributes &= next_transmittance >= MIN_TRANSMITTANCE
+
+        weight = torch.where(contributes, alpha * transmittance, 0)
+        image += weight[..., None] * colors[g]
+        transmittance = torch.where(contributes, next_transmittance, transmittance)
+
+    image += transmittance[..., None] * background_color
+    return image.permute(2, 0, 1)
+
+
+def get_scene(num_gaussians, sh_degree, seed):
+    generator = torch.Generator().manual_seed(seed)
+
+    def rand(*shape):
+        return torch.rand(shape, generator=generator, dtype=torch.float64)
+
+    means = (rand(num_gaussians, 3) - 0.5) * torch.tensor([2.0, 1.5, 2.0])
+    means[:, 2] += 3
+    rotations = torch.linalg.qr(rand(num_gaussians, 3, 3) - 0.5).Q
+    scales = rand(num_gaussians, 3) * 0.08 + 0.005
+    covariances = rotations @ torch.diag_embed(scales**2) @ rotations.transpose(-1, -2)
+    shs = (rand(num_gaussians, (sh_degree + 1) ** 2, 3) - 0.5) * 0.6
+    opacities = rand(num_gaussians) * 0.98 + 0.01
+
+    w2c = torch.eye(4, dtype=torch.float64)
+    w2c[:3, 3] = torch.tensor([0.1, -0.05, 0.2])
+    return w2c, means, covariances, shs, opacities
+
+
+@pytest.mark.parametrize("tile_size", [16, 8, 12])
+@pytest.mark.parametrize("sh_degree", [0, 3])
+def test_rasterize_gaussians_matches_naive(tile_size, sh_degree):
+    w2c, means, covariances, shs, opacities = get_scene(400, sh_degree, seed=tile_size)
+    image_shape = (40, 72)
+    background = torch.tensor([0.2, 0.4, 0.6], dtype=torch.float64)
+    args = (w2c, 0.45, 0.3, image_shape, background, means, covariances, shs, opacities)
+
+    actual = rasterize_gaussians(*args, tile_size=tile_size)
+    expected = rasterize_naive(*args, tile_size=tile_size)
+    torch.testing.assert_close(actual, expected, rtol=0, atol=1e-6)
+
+
+def test_rasterize_gaussians_gradients():
+    w2c, means, covariances, shs, opacities = get_scene(100, 1, seed=0)
+    means.requires_grad_()
+    opacities.requires_grad_()
+    background = torch.zeros(3, dtype=torch.float64)
+    image = rasterize_gaussians(
+        w2c, 0.45, 0.3, (24, 32), background, means, covariances, shs, opacities
+    )
+    image.sum().backward()
+    assert means.grad.abs().sum() > 0
+    assert opacities.grad.abs().sum() > 0
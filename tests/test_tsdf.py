@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+import torch
+
+from src.fusion.sparse_tsdf import SparseTSDFVolume
+from src.fusion.tsdf import TSDFVolumeTorch
+from tsdf_fusion import TSDFVolume
+
+BOUNDS = np.array([[-1.3, 1.3]] * 3)
+VOXEL_SIZE = 0.1
+MARGIN = 3
+
+
+def look_at(eye):
+    z = -eye / np.linalg.norm(eye)
+    x = np.cross(np.array([0.0, 1.0, 0.0]), z)
+    x /= np.linalg.norm(x)
+    pose = np.eye(4)
+    pose[:3, 0], pose[:3, 1], pose[:3, 2], pose[:3, 3] = x, np.cross(z, x), z, eye
+    return pose
+
+
+def render_unit_sphere(pose, intrinsics, h, w):
+    """Z-depth of a unit sphere at the origin, 0 where the rays miss it."""
+    u, v = np.meshgrid(np.arange(w), np.arange(h))
+    directions = np.stack(
+        [
+            (u - intrinsics[0, 2]) / intrinsics[0, 0],
+            (v - intrinsics[1, 2]) / intrinsics[1, 1],
+            np.ones((h, w)),
+        ],
+        axis=-1,
+    ) @ pose[:3, :3].T
+    origin = pose[:3, 3]
+    a = (directions**2).sum(axis=-1)
+    b = 2 * directions @ origin
+    c = origin @ origin - 1
+    discriminant = b * b - 4 * a * c
+    t = (-b - np.sqrt(np.maximum(discriminant, 0))) / (2 * a)
+    return np.where(discriminant > 0, t, 0).astype(np.float32)
+
+
+def get_frames(num_frames=6, h=30, w=40, seed=0):
+    """Views of a unit sphere with random colors from a ring of cameras."""
+    rng = np.random.default_rng(seed)
+    intrinsics = np.array([[35.0, 0, w / 2], [0, 35.0, h / 2], [0, 0, 1]])
+    frames = []
+    for i in range(num_frames):
+        angle = 2 * np.pi * i / num_frames
+        pose = look_at(np.array([3 * np.cos(angle), 0.5, 3 * np.sin(angle)]))
+        color = rng.integers(0, 256, (h, w, 3)).astype(np.float32)
+        depth = render_unit_sphere(pose, intrinsics, h, w)
+        frames.append((color, depth, intrinsics.copy(), pose))
+    return frames
+
+
+def unfold_color(color_vol):
+    b = np.floor(color_vol / (256 * 256))
+    g = np.floor((color_vol - b * 256 * 256) / 256)
+    r = color_vol - b * 256 * 256 - g * 256
+    return np.stack([r, g, b], axis=-1)
+
+
+@pytest.mark.parametrize("block_size", [7, 32])
+def test_tsdf_torch_matches_cpu(block_size):
+    frames = get_frames()
+    expected = TSDFVolume(BOUNDS.copy(), VOXEL_SIZE, use_gpu=False, margin=MARGIN)
+    for frame in frames:
+        expected.integrate(*frame)
+    actual = TSDFVolumeTorch(
+        BOUNDS.copy(), VOXEL_SIZE, margin=MARGIN, device="cpu", block_size=block_size
+    )
+    for frame in frames:
+        actual.integrate(*frame)
+
+    expected_tsdf, expected_color, expected_weight = expected.get_volume()
+    actual_tsdf, actual_color, actual_weight = actual.get_volume()
+    assert (expected_weight > 0).any()
+    np.testing.assert_array_equal(actual_weight, expected_weight)
+    np.testing.assert_allclose(actual_tsdf, expected_tsdf, rtol=0, atol=1e-5)
+    np.testing.assert_array_equal(actual_color, unfold_color(expected_color))
+
+
+def test_tsdf_torch_batched_matches_sequential():
+    frames = get_frames()
+    sequential = TSDFVolumeTorch(BOUNDS.copy(), VOXEL_SIZE, margin=MARGIN, device="cpu")
+    for frame in frames:
+        sequential.integrate(*frame)
+    batched = TSDFVolumeTorch(
+        BOUNDS.copy(), VOXEL_SIZE, margin=MARGIN, device="cpu", block_size=7
+    )
+    batched.integrate_batch(*[np.stack(x) for x in zip(*frames)])
+
+    sequential_tsdf, sequential_color, sequential_weight = sequential.get_volume()
+    batched_tsdf, batched_color, batched_weight = batched.get_volume()
+    np.testing.assert_array_equal(batched_weight, sequential_weight)
+    np.testing.assert_allclose(batched_tsdf, sequential_tsdf, rtol=0, atol=1e-5)
+    # Batches round the running color mean once per batch instead of once per frame.
+    np.testing.assert_allclose(batched_color, sequential_color, rtol=0, atol=1.0)
+
+
+def test_sparse_tsdf_skips_only_unobserved_blocks(monkeypatch):
+    frames = get_frames()
+    batch = [np.stack(x) for x in zip(*frames)]
+    skipping = SparseTSDFVolume(VOXEL_SIZE, margin=MARGIN, device="cpu", block_size=4)
+    reference = SparseTSDFVolume(VOXEL_SIZE, margin=MARGIN, device="cpu", block_size=4)
+    monkeypatch.setattr(
+        reference,
+        "get_visible_blocks",
+        lambda coords, frames: torch.ones(len(coords), dtype=torch.bool),
+    )
+
+    # After the first batch, each frame sees only part of the allocated blocks.
+    for volume in (skipping, reference):
+        volume.integrate_batch(*batch)
+        for frame in frames:
+            volume.integrate(*frame)
+
+    torch.testing.assert_close(skipping.weight, reference.weight, atol=0, rtol=0)
+    torch.testing.assert_close(skipping.tsdf, reference.tsdf, atol=0, rtol=0)
+    torch.testing.assert_close(skipping.color, reference.color, atol=0, rtol=0)
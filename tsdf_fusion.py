@@ -1,21 +1,26 @@
 # Copyright (c) 2018 Andy Zeng
 import os, time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 import numpy as np
 
-from numba import njit, prange
 from skimage import measure
-# import torch
 import argparse
-import cv2
-from PIL import Image
+import torch
 
-# read an image
-def read_img(filename):
-    img = Image.open(filename)
-    np_img = np.array(img, dtype=np.float32) / 255.
-    # np_img = np.array(img, dtype=np.float32)
-    return np_img
+from src.fusion.ply import write_mesh_ply, write_point_cloud_ply
+from src.fusion.scan import get_volume_bounds, load_scan
+from src.fusion.sparse_tsdf import SparseTSDFVolume
+from src.fusion.tsdf import TSDFVolumeTorch
 
+try:
+    from numba import njit, prange
+except ImportError:
+    # numba only speeds up the CPU path of TSDFVolume, the torch engine does not need it
+    def njit(*args, **kwargs):
+        return args[0] if args and callable(args[0]) else lambda f: f
+    prange = range
 
 class TSDFVolume:
     """Volumetric TSDF Fusion of RGB-D Images.
@@ -29,17 +34,15 @@ class TSDFVolume:
             xyz bounds (min/max) in meters.
           voxel_size (float): The volume discretization in meters.
         """
-        # try:
-        import pycuda.driver as cuda
-        import pycuda.autoinit
-        from pycuda.compiler import SourceModule
-
-        FUSION_GPU_MODE = 1
-        self.cuda = cuda
-        # except Exception as err:
-        #     print('Warning: {}'.format(err))
-        #     print('Failed to import PyCUDA. Running fusion in CPU mode.')
-        #     FUSION_GPU_MODE = 0
+        #* the CPU mode does not need PyCUDA
+        FUSION_GPU_MODE = 0
+        if use_gpu:
+            import pycuda.driver as cuda
+            import pycuda.autoinit
+            from pycuda.compiler import SourceModule
+
+            FUSION_GPU_MODE = 1
+            self.cuda = cuda
 
         vol_bnds = np.asarray(vol_bnds)
         assert vol_bnds.shape == (3, 2), "[!] `vol_bnds` should be of shape (3, 2)."
@@ -234,7 +237,7 @@ class TSDFVolume:
             # Fold RGB color image into a single channel image
             color_im = color_im.astype(np.float32)
             color_im = np.floor(color_im[..., 2] * self._color_const + color_im[..., 1] * 256 + color_im[..., 0])
-            color_im = color_im.reshape(-1).astype(np.float32)
+            color_im = color_im.astype(np.float32)
         else:
             color_im = np.array(1)
 
@@ -255,7 +258,7 @@ class TSDFVolume:
                                          self._trunc_margin,
                                          obs_weight
                                      ], np.float32)),
-                                     self.cuda.InOut(color_im),
+                                     self.cuda.InOut(color_im.reshape(-1)),
                                      self.cuda.InOut(depth_im.reshape(-1).astype(np.float32)),
                                      block=(self._max_gpu_threads_per_block, 1, 1),
                                      grid=(
@@ -364,163 +367,71 @@ def rigid_transform(xyz, transform):
     return xyz_t_h[:, :3]
 
 
-def get_view_frustum(depth_im, cam_intr, cam_pose):
-    """Get corners of 3D camera view frustum of depth image
-    """
-    im_h = depth_im.shape[0]
-    im_w = depth_im.shape[1]
-    max_depth = np.max(depth_im)
-    view_frust_pts = np.array([
-        (np.array([0, 0, 0, im_w, im_w]) - cam_intr[0, 2]) * np.array([0, max_depth, max_depth, max_depth, max_depth]) /
-        cam_intr[0, 0],
-        (np.array([0, 0, im_h, 0, im_h]) - cam_intr[1, 2]) * np.array([0, max_depth, max_depth, max_depth, max_depth]) /
-        cam_intr[1, 1],
-        np.array([0, max_depth, max_depth, max_depth, max_depth])
-    ])
-    view_frust_pts = rigid_transform(view_frust_pts.T, cam_pose).T
-    return view_frust_pts
-
-
 def meshwrite(filename, verts, faces, norms, colors):
-    """Save a 3D mesh to a polygon .ply file.
+    """Save a 3D mesh to a binary .ply file.
     """
-    # Write header
-    ply_file = open(filename, 'w')
-    ply_file.write("ply\n")
-    ply_file.write("format ascii 1.0\n")
-    ply_file.write("element vertex %d\n" % (verts.shape[0]))
-    ply_file.write("property float x\n")
-    ply_file.write("property float y\n")
-    ply_file.write("property float z\n")
-    ply_file.write("property float nx\n")
-    ply_file.write("property float ny\n")
-    ply_file.write("property float nz\n")
-    ply_file.write("property uchar red\n")
-    ply_file.write("property uchar green\n")
-    ply_file.write("property uchar blue\n")
-    ply_file.write("element face %d\n" % (faces.shape[0]))
-    ply_file.write("property list uchar int vertex_index\n")
-    ply_file.write("end_header\n")
-
-    # Write vertex list
-    for i in range(verts.shape[0]):
-        ply_file.write("%f %f %f %f %f %f %d %d %d\n" % (
-            verts[i, 0], verts[i, 1], verts[i, 2],
-            norms[i, 0], norms[i, 1], norms[i, 2],
-            colors[i, 0], colors[i, 1], colors[i, 2],
-        ))
-
-    # Write face list
-    for i in range(faces.shape[0]):
-        ply_file.write("3 %d %d %d\n" % (faces[i, 0], faces[i, 1], faces[i, 2]))
-
-    ply_file.close()
+    write_mesh_ply(filename, verts, faces, norms, colors)
 
 
 def pcwrite(filename, xyzrgb):
-    """Save a point cloud to a polygon .ply file.
+    """Save a point cloud to a binary .ply file.
     """
-    xyz = xyzrgb[:, :3]
-    rgb = xyzrgb[:, 3:].astype(np.uint8)
-
-    # Write header
-    ply_file = open(filename, 'w')
-    ply_file.write("ply\n")
-    ply_file.write("format ascii 1.0\n")
-    ply_file.write("element vertex %d\n" % (xyz.shape[0]))
-    ply_file.write("property float x\n")
-    ply_file.write("property float y\n")
-    ply_file.write("property float z\n")
-    ply_file.write("property uchar red\n")
-    ply_file.write("property uchar green\n")
-    ply_file.write("property uchar blue\n")
-    ply_file.write("end_header\n")
-
-    # Write vertex list
-    for i in range(xyz.shape[0]):
-        ply_file.write("%f %f %f %d %d %d\n" % (
-            xyz[i, 0], xyz[i, 1], xyz[i, 2],
-            rgb[i, 0], rgb[i, 1], rgb[i, 2],
-        ))
+    write_point_cloud_ply(filename, xyzrgb)
 
 
 def save_tsdf(args, scan, save_mesh=True, starting_idx=0):
-    img_path = os.path.join(args.root_dir, scan, "color")
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    scan_dir = Path(args.root_dir) / scan
     if args.n_view>0:
         views = [i+starting_idx for i in range(args.n_view)]
         
         if args.test_view is not None:
             views = args.test_view
     else:
-        n_view = len(os.listdir(img_path))
-
-        
+        n_view = len(os.listdir(scan_dir / "color"))
         print(n_view)
         views = [i+starting_idx for i in range(n_view)]
-    vol_bnds = np.zeros((3, 2))
-
-    # get image width and height
-    img_path = os.listdir(img_path)[0]
-    img = cv2.imread(os.path.join(args.root_dir, scan, "color", img_path))
-    im_h, im_w = img.shape[:2]
-    
-        
-    for id in views:
-        if args.test_view is not None:
-            data_tmp = np.load(os.path.join(args.root_dir, scan, "depth", "{:0>6}.npy".format(id)), allow_pickle=True).item()
-        else:
-            if os.path.exists(os.path.join(args.root_dir, scan, "depth", "{:0>6}.npy".format(id))) == False:
-                continue
-            data_tmp = np.load(os.path.join(args.root_dir, scan, "depth", "{:0>6}.npy".format(id)), allow_pickle=True).item()
-        # load the estimated depth of the reference view
-        depth_im = data_tmp['depth']
-        cam_intr = data_tmp['intrinsic']#[:3,:3]
-        
-        #TODO scale back intrinsic matrix
-        cam_intr[0, 0] = cam_intr[0, 0] * im_w
-        cam_intr[0, 2] = cam_intr[0, 2] * im_w
-        cam_intr[1, 1] = cam_intr[1, 1] * im_h
-        cam_intr[1, 2] = cam_intr[1, 2] * im_h
-        
-        
-        # cam_pose = np.linalg.inv(data_tmp['extrinsic']) #* make this a world to camera matrix
-        cam_pose = data_tmp['extrinsic']
 
-        # Compute camera view frustum and extend convex hull
-        view_frust_pts = get_view_frustum(depth_im, cam_intr, cam_pose)
-        vol_bnds[:, 0] = np.minimum(vol_bnds[:, 0], np.amin(view_frust_pts, axis=1))
-        vol_bnds[:, 1] = np.maximum(vol_bnds[:, 1], np.amax(view_frust_pts, axis=1))
+    #* every frame is read once and kept for both the bounds and the integration
+    frames = load_scan(scan_dir, views, skip_missing=args.test_view is None)
+    vol_bnds = get_volume_bounds(frames)
 
     print("Initializing voxel volume...")
-    tsdf_vol = TSDFVolume(vol_bnds, voxel_size=args.voxel_size, margin=args.margin)
-
-    for id in views:
-        if args.test_view is not None:
-            data_tmp = np.load(os.path.join(args.root_dir, scan, "depth", "{:0>6}.npy".format(id)), allow_pickle=True).item()
-        else:     
-            if os.path.exists(os.path.join(args.root_dir, scan, "depth", "{:0>6}".format(id))) == False:
-                continue
-            data_tmp = np.load(os.path.join(args.root_dir, scan, "depth", "{:0>6}.npy".format(id)), allow_pickle=True).item()
-        # load the estimated depth of the reference view
-        depth_im = data_tmp['depth']
-        cam_intr = data_tmp['intrinsic']#[:3,:3]
-        # cam_pose = np.linalg.inv(data_tmp['extrinsic'])
-        cam_pose = data_tmp['extrinsic']
-        #* load corresponidng color image
-        color_image = read_img(os.path.join(args.root_dir, scan, "color", "{:0>6}.png".format(id)))
-        
-        # Integrate observation into voxel volume (assume color aligned with depth)
-        tsdf_vol.integrate(color_image, depth_im, cam_intr, cam_pose, obs_weight=1.)
+    if args.engine == "sparse":
+        tsdf_vol = SparseTSDFVolume(voxel_size=args.voxel_size, margin=args.margin, device=args.device)
+    elif args.engine == "torch":
+        tsdf_vol = TSDFVolumeTorch(vol_bnds, voxel_size=args.voxel_size, margin=args.margin,
+                                   device=args.device, block_size=args.block_size)
+    else:
+        tsdf_vol = TSDFVolume(vol_bnds, voxel_size=args.voxel_size, margin=args.margin)
+
+    # Integrate observation into voxel volume (assume color aligned with depth)
+    if args.engine in ("torch", "sparse"):
+        #* the torch engines integrate several frames per call
+        for i in range(0, len(frames), args.batch_size):
+            batch = frames[i:i + args.batch_size]
+            tsdf_vol.integrate_batch(
+                np.stack([frame.color for frame in batch]),
+                np.stack([frame.depth for frame in batch]),
+                np.stack([frame.intrinsics for frame in batch]),
+                np.stack([frame.extrinsics for frame in batch]),
+                obs_weight=1.,
+            )
+    else:
+        for frame in frames:
+            tsdf_vol.integrate(frame.color, frame.depth, frame.intrinsics, frame.extrinsics, obs_weight=1.)
 
     print("Saving mesh...")
     verts, faces, norms, colors = tsdf_vol.get_mesh()
 
-    #! get point clouds
-    pc = tsdf_vol.get_point_cloud()
+    #! the point cloud holds the mesh vertices, so marching cubes runs once
+    pc = np.hstack([verts, colors])
     
     meshwrite(os.path.join(args.root_dir, "mesh", "{}.ply".format(scan)), verts, faces, norms, colors)
     
     pcwrite(os.path.join(args.root_dir, "pcd", "{}.ply".format(scan)), pc)
+    return scan
     
 
 if __name__ == "__main__":
@@ -536,6 +447,14 @@ if __name__ == "__main__":
     parser.add_argument("--test_view", type=int, nargs="+", default=None)
     parser.add_argument('--test_scan', dest='test_scan', type=str, nargs="+", default=[''],)
     parser.add_argument('--starting_idx', type=int, default=0)
+    parser.add_argument('--engine', type=str, default="torch", choices=["torch", "sparse", "pycuda"],
+        help='torch runs on any torch device, sparse only allocates voxels near the surface, '
+             'pycuda needs a CUDA GPU')
+    parser.add_argument('--device', type=str, default=None, help='torch device, default: cuda if available')
+    parser.add_argument('--block_size', type=int, default=32, help='voxels per side of a processing block')
+    parser.add_argument('--batch_size', type=int, default=8, help='frames integrated per call')
+    parser.add_argument('--num_threads', type=int, default=None, help='CPU threads used by torch per scan')
+    parser.add_argument('--num_workers', type=int, default=1, help='scans fused in parallel processes')
 
     args = parser.parse_args()
 
@@ -549,5 +468,13 @@ if __name__ == "__main__":
 
     os.makedirs(os.path.join(args.root_dir, "mesh"), exist_ok=True)
     os.makedirs(os.path.join(args.root_dir, "pcd"), exist_ok=True)
-    for scan in scans:
-        save_tsdf(args, scan, starting_idx=args.starting_idx) #* save mesh
\ No newline at end of file
+    if args.num_workers > 1:
+        #* spawn, so that workers can use CUDA
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(args.num_workers, mp_context=context) as executor:
+            futures = [executor.submit(save_tsdf, args, scan, starting_idx=args.starting_idx) for scan in scans]
+            for future in as_completed(futures):
+                print("saved", future.result())
+    else:
+        for scan in scans:
+            save_tsdf(args, scan, starting_idx=args.starting_idx) #* save mesh
\ No newline at end of file